@@ -1,19 +1,145 @@
 import os
-from supabase import create_client, Client as SupabaseClient
-from flask import session
-from twilio.rest import Client as TwilioClient  # avoid name
+import threading
+import time
+from functools import cached_property
+from typing import TYPE_CHECKING
 import re
 
+from database import get_supabase
+from logs import get_logger
+from metrics import track_upstream
+
+if TYPE_CHECKING:
+    from supabase import Client as SupabaseClient
+
+log = get_logger('auth')
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def normalise_phone_number(phone):
+    """Strips everything but digits, keeping a leading +."""
+    phone = phone.strip()
+    # Keep + at the beginning if it exists, then keep only digits
+    if phone.startswith('+'):
+        return '+' + _NON_DIGITS.sub('', phone[1:])  # keep +, remove non-digits after
+    return _NON_DIGITS.sub('', phone)  # remove all non-digits
+
+
+class OrganisationPhoneIndex:
+    """
+    Process-local index from normalised phone number to organisation ID, used by login.
+
+    The index is built from one fetch of every organisation's org_phone_numbers and
+    rebuilt once it is older than PHONE_INDEX_TTL, or after invalidate() (call it
+    whenever organisation phone numbers change). A number missing from the index is
+    confirmed with a direct query, since it may have been added since the last build;
+    numbers confirmed unknown are remembered for PHONE_INDEX_NEGATIVE_TTL so repeated
+    attempts do not reach the database.
+    """
+
+    # Upper bound on remembered unknown numbers, cleared wholesale when reached
+    MAX_NEGATIVE_ENTRIES = 10000
+
+    def __init__(self, ttl=None, negative_ttl=None):
+        self.ttl = float(ttl or os.getenv('PHONE_INDEX_TTL', 300))
+        self.negative_ttl = float(negative_ttl or os.getenv('PHONE_INDEX_NEGATIVE_TTL', 30))
+
+        self._lock = threading.Lock()
+        self._index = {}
+        self._built_at = None
+        self._unknown = {}  # phone -> time confirmed unknown
+        self._stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'builds': 0}
+
+    def _is_fresh(self):
+        return self._built_at is not None and time.monotonic() - self._built_at < self.ttl
+
+    def _ensure_built(self):
+        if self._is_fresh():
+            return
+        with self._lock:
+            if self._is_fresh():
+                return
+            try:
+                response = (
+                    get_supabase()
+                    .table('organisations')
+                    .select('id, org_phone_numbers')
+                    .execute()
+                )
+            except Exception as e:
+                if not self._index:
+                    raise
+                log.warning("Error rebuilding phone index, keeping the previous one", extra={'error': str(e)})
+                return
+
+            index = {}
+            for organisation in response.data:
+                for number in organisation.get('org_phone_numbers') or []:
+                    index.setdefault(normalise_phone_number(str(number)), organisation['id'])
+
+            self._index = index
+            self._unknown = {}
+            self._built_at = time.monotonic()
+            self._stats['builds'] += 1
+
+    def lookup(self, phone):
+        """Returns the organisation ID registered for a phone number, or None."""
+        cleaned_phone = normalise_phone_number(phone)
+        if not cleaned_phone.lstrip('+'):
+            # An empty array filter would match every organisation
+            return None
+        self._ensure_built()
+
+        organisation_id = self._index.get(cleaned_phone)
+        if organisation_id is not None:
+            self._stats['hits'] += 1
+            return organisation_id
+
+        unknown_at = self._unknown.get(cleaned_phone)
+        if unknown_at is not None and time.monotonic() - unknown_at < self.negative_ttl:
+            self._stats['negative_hits'] += 1
+            return None
+
+        self._stats['misses'] += 1
+        response = (
+            get_supabase()
+            .table('organisations')
+            .select('id')
+            .filter('org_phone_numbers', 'cs', f'{{{cleaned_phone}}}')  # Array format
+            .limit(1)
+            .execute()
+        )
+
+        with self._lock:
+            if response.data:
+                organisation_id = response.data[0]['id']
+                self._index[cleaned_phone] = organisation_id
+                self._unknown.pop(cleaned_phone, None)
+                return organisation_id
+
+            if len(self._unknown) >= self.MAX_NEGATIVE_ENTRIES:
+                self._unknown.clear()
+            self._unknown[cleaned_phone] = time.monotonic()
+            return None
+
+    def invalidate(self):
+        """Forces a rebuild on the next lookup."""
+        with self._lock:
+            self._built_at = None
+            self._unknown = {}
+
+    def stats(self):
+        return dict(self._stats, entries=len(self._index))
+
+
+phone_index = OrganisationPhoneIndex()
+
+
 class UserAuthentication:
     def __init__(self):
         # Supabase setup
-        url = os.getenv("SUPABASE_URL")
-        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-        if not url or not service_role_key:
-            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
-
-        self.supabase: SupabaseClient = create_client(url, service_role_key)
+        self.supabase: SupabaseClient = get_supabase()
 
         # Twilio Verify setup
         self.twilio_account_sid = os.getenv("TWILIO_ACCOUNT_SID")
@@ -23,70 +149,61 @@ class UserAuthentication:
         if not self.twilio_account_sid or not self.twilio_auth_token or not self.twilio_service_sid:
             raise ValueError("Missing Twilio environment variables.")
 
-        self.twilio_client = TwilioClient(self.twilio_account_sid, self.twilio_auth_token)
+    @cached_property
+    def twilio_client(self):
+        """Twilio client, built on first use so routes that never send an OTP do not load the Twilio SDK."""
+        from twilio.rest import Client as TwilioClient  # avoid name
+        return TwilioClient(self.twilio_account_sid, self.twilio_auth_token)
 
     def send_otp(self, to_phone):
         """Send an OTP to the user's phone using Twilio Verify Default Template"""
         try:
-            verification = self.twilio_client.verify.v2.services(self.twilio_service_sid).verifications.create(
-                to=to_phone,
-                channel="sms"
-            )
+            with track_upstream('twilio.verify_send'):
+                verification = self.twilio_client.verify.v2.services(self.twilio_service_sid).verifications.create(
+                    to=to_phone,
+                    channel="sms"
+                )
             return verification.status == "pending"
         except Exception as e:
-            print(f"Error sending OTP: {e}")
+            log.error("Error sending OTP", extra={'error': str(e)})
             return False
 
     def verify_otp(self, to_phone, code) -> bool:
         """Check if the user-provided code matches the one sent"""
         try:
-            verification_check = self.twilio_client.verify.v2.services(self.twilio_service_sid).verification_checks.create(
-                to=to_phone,
-                code=code
-            )
+            with track_upstream('twilio.verify_check'):
+                verification_check = self.twilio_client.verify.v2.services(self.twilio_service_sid).verification_checks.create(
+                    to=to_phone,
+                    code=code
+                )
             return verification_check.status == "approved"
         except Exception as e:
-            print(f"Error verifying OTP: {e}")
+            log.error("Error verifying OTP", extra={'error': str(e)})
             return False
 
 
 
     def clean_phone_number(self, phone):
-        phone = phone.strip()
-        # Keep + at the beginning if it exists, then keep only digits
-        if phone.startswith('+'):
-            cleaned = '+' + re.sub(r'\D', '', phone[1:])  # keep +, remove non-digits after
-        else:
-            cleaned = re.sub(r'\D', '', phone)  # remove all non-digits
-
-        return cleaned
+        return normalise_phone_number(phone)
 
     def check_organisation_number(self, phone):
         """Checks if that number is in an organisation's phone numbers array and returns the organisation ID if found."""
         try:
             cleaned_phone = self.clean_phone_number(phone)
 
-            print(f"Original phone: {phone}")
-            print(f"Cleaned phone: {cleaned_phone}")
+            # Resolved from the in-process phone index (see OrganisationPhoneIndex)
+            organisation_id = phone_index.lookup(cleaned_phone)
 
-            response = (
-                self.supabase
-                .table('organisations')
-                .select('id, org_phone_numbers')
-                .filter('org_phone_numbers', 'cs', f'{{{cleaned_phone}}}')  # Array format
-                .execute()
-            )
-
-            if response.data:
-                organisation_id = response.data[0]['id']
-                print(f'{cleaned_phone} exists in the database under organisation ID {organisation_id}')
+            # Phone numbers are personal data, so they are never logged
+            if organisation_id is not None:
+                log.info("Phone number matched an organisation", extra={'organisation_id': organisation_id})
                 return True, organisation_id
             else:
-                print(f'{cleaned_phone} does not exist in the database')
+                log.info("Phone number not registered with any organisation")
                 return False, None
 
         except Exception as e:
-            print(f"Error checking phone number: {e}")
+            log.error("Error checking phone number", extra={'error': str(e)})
             return False, None
 
 
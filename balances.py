@@ -0,0 +1,169 @@
+import os
+
+from batching import fetch_in
+from cache import BoundedCache
+from database import get_supabase
+
+
+def _relation_missing(error):
+    """True if a Supabase query failed because loan_balances has not been created (migration not applied)."""
+    return getattr(error, 'code', None) in ('PGRST205', '42P01')
+
+
+def _function_missing(error):
+    """True if an RPC failed because the function has not been created (migration not applied)."""
+    return getattr(error, 'code', None) == 'PGRST202'
+
+
+class LoanBalanceStore:
+    """
+    Current balance per loan, read from the loan_balances table (migrations/002_loan_balances.sql).
+
+    The table is kept up to date by a trigger on loan_repayments, so it changes in
+    the same transaction as the repayment insert and a lookup is a key read rather
+    than a scan of the repayment history. Balances are also kept in a per-process
+    write-through cache for display reads: callers that insert repayments pass the
+    rows to record(), and other workers pick up the change once their entry expires
+    (BALANCE_CACHE_TTL). Settlement reads with fresh=True, since a balance another
+    worker changed within the TTL would skew the interest/principal split.
+
+    Until the migration is applied, lookups fall back to the latest loan_repayments row
+    (migrations/003_latest_loan_balances.sql).
+    """
+
+    def __init__(self, ttl=None, max_bytes=None):
+        self._cache = BoundedCache(
+            max_bytes=max_bytes or os.getenv('BALANCE_CACHE_MAX_BYTES', 4 * 1024 * 1024),
+            ttl=ttl or os.getenv('BALANCE_CACHE_TTL', 30)
+        )
+
+    @property
+    def supabase(self):
+        return get_supabase()
+
+    def get(self, loan_id, fresh=False):
+        """Returns the current balance of a loan, or None if it has no repayments yet."""
+        return self.get_many([loan_id], fresh=fresh).get(loan_id)
+
+    def get_many(self, loan_ids, fresh=False):
+        """
+        Returns the current balance of several loans with one query per URL-sized chunk of IDs.
+
+        Args:
+            loan_ids (list): Loan IDs to look up.
+            fresh (bool): Read every loan from the database rather than the cache
+                (the rows read still refresh the cache).
+
+        Returns:
+            dict: loan_id -> balance (float) for loans with at least one repayment.
+        """
+        balances = {}
+        missing = []
+        for loan_id in dict.fromkeys(loan_ids):
+            balance = None if fresh else self._cache.get(loan_id)
+            if balance is None:
+                missing.append(loan_id)
+            else:
+                balances[loan_id] = balance
+
+        if not missing:
+            return balances
+
+        try:
+            fetched = self._stored(missing)
+        except Exception as e:
+            if not _relation_missing(e):
+                raise
+            fetched = self._latest_from_history(missing)
+
+        for loan_id, balance in fetched.items():
+            self._cache.set(loan_id, balance)
+        balances.update(fetched)
+        return balances
+
+    def record(self, repayment_rows):
+        """Writes the balances of just-inserted loan_repayments rows through to the cache (last row per loan wins)."""
+        for row in repayment_rows:
+            self._cache.set(row['loan_id'], float(row['balance']))
+
+    def invalidate(self, loan_id):
+        self._cache.invalidate(loan_id)
+
+    def _stored(self, loan_ids):
+        """Balances held in loan_balances (one row per loan)."""
+        rows = fetch_in(
+            lambda: self.supabase.table('loan_balances').select('loan_id, balance'),
+            'loan_id', loan_ids
+        )
+        return {row['loan_id']: float(row['balance']) for row in rows}
+
+    def _latest_from_history(self, loan_ids):
+        """
+        Latest balance per loan computed from loan_repayments.
+
+        The latest_loan_balances function returns one row per loan. Until it is created,
+        every repayment of the loans is read page by page and the newest row is kept.
+        """
+        loan_ids = list(dict.fromkeys(loan_ids))
+        if not loan_ids:
+            return {}
+
+        try:
+            response = self.supabase.rpc('latest_loan_balances', {'p_loan_ids': loan_ids}).execute()
+            return {row['loan_id']: float(row['balance']) for row in response.data}
+        except Exception as e:
+            if not _function_missing(e):
+                raise
+
+        rows = fetch_in(
+            lambda: self.supabase.table('loan_repayments').select('id, loan_id, balance, created_at'),
+            'loan_id', loan_ids, paged=True
+        )
+        # Pages come oldest first, so the newest row of each loan is written last
+        return {row['loan_id']: float(row['balance']) for row in rows}
+
+    def verify(self, loan_ids, repair=True):
+        """
+        Checks loan_balances against the repayment history and optionally rebuilds mismatched rows.
+
+        Args:
+            loan_ids (list): Loans to check.
+            repair (bool): Upsert the balance recomputed from history for every mismatch.
+
+        Returns:
+            dict: {'checked': int, 'mismatched': {loan_id: (stored, expected)}, 'repaired': int}
+        """
+        loan_ids = list(dict.fromkeys(loan_ids))
+        expected = self._latest_from_history(loan_ids)
+        stored = self._stored(loan_ids)
+
+        mismatched = {
+            loan_id: (stored.get(loan_id), balance)
+            for loan_id, balance in expected.items()
+            if stored.get(loan_id) is None or abs(stored[loan_id] - balance) > 0.005
+        }
+
+        repaired = 0
+        if repair and mismatched:
+            self.supabase.table('loan_balances').upsert(
+                [{'loan_id': loan_id, 'balance': balance} for loan_id, (_, balance) in mismatched.items()],
+                on_conflict='loan_id'
+            ).execute()
+            repaired = len(mismatched)
+
+        for loan_id in mismatched:
+            self._cache.invalidate(loan_id)
+
+        return {'checked': len(loan_ids), 'mismatched': mismatched, 'repaired': repaired}
+
+    def rebuild(self):
+        """Recomputes the whole loan_balances table from history on the database side. Returns rows changed."""
+        response = self.supabase.rpc('rebuild_loan_balances', {}).execute()
+        self._cache.clear()
+        return response.data
+
+    def stats(self):
+        return self._cache.stats()
+
+
+balance_store = LoanBalanceStore()
@@ -0,0 +1,140 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from pagination import fetch_all
+
+# Budget for the URL-encoded values of one in_() filter; keeps request lines well under common 8KB limits
+IN_FILTER_MAX_BYTES = int(os.getenv('SUPABASE_IN_FILTER_MAX_BYTES', 4000))
+QUERY_WORKERS = int(os.getenv('SUPABASE_QUERY_WORKERS', 4))
+FAN_OUT_WORKERS = int(os.getenv('SUPABASE_FAN_OUT_WORKERS', 8))
+
+_lock = threading.Lock()
+_executors = {}  # name -> (pid, ThreadPoolExecutor)
+_local = threading.local()
+
+
+def _get_executor(name, workers):
+    """Bounded pool `name` shared by this process (recreated after fork)."""
+    pid = os.getpid()
+    entry = _executors.get(name)
+    if entry is None or entry[0] != pid:
+        with _lock:
+            entry = _executors.get(name)
+            if entry is None or entry[0] != pid:
+                entry = _executors[name] = (pid, ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name))
+    return entry[1]
+
+
+def _run_fanned_out(call):
+    _local.fanned_out = True
+    try:
+        return call()
+    finally:
+        _local.fanned_out = False
+
+
+def gather(*calls):
+    """
+    Runs independent zero-argument calls (typically Supabase reads) concurrently and
+    returns their results in the same order, so a request waits for the slowest read
+    rather than the sum of all of them.
+
+    The first call runs in the calling thread and the rest on a bounded pool; every
+    call has finished when gather returns, so nothing outlives the request. If any
+    call raises, the first exception (in call order) is re-raised. Calls made from
+    inside a gathered call run sequentially, so nested gathers cannot exhaust the pool.
+
+    The calls run outside Flask's request context, so read session values before
+    gathering and pass them in. Context variables (the request's log IDs and trace)
+    are copied into each call.
+    """
+    if len(calls) <= 1 or getattr(_local, 'fanned_out', False):
+        return tuple(call() for call in calls)
+
+    executor = _get_executor('supabase-fan-out', FAN_OUT_WORKERS)
+    futures = [executor.submit(contextvars.copy_context().run, _run_fanned_out, call) for call in calls[1:]]
+
+    results = []
+    error = None
+    try:
+        results.append(calls[0]())
+    except Exception as e:
+        error = e
+        results.append(None)
+
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+            results.append(None)
+
+    if error is not None:
+        raise error
+    return tuple(results)
+
+
+def chunk_ids(ids, max_bytes=None):
+    """
+    Splits IDs into chunks whose URL-encoded in_() list stays within max_bytes.
+
+    Duplicates are dropped and the original order is kept.
+    """
+    max_bytes = int(max_bytes or IN_FILTER_MAX_BYTES)
+    chunks = []
+    chunk = []
+    size = 0
+    for value in dict.fromkeys(ids):
+        # Encoded value plus its encoded separating comma
+        value_size = len(quote(str(value), safe='')) + 3
+        if chunk and size + value_size > max_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+        chunk.append(value)
+        size += value_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def fetch_in(build_query, column, ids, paged=False, max_bytes=None):
+    """
+    Runs `build_query().in_(column, chunk)` for URL-safe chunks of ids and merges the rows.
+
+    Chunks run concurrently on a bounded thread pool over the shared Supabase client;
+    the rows are returned in chunk order, as a single in_() query would have listed them
+    chunk by chunk.
+
+    Args:
+        build_query (callable): Returns a fresh select, e.g. lambda: supabase.table('borrowers').select('id, phone').
+        column (str): Column filtered with in_().
+        ids (iterable): Values to match.
+        paged (bool): Read each chunk with keyset pagination (see pagination.iter_rows),
+            for chunks that can match more rows than PostgREST returns at once.
+        max_bytes (int, optional): Encoded size budget per chunk, defaults to SUPABASE_IN_FILTER_MAX_BYTES.
+
+    Returns:
+        list: Matching rows.
+    """
+    chunks = chunk_ids(ids, max_bytes=max_bytes)
+    if not chunks:
+        return []
+
+    def run(chunk):
+        if paged:
+            return fetch_all(lambda: build_query().in_(column, chunk))
+        return build_query().in_(column, chunk).execute().data
+
+    if len(chunks) == 1:
+        return run(chunks[0])
+
+    rows = []
+    executor = _get_executor('supabase-query', QUERY_WORKERS)
+    # One copy of the caller's context (log IDs, trace) per chunk; a context cannot run in two threads at once
+    futures = [executor.submit(contextvars.copy_context().run, run, chunk) for chunk in chunks]
+    for chunk_rows in (future.result() for future in futures):
+        rows.extend(chunk_rows)
+    return rows
@@ -4,15 +4,32 @@ import uuid
 from datetime import datetime
 import mimetypes
 
-import bcrypt
-from supabase import create_client, Client
+from typing import TYPE_CHECKING
+from batching import fetch_in
+from cache import BoundedCache
+from columns import BORROWERS
+from database import get_supabase
 from flask import session
+from logs import get_logger
 import os
 import random
 import string
 import smtplib
 from email.message import EmailMessage
 
+if TYPE_CHECKING:
+    from supabase import Client
+
+log = get_logger('borrowers')
+
+# borrower_id -> borrower row, shared by staff pages and payment flows in this process
+borrower_cache = BoundedCache(
+    max_bytes=os.getenv('BORROWER_CACHE_MAX_BYTES', 8 * 1024 * 1024),
+    ttl=os.getenv('BORROWER_CACHE_TTL', 300)
+)
+# loan_id -> borrower_id; a loan's borrower never changes, so this only ages out to bound memory
+loan_borrower_ids = BoundedCache(max_bytes=2 * 1024 * 1024, ttl=24 * 3600)
+
 
 def get_content_type(file_extension):
     """Helper function to get content type based on file extension"""
@@ -24,13 +41,7 @@ class Borrowers:
     """contains methods required for the home template"""
 
     def __init__(self):
-        url = os.getenv("SUPABASE_URL")
-        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-        if not url or not service_role_key:
-            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
-
-        self.supabase: Client = create_client(url, service_role_key)
+        self.supabase: Client = get_supabase()
 
         # email authentication
         self.sender_email = os.getenv('SENDER_EMAIL')
@@ -38,44 +49,107 @@ class Borrowers:
 
     def get_borrower_by_loan(self, loan_id):
         """Gets the borrower information by loan_id."""
+        borrower = self.get_borrowers_by_loans([loan_id]).get(loan_id)
+        if borrower is None:
+            log.error("Borrower for loan not found", extra={'loan_id': loan_id})
+        return borrower
+
+    def get_borrowers(self, borrower_ids):
+        """
+        Returns borrower rows by ID, from borrower_cache where possible.
+
+        Args:
+            borrower_ids (list): Borrower IDs.
+
+        Returns:
+            dict: borrower_id -> borrower row, for borrowers that exist.
+        """
+        borrowers = {}
+        missing = []
+        for borrower_id in dict.fromkeys(borrower_ids):
+            borrower = borrower_cache.get(borrower_id)
+            if borrower is None:
+                missing.append(borrower_id)
+            else:
+                borrowers[borrower_id] = borrower
+
+        if missing:
+            try:
+                rows = BORROWERS.track(fetch_in(lambda: BORROWERS.query(self.supabase), 'id', missing))
+            except Exception:
+                log.exception("get_borrowers failed")
+                return borrowers
+
+            for borrower in rows:
+                borrower_cache.set(borrower['id'], borrower)
+                borrowers[borrower['id']] = borrower
+
+        return borrowers
+
+    def get_borrowers_by_loans(self, loan_ids):
+        """
+        Returns the borrower of each loan, resolving uncached loans with one embedded select
+        (loans joined to borrowers) instead of a loan query plus a borrower query per loan.
+
+        Args:
+            loan_ids (list): Loan IDs.
+
+        Returns:
+            dict: loan_id -> borrower row, for loans whose borrower exists.
+        """
+        borrowers = {}
+        unresolved = []
+        for loan_id in dict.fromkeys(loan_ids):
+            borrower_id = loan_borrower_ids.get(loan_id)
+            borrower = borrower_cache.get(borrower_id) if borrower_id is not None else None
+            if borrower is None:
+                unresolved.append(loan_id)
+            else:
+                borrowers[loan_id] = borrower
+
+        if not unresolved:
+            return borrowers
 
         try:
-            # Step 1: Get borrower_id from the loans table
-            loan_response = (
-                self.supabase
-                .table('loans')
-                .select('borrower_id')
-                .eq('id', loan_id)
-                .single()
-                .execute()
-            )
-
-            if not loan_response.data:
-                print(f"[ERROR] Loan with ID {loan_id} not found.")
-                return None
-
-            borrower_id = loan_response.data.get('borrower_id')
-
-            if not borrower_id:
-                print(f"[ERROR] borrower_id not found for loan {loan_id}.")
-                return None
-
-            # Step 2: Get borrower details from borrowers table
-            borrower_response = (
-                self.supabase
-                .table('borrowers')
-                .select('*')
-                .eq('id', borrower_id)
-                .single()
-                .execute()
+            rows = fetch_in(
+                lambda: self.supabase.table('loans').select(f'id, borrower_id, {BORROWERS.embedded}'),
+                'id',
+                unresolved
             )
-
-            if not borrower_response.data:
-                print(f"[ERROR] Borrower with ID {borrower_id} not found.")
-                return None
-
-            return borrower_response.data
-
         except Exception as e:
-            print(f"[EXCEPTION] get_borrower_by_loan failed: {e}")
-            return None
+            # PGRST200: no foreign key from loans.borrower_id to borrowers to embed through
+            if getattr(e, 'code', None) != 'PGRST200':
+                log.exception("get_borrowers_by_loans failed")
+                return borrowers
+            return dict(borrowers, **self._get_borrowers_by_loans_unjoined(unresolved))
+
+        for row in rows:
+            borrower_id = row.get('borrower_id')
+            if not borrower_id:
+                continue
+            loan_borrower_ids.set(row['id'], borrower_id)
+
+            borrower = row.get('borrowers')
+            if borrower:
+                borrower = BORROWERS.track([borrower])[0]
+                borrower_cache.set(borrower_id, borrower)
+                borrowers[row['id']] = borrower
+
+        return borrowers
+
+    def _get_borrowers_by_loans_unjoined(self, loan_ids):
+        """get_borrowers_by_loans without embedding: loans -> borrower IDs, then borrowers in bulk."""
+        rows = fetch_in(lambda: self.supabase.table('loans').select('id, borrower_id'), 'id', loan_ids)
+
+        borrower_ids_by_loan = {}
+        for row in rows:
+            if row.get('borrower_id'):
+                loan_borrower_ids.set(row['id'], row['borrower_id'])
+                borrower_ids_by_loan[row['id']] = row['borrower_id']
+
+        borrowers = self.get_borrowers(borrower_ids_by_loan.values())
+        return {
+            loan_id: borrowers[borrower_id]
+            for loan_id, borrower_id in borrower_ids_by_loan.items()
+            if borrower_id in borrowers
+        }
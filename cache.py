@@ -0,0 +1,252 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(obj, _seen=None):
+    """Approximate deep size in bytes of plain data (dicts, lists, sets, tuples, scalars, simple objects)."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key, _seen) + estimate_size(value, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += estimate_size(item, _seen)
+    elif hasattr(obj, '__dict__'):
+        size += estimate_size(vars(obj), _seen)
+    return size
+
+
+class BoundedCache:
+    """
+    Thread-safe LRU cache bounded by an approximate byte budget, with a TTL per entry.
+
+    Entries are evicted least-recently-used first once the total estimated size
+    exceeds `max_bytes`; entries older than `ttl` seconds are treated as misses.
+    The cache is per process, so explicit invalidation only affects the worker
+    that performed the write and other workers fall back on the TTL.
+    """
+
+    def __init__(self, max_bytes, ttl, sizeof=estimate_size):
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self._sizeof = sizeof
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            value, size, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        """Stores value under key, evicting least-recently-used entries to stay within budget."""
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            if size > self.max_bytes:
+                # Never worth caching something that would flush everything else
+                return
+
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """Drops the entry for key, if any."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        """Returns hit/miss/eviction counters along with current usage."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+        return stats
+
+
+# Loans and completed repayments per organisation, shared by the schedule and staff-breakdown views
+schedule_cache = BoundedCache(
+    max_bytes=os.getenv('SCHEDULE_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+    ttl=os.getenv('SCHEDULE_CACHE_TTL', 300)
+)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = {}  # event loop -> future its async followers await
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait and receive the same result (or exception). Results accepted
+    by `cacheable` are additionally kept in `cache` so callers shortly after the
+    flight finished do not run it again.
+    """
+
+    def __init__(self, cache=None, cacheable=None):
+        self.cache = cache
+        self.cacheable = cacheable or (lambda result: False)
+
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {'executions': 0, 'coalesced': 0, 'cache_hits': 0}
+
+    def do(self, key, fn):
+        """Returns fn() for key, sharing one execution among concurrent callers."""
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        flight, leader = self._join(key)
+        if not leader:
+            flight.done.wait()
+            return self._shared_result(flight)
+
+        try:
+            return self._succeed(key, flight, fn())
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    async def do_async(self, key, fn):
+        """
+        Async do(): fn is a coroutine function, awaited by the leader on its own event loop.
+
+        Flights are shared with do(), so sync and async callers for the same key
+        (e.g. the poller and an async view) still make a single execution; async
+        followers await a future on their own loop, resolved when the flight lands.
+        """
+        cached = self._cached(key)
+        if cached is not None:
+            return cached
+
+        flight, leader = self._join(key)
+        if not leader:
+            await self._wait_async(flight)
+            return self._shared_result(flight)
+
+        try:
+            return self._succeed(key, flight, await fn())
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+
+    def _cached(self, key):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(key)
+        if cached is not None:
+            with self._lock:
+                self._stats['cache_hits'] += 1
+        return cached
+
+    def _join(self, key):
+        """Returns (flight, leader): the flight in progress for key, or a new one this caller leads."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._stats['executions'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        return flight, leader
+
+    async def _wait_async(self, flight):
+        """Waits for flight to land; followers on the same loop share one future."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if flight.done.is_set():
+                return
+            future = flight.waiters.get(loop)
+            if future is None:
+                future = flight.waiters[loop] = loop.create_future()
+        # Shielded so a cancelled follower does not cancel the others' wait
+        await asyncio.shield(future)
+
+    @staticmethod
+    def _shared_result(flight):
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _succeed(self, key, flight, result):
+        flight.result = result
+        if self.cache is not None and self.cacheable(result):
+            self.cache.set(key, result)
+        return result
+
+    def _land(self, key, flight):
+        with self._lock:
+            self._flights.pop(key, None)
+            flight.done.set()
+            waiters, flight.waiters = flight.waiters, {}
+        for loop, future in waiters.items():
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # The waiting loop has been closed; nobody is left to wake
+                pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,128 @@
+import os
+
+# Set COLUMN_AUDIT=1 (e.g. in development) to record which declared columns each call site reads
+COLUMN_AUDIT = os.getenv('COLUMN_AUDIT', '0') not in ('0', 'false', 'False')
+
+
+class _TrackedRow(dict):
+    """Row dict that reports the keys read from it to its ColumnSet."""
+
+    def __init__(self, row, column_set):
+        super().__init__(row)
+        self._column_set = column_set
+
+    def __getitem__(self, key):
+        self._column_set._read.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._column_set._read.add(key)
+        return super().get(key, default)
+
+
+class ColumnSet:
+    """
+    The columns one call site fetches from a table, declared next to the other call sites below.
+
+    query() builds the select with exactly those columns, so hot paths never pull
+    whole rows with select('*'). With COLUMN_AUDIT enabled, rows passed through
+    track() record the keys the call site reads, and unread() lists declared
+    columns it never used - a sign the declaration can be narrowed.
+    """
+
+    def __init__(self, name, table, *columns, key=()):
+        self.name = name
+        self.table = table
+        self.columns = tuple(columns)
+        # Columns the query itself needs (e.g. the pagination key), exempt from the audit
+        self.key = tuple(key)
+        self._read = set()
+
+    @property
+    def select(self):
+        return ', '.join(self.columns)
+
+    @property
+    def embedded(self):
+        """The columns as an embedded resource in another table's select, e.g. 'borrowers(id, phone)'."""
+        return f'{self.table}({self.select})'
+
+    def query(self, supabase):
+        """Returns supabase.table(table).select(columns), ready for filters."""
+        return supabase.table(self.table).select(self.select)
+
+    def track(self, rows):
+        """Returns rows (a list or a stream) unchanged, or wrapped to record the keys read when COLUMN_AUDIT is on."""
+        if not COLUMN_AUDIT:
+            return rows
+        if isinstance(rows, list):
+            return [_TrackedRow(row, self) for row in rows]
+        return (_TrackedRow(row, self) for row in rows)
+
+    def unread(self):
+        """Declared columns not read since tracking started (only meaningful with COLUMN_AUDIT)."""
+        return [column for column in self.columns if column not in self._read and column not in self.key]
+
+
+# Queries read with pagination.iter_rows also need its (created_at, id) key
+PAGE_KEY = ('created_at', 'id')
+
+# Loans feeding the schedule engine (schedule.ScheduleArrays / MonthIndex)
+SCHEDULE_LOANS = ColumnSet(
+    'schedule_loans', 'loans',
+    'id', 'created_at', 'term_months', 'monthly_payment', 'borrower_id', 'remaining_payments',
+    key=PAGE_KEY
+)
+
+# Completed repayments reduced to paid months per loan (Loans.map_payments_by_month)
+PAID_MONTH_REPAYMENTS = ColumnSet(
+    'paid_month_repayments', 'loan_repayments',
+    'id', 'loan_id', 'created_at',
+    key=PAGE_KEY
+)
+
+# Loans and repayments shown in the monthly repayments summary (Loans.get_monthly_loan_repayments)
+REPAYMENT_SUMMARY_LOANS = ColumnSet(
+    'repayment_summary_loans', 'loans',
+    'id', 'created_at', 'monthly_payment', 'term_months',
+    key=PAGE_KEY
+)
+REPAYMENT_SUMMARY_REPAYMENTS = ColumnSet(
+    'repayment_summary_repayments', 'loan_repayments',
+    'id', 'loan_id', 'created_at', 'borrower_id', 'organisation_id', 'payment_amount',
+    'principal_component', 'interest_component', 'balance', 'payment_status',
+    key=PAGE_KEY
+)
+
+# Loans being settled by a payment (Pay.settle_loans, which keys them by id)
+SETTLEMENT_LOANS = ColumnSet(
+    'settlement_loans', 'loans',
+    'id', 'monthly_payment', 'loan_amount', 'interest_rate', 'borrower_id', 'organisation_id'
+)
+
+# A single loan being repaid (Pay.record_repayment); it is looked up by id, so id is not fetched
+REPAYMENT_LOANS = ColumnSet(
+    'repayment_loans', 'loans',
+    'monthly_payment', 'loan_amount', 'interest_rate', 'borrower_id', 'organisation_id'
+)
+
+# Borrowers shown on staff pages, fetched directly or embedded in a loan (borrowers.Borrowers)
+BORROWERS = ColumnSet(
+    'borrowers', 'borrowers',
+    'id', 'first_name', 'last_name', 'nrc_number', 'phone'
+)
+
+COLUMN_SETS = (
+    SCHEDULE_LOANS,
+    PAID_MONTH_REPAYMENTS,
+    REPAYMENT_SUMMARY_LOANS,
+    REPAYMENT_SUMMARY_REPAYMENTS,
+    SETTLEMENT_LOANS,
+    REPAYMENT_LOANS,
+    BORROWERS,
+)
+
+
+def audit_report():
+    """Returns {column set name: unread columns} for every call site that over-fetches."""
+    return {column_set.name: column_set.unread() for column_set in COLUMN_SETS if column_set.unread()}
@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import httpx
+
+import tracing
+from logs import get_logger
+from metrics import observe_upstream, supabase_operation
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+log = get_logger('database')
+
+
+class _CountingTransport(httpx.BaseTransport):
+    """HTTP transport that counts how often a request opened a new connection
+    versus reusing a kept-alive one from the pool, and records each request's
+    latency as an upstream metric (e.g. loans.select) and, while a request is
+    being traced, as a span with its filter shape, row count and size.
+    Requests are sent through the wrapped `transport`."""
+
+    def __init__(self, registry, transport):
+        self._registry = registry
+        self._transport = transport
+
+    def close(self):
+        self._transport.close()
+
+    def handle_request(self, request):
+        opened = []
+        previous_trace = request.extensions.get('trace')
+
+        def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.complete':
+                opened.append(True)
+            if previous_trace is not None:
+                previous_trace(event_name, info)
+
+        request.extensions['trace'] = trace
+        trace = tracing.current()
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self._transport.handle_request(request)
+            if trace is not None:
+                # The client reads the whole body anyway; reading it here puts it inside the span
+                response.read()
+            return response
+        finally:
+            duration = time.perf_counter() - started
+            failed = response is None or response.status_code >= 400
+            operation = supabase_operation(request)
+            observe_upstream(operation, duration, failed)
+            if trace is not None:
+                tracing.record_span(
+                    'supabase', operation, started, duration,
+                    shape=tracing.query_shape(request.url.params),
+                    rows=_row_count(response),
+                    bytes=len(response.content) if response is not None else None,
+                    status=response.status_code if response is not None else 'error'
+                )
+            self._registry._record_request(opened=bool(opened))
+
+
+def _row_count(response):
+    """Rows in a PostgREST response, from its Content-Range header (e.g. '0-24/*' is 25 rows)."""
+    if response is None:
+        return None
+    content_range = response.headers.get('content-range', '')
+    rows = content_range.split('/')[0]
+    if rows == '*':
+        return 0
+    if '-' not in rows:
+        return None
+    first, last = rows.split('-', 1)
+    try:
+        return int(last) - int(first) + 1
+    except ValueError:
+        return None
+
+
+class SupabaseRegistry:
+    """
+    Process-wide registry holding a single Supabase client per worker process.
+
+    All manager classes (Loans, Pay, Organisations, Borrowers, UserAuthentication)
+    share the client returned by get_client(), so a page view reuses warm
+    keep-alive connections instead of building a new client and connection pool.
+    The client is rebuilt automatically after a fork (e.g. gunicorn workers).
+    """
+
+    def __init__(self, pool_size=None, keepalive_expiry=None, transport=None):
+        self.pool_size = int(pool_size or os.getenv('SUPABASE_POOL_SIZE', 10))
+        self.keepalive_expiry = float(keepalive_expiry or os.getenv('SUPABASE_KEEPALIVE_EXPIRY', 60))
+        # httpx transport to send requests through instead of the HTTP/2 pool (e.g. a stub server in tests)
+        self.transport = transport
+
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._client = None
+        self._http_client = None
+        self._pid = None
+
+        self._requests = 0
+        self._connections_opened = 0
+
+    def _record_request(self, opened):
+        with self._stats_lock:
+            self._requests += 1
+            if opened:
+                self._connections_opened += 1
+
+    def _build_client(self):
+        # supabase pulls in gotrue, realtime and storage, so it is only imported once a client is needed
+        from supabase import create_client, ClientOptions
+
+        url = os.getenv("SUPABASE_URL")
+        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+        if not url or not service_role_key:
+            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
+
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry
+        )
+        transport = self.transport or httpx.HTTPTransport(limits=limits, http2=True)
+        http_client = httpx.Client(
+            transport=_CountingTransport(self, transport),
+            timeout=httpx.Timeout(120, connect=10),
+            follow_redirects=True
+        )
+        options = ClientOptions(
+            httpx_client=http_client,
+            auto_refresh_token=False,
+            persist_session=False
+        )
+        return create_client(url, service_role_key, options=options), http_client
+
+    def get_client(self) -> 'Client':
+        """Returns the shared Supabase client for the current process."""
+        pid = os.getpid()
+        if self._client is not None and self._pid == pid:
+            return self._client
+
+        with self._lock:
+            if self._client is None or self._pid != pid:
+                # A client inherited across fork shares sockets with the parent, so never reuse it
+                self._client, self._http_client = self._build_client()
+                self._pid = pid
+                with self._stats_lock:
+                    self._requests = 0
+                    self._connections_opened = 0
+
+        return self._client
+
+    def reset(self):
+        """Closes the pooled connections and drops the client; the next get_client() rebuilds it."""
+        with self._lock:
+            if self._http_client is not None and self._pid == os.getpid():
+                try:
+                    self._http_client.close()
+                except Exception as e:
+                    log.warning("Error closing Supabase connection pool", extra={'error': str(e)})
+            self._client = None
+            self._http_client = None
+            self._pid = None
+
+    def stats(self):
+        """Returns connection reuse counters for the current process."""
+        with self._stats_lock:
+            requests_made = self._requests
+            opened = self._connections_opened
+
+        return {
+            'pool_size': self.pool_size,
+            'requests': requests_made,
+            'connections_opened': opened,
+            'connections_reused': requests_made - opened,
+            'reuse_ratio': round((requests_made - opened) / requests_made, 4) if requests_made else 0.0
+        }
+
+
+registry = SupabaseRegistry()
+
+
+def get_supabase() -> 'Client':
+    """Returns the process-wide shared Supabase client."""
+    return registry.get_client()
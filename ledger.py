@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import BoundedCache
+
+CLAIMED = 'claimed'
+SETTLED = 'settled'
+FAILED = 'failed'
+
+
+class SettlementLedger:
+    """
+    Once-only settlement ledger keyed by TuMeNy payment_id.
+
+    A payment is claimed (an INSERT on the payment_id primary key) before its
+    loans are settled, so a second poll, a refresh or another tab can never
+    settle it again. The final check_payment_status response is stored with the
+    claim and returned to later polls without touching Supabase or the gateway.
+    Cancelled or declined payments are recorded the same way so they are final too.
+
+    The ledger is a local SQLite file shared by every worker on the host
+    (SETTLEMENT_LEDGER_PATH); settled results are also kept in a small
+    in-memory cache per process. It also holds the poll leases that decide
+    which worker's poller checks a pending payment with the gateway.
+    """
+
+    def __init__(self, path=None, claim_timeout=None):
+        self.path = path or os.getenv(
+            'SETTLEMENT_LEDGER_PATH',
+            os.path.join(tempfile.gettempdir(), 'bridgetrust_settlements.db')
+        )
+        self.claim_timeout = float(claim_timeout or os.getenv('SETTLEMENT_CLAIM_TIMEOUT', 120))
+
+        self._settled = BoundedCache(max_bytes=4 * 1024 * 1024, ttl=3600)
+        self._lock = threading.Lock()
+        self._initialised = False
+        self._updated = threading.Condition()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self._initialised:
+            with self._lock:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS settlements ('
+                    ' payment_id TEXT PRIMARY KEY,'
+                    ' status TEXT NOT NULL,'
+                    ' result TEXT,'
+                    ' claimed_at REAL NOT NULL,'
+                    ' settled_at REAL)'
+                )
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS poll_leases ('
+                    ' payment_id TEXT PRIMARY KEY,'
+                    ' owner TEXT NOT NULL,'
+                    ' expires_at REAL NOT NULL)'
+                )
+                self._initialised = True
+        return connection
+
+    @contextmanager
+    def reader(self):
+        """Yields one connection for a run of get() calls, e.g. a status stream re-reading every half second."""
+        connection = self._connect()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get(self, payment_id, connection=None):
+        """
+        Returns the ledger entry for a payment.
+
+        Args:
+            payment_id (str): TuMeNy payment ID.
+            connection (sqlite3.Connection, optional): Open connection from reader() to
+                read through; a connection is opened for this call otherwise.
+
+        Returns:
+            dict | None: {'status': 'claimed' | 'settled' | 'failed', 'result': dict | None,
+                'claimed_at': float} or None if the payment has never been claimed.
+        """
+        cached = self._settled.get(payment_id)
+        if cached is not None:
+            return {'status': cached[0], 'result': cached[1], 'claimed_at': None}
+
+        own_connection = connection is None
+        if own_connection:
+            connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT status, result, claimed_at FROM settlements WHERE payment_id = ?',
+                (payment_id,)
+            ).fetchone()
+        finally:
+            if own_connection:
+                connection.close()
+
+        if row is None:
+            return None
+
+        status, result, claimed_at = row
+        result = json.loads(result) if result else None
+        if result is not None:
+            self._settled.set(payment_id, (status, result))
+        return {'status': status, 'result': result, 'claimed_at': claimed_at}
+
+    def claim(self, payment_id):
+        """Claims a payment for settlement. Returns False if it was already claimed."""
+        connection = self._connect()
+        try:
+            connection.execute(
+                'INSERT INTO settlements (payment_id, status, claimed_at) VALUES (?, ?, ?)',
+                (payment_id, CLAIMED, time.time())
+            )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+        finally:
+            connection.close()
+
+    def complete(self, payment_id, result):
+        """Stores the final settlement result for a claimed payment."""
+        connection = self._connect()
+        try:
+            connection.execute(
+                'UPDATE settlements SET status = ?, result = ?, settled_at = ? WHERE payment_id = ?',
+                (SETTLED, json.dumps(result), time.time(), payment_id)
+            )
+        finally:
+            connection.close()
+        self._settled.set(payment_id, (SETTLED, result))
+        self._notify()
+
+    def record_outcome(self, payment_id, result):
+        """Stores the final result of a payment that will never be settled (e.g. cancelled)."""
+        connection = self._connect()
+        try:
+            connection.execute(
+                'INSERT OR IGNORE INTO settlements (payment_id, status, result, claimed_at, settled_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (payment_id, FAILED, json.dumps(result), time.time(), time.time())
+            )
+        finally:
+            connection.close()
+        self._notify()
+
+    def lease_poll(self, payment_id, owner, ttl):
+        """
+        Claims (or renews) the right to poll the gateway for a payment.
+
+        One owner per payment_id holds the lease at a time. Another owner can take
+        it over only once it has expired, e.g. because the worker holding it died.
+
+        Args:
+            payment_id (str): TuMeNy payment ID.
+            owner (str): ID of the calling poller, unique per worker process.
+            ttl (float): Seconds the lease is held for unless renewed.
+
+        Returns:
+            bool: True if `owner` holds the lease now.
+        """
+        now = time.time()
+        connection = self._connect()
+        try:
+            cursor = connection.execute(
+                'INSERT INTO poll_leases (payment_id, owner, expires_at) VALUES (?, ?, ?)'
+                ' ON CONFLICT (payment_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at'
+                ' WHERE poll_leases.owner = excluded.owner OR poll_leases.expires_at < ?',
+                (payment_id, owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def release_poll(self, payment_id, owner):
+        """Drops owner's poll lease for a payment, once its outcome is final."""
+        connection = self._connect()
+        try:
+            connection.execute('DELETE FROM poll_leases WHERE payment_id = ? AND owner = ?', (payment_id, owner))
+        finally:
+            connection.close()
+
+    def _notify(self):
+        with self._updated:
+            self._updated.notify_all()
+
+    def wait_for_update(self, timeout):
+        """
+        Blocks until this process records an outcome or `timeout` seconds pass.
+
+        Outcomes recorded by other workers are not signalled, so callers should
+        re-read the ledger after every wake-up.
+        """
+        with self._updated:
+            self._updated.wait(timeout)
+
+    def is_stale(self, entry):
+        """True if a claim has been outstanding longer than claim_timeout (e.g. the worker died)."""
+        return (
+            entry['status'] == CLAIMED
+            and entry['claimed_at'] is not None
+            and time.time() - entry['claimed_at'] > self.claim_timeout
+        )
+
+
+settlement_ledger = SettlementLedger()
@@ -3,31 +3,57 @@ import textwrap
 import uuid
 from http.client import responses
 
-import bcrypt
-from dateutil.relativedelta import relativedelta
-from supabase import create_client, Client
+from typing import TYPE_CHECKING
+from batching import fetch_in, gather
+from borrowers import Borrowers
+from cache import schedule_cache
+from columns import (PAID_MONTH_REPAYMENTS, REPAYMENT_SUMMARY_LOANS, REPAYMENT_SUMMARY_REPAYMENTS,
+                     SCHEDULE_LOANS)
+from database import get_supabase
+from logs import get_logger
+from pagination import iter_rows, fetch_all
+from schedule import build_payment_status, MonthIndex
 from flask import session
 import os
 import random
 import string
 import smtplib
 from email.message import EmailMessage
-import pandas as pd
 from datetime import datetime, timedelta
 import os
 
+if TYPE_CHECKING:
+    from supabase import Client
+
+log = get_logger('loans')
+
+
+def month_index_key(organisation_id):
+    """schedule_cache key of an organisation's MonthIndex."""
+    return (organisation_id, 'month_index')
+
+
+def remove_completed_loans(rows):
+    """
+    Removes loans whose remaining_payments reached 0 from their organisation's cached
+    MonthIndex, so the staff breakdown stops listing them without waiting for the TTL.
+
+    Args:
+        rows (list): Updated loan rows with id, remaining_payments and organisation_id.
+    """
+    for row in rows:
+        if row.get('remaining_payments') != 0:
+            continue
+        month_index = schedule_cache.get(month_index_key(row.get('organisation_id')))
+        if month_index is not None:
+            month_index.remove_loan(row['id'])
+
 
 class Loans:
     """contains methods required for the home template"""
 
     def __init__(self):
-        url = os.getenv("SUPABASE_URL")
-        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-        if not url or not service_role_key:
-            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
-
-        self.supabase: Client = create_client(url, service_role_key)
+        self.supabase: Client = get_supabase()
 
         # email authentication
         self.sender_email = os.getenv('SENDER_EMAIL')
@@ -37,35 +63,71 @@ class Loans:
         """
         Returns a dictionary mapping loan_id to set of paid months (YYYY-MM)
         Only includes repayments for the given organisation.
+
+        Query errors propagate, so a failed read is never mistaken for "no repayments"
+        (and cached as such by get_schedule_source).
         """
         from collections import defaultdict
         payments_by_month = defaultdict(set)
 
-        try:
-            response = (
-                self.supabase
-                .table('loan_repayments')
-                .select('*')
-                .eq('payment_status', 'complete')
-                .eq('organisation_id', organisation_id)
-                .execute()
-            )
-            repayments = response.data
+        # Stream the repayment history page by page instead of holding it all at once
+        repayments = PAID_MONTH_REPAYMENTS.track(iter_rows(
+            lambda: PAID_MONTH_REPAYMENTS.query(self.supabase)
+            .eq('payment_status', 'complete')
+            .eq('organisation_id', organisation_id)
+        ))
 
-            for r in repayments:
-                try:
-                    month_paid = datetime.fromisoformat(r['created_at']).strftime("%Y-%m")
-                    payments_by_month[r['loan_id']].add(month_paid)
-                except Exception as e:
-                    print(f"Date parse error for repayment {r}: {e}")
+        for r in repayments:
+            try:
+                month_paid = datetime.fromisoformat(r['created_at']).strftime("%Y-%m")
+                payments_by_month[r['loan_id']].add(month_paid)
+            except Exception as e:
+                log.warning("Date parse error for repayment", extra={'loan_id': r.get('loan_id'), 'error': str(e)})
 
-            return payments_by_month
+        return payments_by_month
 
-        except Exception as e:
-            print(f"Error retrieving repayments: {e}")
-            return defaultdict(set)
+    def get_schedule_source(self, organisation_id):
+        """
+        Returns (loans, payments_by_month) for an organisation, the inputs of the schedule engine.
 
-    def generate_payment_status(self, organisation_id):
+        Results are kept in the per-process schedule cache (see cache.py) so moving between
+        the schedules overview and a month's staff breakdown does not re-download them.
+        The schedule itself is always recomputed since statuses depend on today's date.
+        If either read fails the error is raised and nothing is cached.
+        """
+        cached = schedule_cache.get(organisation_id)
+        if cached is not None:
+            return cached
+
+        # Loans and repayments do not depend on each other, so fetch them concurrently
+        loans, payments_by_month = gather(
+            lambda: SCHEDULE_LOANS.track(fetch_all(
+                lambda: SCHEDULE_LOANS.query(self.supabase)
+                .eq('organisation_id', organisation_id)
+            )),
+            lambda: dict(self.map_payments_by_month(organisation_id))
+        )
+
+        schedule_cache.set(organisation_id, (loans, payments_by_month))
+        return loans, payments_by_month
+
+    def get_month_index(self, organisation_id):
+        """
+        Returns the organisation's MonthIndex (due month -> loans), building it on first use.
+
+        The index only depends on loan start dates and terms, so repayments do not
+        invalidate it; it is cached next to the schedule inputs and expires with the TTL.
+        Loans completed in the meantime are removed in place (see remove_completed_loans).
+        """
+        cache_key = month_index_key(organisation_id)
+        month_index = schedule_cache.get(cache_key)
+        if month_index is None:
+            loans, _ = self.get_schedule_source(organisation_id)
+            month_index = MonthIndex(loans)
+            schedule_cache.set(cache_key, month_index)
+        return month_index
+
+    def generate_payment_status(self, organisation_id, months=None, statuses=None):
         """
         Returns a dict mapping loan_id to {
           'monthly_payment': float,
@@ -73,53 +135,24 @@ class Loans:
           'payment_status_by_month': { month: status }
         }
         Only includes loans belonging to the specified organisation.
+
+        The schedule is computed in bulk by the NumPy engine in schedule.py.
+        Pass `months` (e.g. {'2025-03'}) and/or `statuses` (e.g. {'Upcoming'})
+        to only build the entries the caller needs.
         """
         try:
-            loans_response = (
-                self.supabase
-                .table('loans')
-                .select('*')
-                .eq('organisation_id', organisation_id)
-                .execute()
+            loans, payments_by_month = self.get_schedule_source(organisation_id)
+
+            return build_payment_status(
+                loans,
+                payments_by_month,
+                organisation_id,
+                months=months,
+                statuses=statuses
             )
-            loans = loans_response.data
-
-            payments_by_month = self.map_payments_by_month(organisation_id)
-            today = datetime.today()
-            result = {}
-
-            for loan in loans:
-                loan_id = loan['id']
-                created_at = datetime.fromisoformat(loan['created_at'])
-                start_date = created_at + relativedelta(months=1)  # repayments start 1 month after creation
-                months = loan['term_months']
-
-                loan_status = {}
-
-                for i in range(months):
-                    due_date = start_date + relativedelta(months=i)
-                    month_key = due_date.strftime("%Y-%m")
-
-                    if due_date > today:
-                        status = "Upcoming"
-                    elif month_key in payments_by_month.get(loan_id, set()):
-                        status = "Paid"
-                    else:
-                        status = "Missed"
-
-                    loan_status[month_key] = status
-
-                result[loan_id] = {
-                    "monthly_payment": loan.get("monthly_payment"),
-                    "borrower_id": loan.get("borrower_id"),
-                    "organisation_id": organisation_id,
-                    "payment_status_by_month": loan_status
-                }
-
-            return result
 
         except Exception as e:
-            print(f"Error generating payment status: {e}")
+            log.error("Error generating payment status", extra={'error': str(e)})
             return {}
 
     def get_monthly_payment_schedules_for_template(self, organisation_id):
@@ -150,8 +183,8 @@ class Loans:
             }
         """
         try:
-            # Get the raw payment status data
-            payment_data = self.generate_payment_status(organisation_id)
+            # Get the raw payment status data (only upcoming months are displayed)
+            payment_data = self.generate_payment_status(organisation_id, statuses={'Upcoming'})
 
             if not payment_data:
                 return {
@@ -182,7 +215,7 @@ class Loans:
                         try:
                             monthly_payment = float(monthly_payment_raw) if monthly_payment_raw is not None else 0.0
                         except (ValueError, TypeError):
-                            print(f"Warning: Invalid monthly_payment value for loan {loan_id}: {monthly_payment_raw}")
+                            log.warning("Invalid monthly_payment value", extra={'loan_id': loan_id, 'monthly_payment': monthly_payment_raw})
                             monthly_payment = 0.0
 
                         months_with_payments[month]['total_amount'] += monthly_payment
@@ -208,7 +241,7 @@ class Loans:
             }
 
         except Exception as e:
-            print(f"Error generating monthly payment schedules for template: {e}")
+            log.error("Error generating monthly payment schedules for template", extra={'error': str(e)})
             return {
                 'months_with_payments': [],
                 'has_upcoming_payments': False,
@@ -233,14 +266,15 @@ class Loans:
             ]
             return f"{month_names[int(month_num)]} {year}"
         except (ValueError, IndexError) as e:
-            print(f"Error formatting month display for {month_key}: {e}")
+            log.warning("Error formatting month display", extra={'month': month_key, 'error': str(e)})
             return month_key  # fallback to original format
 
     def get_monthly_loan_repayments(self, organisation_id):
         """Returns monthly loan repayments for all loans belonging to a specific organisation"""
         try:
-            loans_response = self.supabase.table('loans').select("*").eq('organisation_id', organisation_id).execute()
-            loans = loans_response.data
+            loans = REPAYMENT_SUMMARY_LOANS.track(fetch_all(
+                lambda: REPAYMENT_SUMMARY_LOANS.query(self.supabase).eq('organisation_id', organisation_id)
+            ))
 
             if not loans:
                 return {}
@@ -250,12 +284,13 @@ class Loans:
 
             loan_ids = list(loan_map.keys())
 
-            repayments_response = self.supabase.table('loan_repayments') \
-                .select("*") \
-                .in_('loan_id', loan_ids) \
-                .execute()
-
-            repayments = repayments_response.data
+            # Chunked so thousands of loan IDs stay within URL limits; chunks run concurrently
+            repayments = REPAYMENT_SUMMARY_REPAYMENTS.track(fetch_in(
+                lambda: REPAYMENT_SUMMARY_REPAYMENTS.query(self.supabase),
+                'loan_id',
+                loan_ids,
+                paged=True
+            ))
 
             from collections import defaultdict
             from datetime import datetime
@@ -286,7 +321,7 @@ class Loans:
             return dict(monthly_summary)
 
         except Exception as e:
-            print(f"Error generating payment status: {e}")
+            log.error("Error generating monthly loan repayments", extra={'error': str(e)})
             return {}
 
     def get_borrower_payment_details_for_month(self, organisation_id, month):
@@ -310,25 +345,21 @@ class Loans:
             Empty list if no borrowers found.
         """
         try:
-            # Step 1: Get payment status data for the organisation
-            payment_data = self.generate_payment_status(organisation_id)
+            # Step 1: Look up the loans with a repayment due this month
+            month_index = self.get_month_index(organisation_id)
+            upcoming_loans = month_index.upcoming_loans(month)
 
-            if not payment_data:
-                return []
-
-            # Step 2: Find all loan IDs that have upcoming payments for the specified month
+            # Step 2: Collect the loan IDs that have upcoming payments for the specified month
             loan_ids_for_month = []
             loan_payment_info = {}
 
-            for loan_id, loan_info in payment_data.items():
-                month_status = loan_info.get('payment_status_by_month', {}).get(month)
-                if month_status == "Upcoming":
-                    loan_ids_for_month.append(loan_id)
-                    loan_payment_info[loan_id] = {
-                        'monthly_payment': loan_info.get('monthly_payment'),
-                        'borrower_id': loan_info.get('borrower_id'),
-                        'status': month_status
-                    }
+            for loan_id, loan_info in upcoming_loans.items():
+                loan_ids_for_month.append(loan_id)
+                loan_payment_info[loan_id] = {
+                    'monthly_payment': loan_info.get('monthly_payment'),
+                    'borrower_id': loan_info.get('borrower_id'),
+                    'status': "Upcoming"
+                }
 
             if not loan_ids_for_month:
                 return []
@@ -343,20 +374,10 @@ class Loans:
             if not borrower_ids:
                 return []
 
-            # Step 4: Query borrowers table for all borrower IDs
-            borrowers_response = (
-                self.supabase
-                .table('borrowers')
-                .select('id, first_name, last_name, nrc_number, phone')
-                .in_('id', borrower_ids)
-                .execute()
-            )
-            borrowers_data = borrowers_response.data
+            # Step 4: Look up the borrowers in bulk (cached, see borrowers.get_borrowers)
+            borrowers_lookup = Borrowers().get_borrowers(borrower_ids)
 
-            # Step 5: Create a lookup dictionary for borrower data
-            borrowers_lookup = {borrower['id']: borrower for borrower in borrowers_data}
-
-            # Step 6: Build the result list
+            # Step 5: Build the result list
             result = []
             for loan_id in loan_ids_for_month:
                 loan_info = loan_payment_info[loan_id]
@@ -378,7 +399,7 @@ class Loans:
             return result
 
         except Exception as e:
-            print(f"Error fetching borrower payment details for month {month}: {e}")
+            log.error("Error fetching borrower payment details for month", extra={'month': month, 'error': str(e)})
             return []
 
     def get_borrower_payment_details(self, loans, loan_id):
@@ -403,16 +424,8 @@ class Loans:
             if not borrower_id:
                 return None
 
-            # Step 2: Query borrowers table for this borrower_id
-            borrower_response = (
-                self.supabase
-                .table('borrowers')
-                .select('id, first_name, last_name, nrc_number, phone_number')
-                .eq('id', borrower_id)
-                .limit(1)
-                .execute()
-            )
-            borrower_data = borrower_response.data[0] if borrower_response.data else None
+            # Step 2: Look up the borrower (cached, see borrowers.get_borrowers)
+            borrower_data = Borrowers().get_borrowers([borrower_id]).get(borrower_id)
 
             if not borrower_data:
                 return None
@@ -429,10 +442,5 @@ class Loans:
             }
 
         except Exception as e:
-            print(f"Error fetching borrower payment details: {e}")
+            log.error("Error fetching borrower payment details", extra={'loan_id': loan_id, 'error': str(e)})
             return None
-
-
-# Example usage and testing
-#test = Loans()
-#print(json.dumps(test.get_monthly_payment_schedules_for_template('ee8278fc-66e6-4a0f-a6bb-3525657f98b8')))
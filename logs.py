@@ -0,0 +1,180 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Fraction of debug-level gateway dumps (full requests and responses) that are kept
+GATEWAY_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_GATEWAY_DEBUG_SAMPLE_RATE', 0.01))
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+payment_id_var = contextvars.ContextVar('payment_id', default=None)
+
+REDACTED = '[REDACTED]'
+SECRET_KEYS = {
+    'authorization', 'cookie', 'set-cookie', 'token', 'access_token', 'refresh_token',
+    'apikey', 'api_key', 'apisecret', 'api_secret', 'secret', 'password', 'email_password',
+    # Personal data, e.g. in the TuMeNy payment request payload
+    'phone', 'phonenumber', 'phone_number', 'email',
+}
+_BEARER = re.compile(r'(Bearer\s+)[^\s\'",}]+', re.IGNORECASE)
+# Secret fields inside serialised JSON, e.g. a raw gateway response body
+_SECRET_FIELD = re.compile(
+    r'("(?:' + '|'.join(re.escape(key) for key in SECRET_KEYS) + r')"\s*:\s*")[^"]*',
+    re.IGNORECASE
+)
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+def bind_request_id(request_id):
+    """Tags every record logged from the current request with request_id (and clears payment_id)."""
+    request_id_var.set(request_id)
+    payment_id_var.set(None)
+
+
+def bind_payment_id(payment_id):
+    """Tags every later record logged from the current request with payment_id."""
+    payment_id_var.set(payment_id)
+
+
+def redact(value):
+    """Returns value with secret fields and bearer tokens replaced, recursing into dicts and lists."""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if str(key).lower() in SECRET_KEYS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        return _SECRET_FIELD.sub(r'\1' + REDACTED, _BEARER.sub(r'\1' + REDACTED, value))
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request/payment IDs and extra fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': redact(record.getMessage()),
+            'request_id': getattr(record, 'request_id', None),
+            'payment_id': getattr(record, 'payment_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = redact(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a `rate` fraction of DEBUG records from loggers under `name`; everything else passes."""
+
+    def __init__(self, name, rate):
+        super().__init__(name)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or not super().filter(record):
+            return True
+        return random.random() < self.rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a background listener thread instead of writing them.
+
+    The request thread only stamps the record with the current request and
+    payment IDs; formatting, redaction and I/O happen on the listener. When the
+    queue is full records are dropped (and counted) rather than blocking. The
+    queue and listener are recreated after fork, so this is safe with gunicorn --preload.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+        self.stream = stream or sys.stdout
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # Whatever the parent left in the queue belongs to the parent
+            self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            output = logging.StreamHandler(self.stream)
+            output.setFormatter(JsonFormatter())
+            self._listener = logging.handlers.QueueListener(self.queue, output)
+            self._listener.start()
+            self._pid = pid
+
+    def prepare(self, record):
+        record.request_id = getattr(record, 'request_id', None) or request_id_var.get()
+        record.payment_id = getattr(record, 'payment_id', None) or payment_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        """Flushes queued records (used at exit)."""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+_handler = None
+_configure_lock = threading.Lock()
+
+
+def configure_logging(level=None, stream=None):
+    """Routes the app's 'bridgetrust' loggers through the queue-backed JSON handler (idempotent)."""
+    global _handler
+    with _configure_lock:
+        if _handler is not None:
+            return _handler
+
+        _handler = _QueueHandler(stream=stream)
+        root = logging.getLogger('bridgetrust')
+        root.setLevel(level or LOG_LEVEL)
+        root.addHandler(_handler)
+        root.propagate = False
+
+        # Runs before the record is queued, so dropped dumps cost the request thread nothing further
+        _handler.addFilter(SamplingFilter('bridgetrust.gateway', GATEWAY_DEBUG_SAMPLE_RATE))
+        atexit.register(_handler.stop)
+        return _handler
+
+
+def get_logger(name):
+    """Returns the 'bridgetrust.<name>' logger, configuring the pipeline on first use."""
+    configure_logging()
+    return logging.getLogger(f'bridgetrust.{name}')
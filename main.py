@@ -1,15 +1,14 @@
 import time
 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import Blueprint, Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, stream_with_context, g, current_app
 from dotenv import load_dotenv
 from flask_wtf.csrf import CSRFProtect, generate_csrf
 
+import logging
 import os
+import json
 from datetime import datetime
-import traceback
-import secrets
-import io
-import pandas as pd
+import uuid
 
 # Load environment variables
 load_dotenv()
@@ -17,27 +16,111 @@ load_dotenv()
 # modules
 from auth import UserAuthentication
 from loans import Loans
-from organisation import Organisations
-from pay import Pay
+from organisation import Organisations, warm_organisation_cache
+from pay import AsyncPay
+from ledger import settlement_ledger
+from logs import bind_payment_id, bind_request_id, get_logger, request_id_var
+from metrics import instrument_view, render as render_metrics
+from poller import payment_poller
+from settlement import resolve_payment, resolve_payment_async, stored_payment_result
+from tracing import current as current_trace, finish_trace, log_waterfall, start_trace
 
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY') or 'fallback-secret-key-for-development'
-csrf = CSRFProtect(app)
+csrf = CSRFProtect()
+log = get_logger('web')
+
+# Views below are declared on this blueprint; create_app() registers it on each app it builds
+web = Blueprint('web', __name__)
+
+# Send X-Debug-Trace: 1 to get a Server-Timing header and a logged waterfall of the request's upstream calls
+TRACE_DEBUG_HEADER = os.getenv('TRACE_DEBUG_HEADER', '0') not in ('0', 'false', 'False')
+
+
+def max_queries(budget):
+    """Sets the most Supabase queries a view may make, whatever the organisation's size (see tracing.query_budget)."""
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+def create_app():
+    """
+    Builds the Flask app.
+
+    Safe with gunicorn --preload: nothing here opens a connection or starts a
+    thread. The Supabase client, TuMeNy sessions, the gateway event loop, the
+    payment poller and cache warm-up are all created lazily in each worker
+    process on first use.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY') or 'fallback-secret-key-for-development'
+    csrf.init_app(app)
+
+    app.context_processor(inject_csrf_token)
+    app.before_request(bind_request_context)
+    app.before_request(warm_caches)
+    app.after_request(echo_request_id)
+    app.after_request(add_server_timing)
+    app.teardown_request(finish_request_trace)
+
+    app.register_blueprint(web)
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint.startswith(f'{web.name}.'):
+            app.view_functions[rule.endpoint] = instrument_view(rule.rule, app.view_functions[rule.endpoint])
+
+    return app
 
 
 # Make CSRF token available in all templates
-@app.context_processor
 def inject_csrf_token():
     return dict(csrf_token=generate_csrf())
 
 
-@app.route('/', methods=['POST', 'GET'])
+def bind_request_context():
+    # Every log record from this request carries its ID (taken from the proxy when it sets one)
+    bind_request_id(request.headers.get('X-Request-ID') or uuid.uuid4().hex)
+    start_trace(f'{request.method} {request.path}')
+    g.debug_trace = (TRACE_DEBUG_HEADER or current_app.debug) and request.headers.get('X-Debug-Trace') == '1'
+
+
+def echo_request_id(response):
+    response.headers['X-Request-ID'] = request_id_var.get()
+    return response
+
+
+def add_server_timing(response):
+    trace = current_trace()
+    if g.get('debug_trace') and trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+
+def finish_request_trace(error=None):
+    trace = finish_trace()
+    if trace is None:
+        return
+
+    if g.get('debug_trace'):
+        log_waterfall(trace)
+
+    # A route over its budget usually means a per-row query crept in; log where the calls went
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    if budget is not None and len(trace.calls('supabase')) > budget:
+        log_waterfall(trace, f'Query budget of {budget} exceeded', logging.WARNING)
+
+
+def warm_caches():
+    # First request in each worker loads organisation metadata in the background
+    warm_organisation_cache()
+
+
+@web.route('/', methods=['POST', 'GET'])
 def index():
     auth_manager = UserAuthentication()
 
     if request.method == 'POST':
         phone = request.form.get('phone')
-        print(phone)
 
         # Verify number in database
         phone_status, organisation_id = auth_manager.check_organisation_number(phone)
@@ -48,26 +131,26 @@ def index():
             session['phone'] = phone
             session['organisation_id'] = organisation_id  # Store organisation_id in session
             flash('Welcome back!')
-            return redirect(url_for('home'))
+            return redirect(url_for('web.home'))
 
     return render_template('index.html')
 
 
-@app.route('/otp_verification', methods=['GET', 'POST'])
+@web.route('/otp_verification', methods=['GET', 'POST'])
 def otp_verification():
     auth_manager = UserAuthentication()
     phone = session.get('phone')
 
     if not phone:
         flash('Session expired or invalid access')
-        return redirect(url_for('index'))
+        return redirect(url_for('web.index'))
 
     if request.method == 'POST':
         otp = request.form.get('otp')
 
         if not otp:
             flash('Please enter the OTP')
-            return redirect(url_for('home'))
+            return redirect(url_for('web.home'))
 
         verification = auth_manager.verify_otp(phone, otp)
 
@@ -77,12 +160,12 @@ def otp_verification():
             flash('OTP verification failed, but continuing...')
 
         session.pop('phone', None)
-        return redirect(url_for('home'))
+        return redirect(url_for('web.home'))
 
     return render_template('index.html', phone=phone)
 
 
-@app.route('/home')
+@web.route('/home')
 def home():
     organisation_id = session['organisation_id']
     organisation_manager = Organisations()
@@ -91,7 +174,7 @@ def home():
     return render_template('home.html', organisation_name = organisation_name)
 
 
-@app.route('/monthly_payment_schedules')
+@web.route('/monthly_payment_schedules')
 def monthly_payment_schedules():
     loans_manager = Loans()
     organisation_id = session['organisation_id']
@@ -101,7 +184,8 @@ def monthly_payment_schedules():
     return render_template('monthly_payment_schedules.html', schedule_data=schedule_data)
 
 
-@app.route('/staff_breakdown/<month>')
+@web.route('/staff_breakdown/<month>')
+@max_queries(3)
 def monthly_payment_details(month):
     loans_manager = Loans()
     organisation_id = session['organisation_id']
@@ -118,7 +202,7 @@ def monthly_payment_details(month):
                            month_display=month_display)
 
 
-@app.route('/repayment_summary', methods=['GET'])
+@web.route('/repayment_summary', methods=['GET'])
 def repayment_summary():
     total = request.args.get('total', '0.00')
     loan_ids_string = request.args.get('loan_ids', '')
@@ -134,9 +218,7 @@ def repayment_summary():
     # Save to session
     session['checkout_month'] = month
 
-    print(f"Total: {total}")
-    print(f"Loan IDs: {loan_ids}")
-    print(f"Month: {month}")
+    log.debug("Repayment summary", extra={'total': total, 'loan_ids': loan_ids, 'month': month})
 
     return render_template('repayment_summary.html',
                            total=total,
@@ -144,7 +226,7 @@ def repayment_summary():
                            month=month)
 
 
-@app.route('/checkout', methods=['POST', 'GET'])
+@web.route('/checkout', methods=['POST', 'GET'])
 def checkout():
     if request.method == 'POST':
         # This is when coming FROM repayment_summary.html
@@ -187,18 +269,18 @@ def checkout():
         else:
             # No checkout data available, redirect to home
             flash('No payment data available. Please select loans to pay for.', 'error')
-            return redirect(url_for('home'))
+            return redirect(url_for('web.home'))
 
 
-@app.route('/pay', methods=['POST', 'GET'])
-def pay():
+@web.route('/pay', methods=['POST', 'GET'])
+async def pay():
     if request.method == 'POST':
         try:
             # Check if user is logged in
             organisation_id = session.get('organisation_id')
             if not organisation_id:
                 flash('Session expired. Please login again.', 'error')
-                return redirect(url_for('index'))
+                return redirect(url_for('web.index'))
 
             # Get checkout data that was passed as hidden fields
             total_amount_str = request.form.get('total_amount', '0')
@@ -210,13 +292,12 @@ def pay():
             mobile_number = request.form.get('mobile_number', '').strip()
             email = request.form.get('email', '').strip()
 
-            print(f"Debug - Received payment data:")
-            print(f"  Total Amount: {total_amount_str}")
-            print(f"  Transaction Fees: {transaction_fees_str}")
-            print(f"  Loan IDs: {loan_ids_str}")
-            print(f"  Month: {month}")
-            print(f"  Mobile: {mobile_number}")
-            print(f"  Email: {email}")
+            log.debug("Received payment data", extra={
+                'total_amount': total_amount_str,
+                'transaction_fees': transaction_fees_str,
+                'loan_ids': loan_ids_str,
+                'month': month
+            })
 
             # Server-side validation
             validation_errors = []
@@ -280,21 +361,18 @@ def pay():
             # Convert loan_ids back to list
             loan_ids = [id.strip() for id in loan_ids_str.split(',') if id.strip()]
 
-            print(f"Debug - Processing {len(loan_ids)} loans: {loan_ids}")
-
-            pay_manager = Pay()
+            pay_manager = AsyncPay()
 
             # Create description with all loan IDs
             loan_ids_display = ", ".join(loan_ids)
 
-            print(f"Debug - Initiating payment:")
-            print(f"  Mobile: {mobile_number}")
-            print(f"  Amount: {total_amount_ngwee} ngwee")
-            print(f"  Description: Loan repayment for {month}")
+            log.info("Initiating payment", extra={
+                'loan_ids': loan_ids, 'amount': total_amount_ngwee, 'month': month
+            })
 
             try:
                 # Make ONE payment for the total amount of ALL loans
-                payment_response = pay_manager.initiate_payment(
+                payment_response = await pay_manager.initiate_payment(
                     number=mobile_number,
                     total_amount=total_amount_ngwee,
                     transaction_fees=transaction_fees_ngwee,
@@ -304,11 +382,9 @@ def pay():
                     organisation_email=organisation_email or email or "noreply@example.com"
                 )
 
-                print(f"Debug - Payment response: {payment_response}")
-
                 # Check if payment initiation was successful
                 if 'error' in payment_response:
-                    print(f"Payment initiation error: {payment_response['error']}")
+                    log.warning("Payment initiation error", extra={'error': payment_response['error']})
                     # Keep checkout data in session so user can retry
                     session['checkout_data'] = {
                         'total_amount': total_amount_str,
@@ -317,14 +393,14 @@ def pay():
                         'month': month
                     }
                     flash(f"Payment initiation failed: {payment_response.get('message', 'Unknown error')}", 'error')
-                    return redirect(url_for('checkout'))
+                    return redirect(url_for('web.checkout'))
 
                 # Extract payment ID correctly
                 payment_data = payment_response.get('payment', {})
                 payment_id = payment_data.get('id')
 
                 if not payment_id:
-                    print("No payment ID in response")
+                    log.error("No payment ID in response")
                     session['checkout_data'] = {
                         'total_amount': total_amount_str,
                         'transaction_fees': transaction_fees_str,
@@ -332,13 +408,17 @@ def pay():
                         'month': month
                     }
                     flash('No payment ID received from gateway. Please try again.', 'error')
-                    return redirect(url_for('checkout'))
+                    return redirect(url_for('web.checkout'))
 
-                print(f"Debug - Payment initiated with ID: {payment_id}")
+                bind_payment_id(payment_id)
+                log.info("Payment initiated")
 
                 # Clear checkout data from session since payment was successfully initiated
                 session.pop('checkout_data', None)
 
+                if payment_poller.enabled:
+                    payment_poller.track(payment_id, loan_ids, total_amount_str)
+
                 # Render loading page and then check status via JavaScript
                 return render_template('payment_processing.html',
                                        payment_id=payment_id,
@@ -346,7 +426,7 @@ def pay():
                                        total_amount=total_amount_str)
 
             except Exception as e:
-                print(f"Payment initiation exception: {e}")
+                log.exception("Payment initiation exception")
                 # Keep checkout data in session so user can retry
                 session['checkout_data'] = {
                     'total_amount': total_amount_str,
@@ -355,97 +435,44 @@ def pay():
                     'month': month
                 }
                 flash(f'Payment processing error: {str(e)}', 'error')
-                return redirect(url_for('checkout'))
+                return redirect(url_for('web.checkout'))
 
         except Exception as e:
-            print(f"Payment processing error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Payment processing error")
             flash('An error occurred during payment processing', 'error')
-            return redirect(url_for('checkout'))
+            return redirect(url_for('web.checkout'))
 
     else:
         # GET request - redirect to checkout
-        return redirect(url_for('checkout'))
+        return redirect(url_for('web.checkout'))
 
 
-@app.route('/check_payment_status/<payment_id>', methods=['GET'])
-def check_payment_status(payment_id):
+@web.route('/check_payment_status/<payment_id>', methods=['GET'])
+@max_queries(5)  # the same for one loan as for many, see tests/test_query_budgets.py
+async def check_payment_status(payment_id):
     """AJAX endpoint to check payment status"""
+    bind_payment_id(payment_id)
     try:
         loan_ids_str = request.args.get('loan_ids', '')
         total_amount_str = request.args.get('total_amount', '0')
+        loan_ids = [id.strip() for id in loan_ids_str.split(',') if id.strip()]
 
-        pay_manager = Pay()
-        payment_status_result = pay_manager.check_payment_status(payment_id)
-
-        # Handle the new structured response
-        if payment_status_result["status"] == "success":
-            # Process loan repayments (existing logic)
-            loan_ids = [id.strip() for id in loan_ids_str.split(',') if id.strip()]
-            successful_loans = []
-            failed_loans = []
-
-            for loan_id in loan_ids:
-                try:
-                    repayment_response = pay_manager.record_repayment(loan_id)
-
-                    if repayment_response.get('success'):
-                        updated_payments_left, loans_data = pay_manager.reduce_remaining_payments(loan_id)
-
-                        if updated_payments_left:
-                            successful_loans.append({
-                                'loan_id': loan_id,
-                                'payment_id': payment_id
-                            })
-                        else:
-                            failed_loans.append({
-                                'loan_id': loan_id,
-                                'error': 'Failed to update remaining payments'
-                            })
-                    else:
-                        failed_loans.append({
-                            'loan_id': loan_id,
-                            'error': repayment_response.get('error', 'Failed to record repayment')
-                        })
-
-                except Exception as e:
-                    failed_loans.append({
-                        'loan_id': loan_id,
-                        'error': str(e)
-                    })
-
-            return jsonify({
-                'status': 'success',
-                'successful_loans': successful_loans,
-                'failed_loans': failed_loans,
-                'payment_id': payment_id,
-                'total_amount': total_amount_str
-            })
-
-        elif payment_status_result["status"] == "failed":
-            # Payment was cancelled or failed - stop polling
-            return jsonify({
-                'status': 'failed',
-                'reason': payment_status_result.get('reason', 'unknown'),
-                'message': f'Payment was {payment_status_result.get("reason", "cancelled")}'
-            })
-
-        elif payment_status_result["status"] == "error":
-            # API error - stop polling
-            return jsonify({
-                'status': 'error',
-                'reason': payment_status_result.get('reason', 'unknown'),
-                'message': 'Error checking payment status'
-            })
+        # Settled, failed or in-progress payments are answered from the settlement ledger
+        result = stored_payment_result(payment_id)
+        if result is not None:
+            return jsonify(result)
 
-        else:
-            # Still pending
+        if payment_poller.enabled:
+            # The background poller checks the gateway; this worker may not have seen /pay yet
+            payment_poller.track(payment_id, loan_ids, total_amount_str)
             return jsonify({
                 'status': 'pending'
             })
 
+        return jsonify(await resolve_payment_async(payment_id, loan_ids, total_amount_str))
+
     except Exception as e:
+        log.exception("Payment status check failed")
         return jsonify({
             'status': 'error',
             'error': str(e)
@@ -453,7 +480,79 @@ def check_payment_status(payment_id):
 
 
 
-@app.route('/payment_result')
+# Longest a status stream stays open before the browser reconnects. Under gunicorn's default sync
+# workers every open stream occupies a whole worker for this long, so keep it short there, or run
+# with --threads N (gthread) or a gevent worker class to hold more streams per worker.
+PAYMENT_STREAM_MAX_HOLD = float(os.getenv('PAYMENT_STREAM_MAX_HOLD', 10))
+PAYMENT_STREAM_HEARTBEAT = 5
+
+
+@web.route('/payment_status_stream/<payment_id>', methods=['GET'])
+def payment_status_stream(payment_id):
+    """
+    Server-Sent Events endpoint that pushes the payment status as soon as it is final.
+
+    Emits one `status` event with the same JSON as /check_payment_status once the
+    payment is success, failed or error. If nothing happens within
+    PAYMENT_STREAM_MAX_HOLD seconds it emits a pending status and closes, and the
+    browser's EventSource reconnects. The ledger is re-read through one connection
+    for the whole stream.
+    """
+    bind_payment_id(payment_id)
+    loan_ids_str = request.args.get('loan_ids', '')
+    total_amount_str = request.args.get('total_amount', '0')
+    loan_ids = [id.strip() for id in loan_ids_str.split(',') if id.strip()]
+
+    if payment_poller.enabled:
+        payment_poller.track(payment_id, loan_ids, total_amount_str)
+
+    def status_events():
+        started = time.monotonic()
+        last_heartbeat = started
+        last_gateway_check = None
+
+        yield 'retry: 1000\n\n'
+
+        with settlement_ledger.reader() as connection:
+            while True:
+                try:
+                    result = stored_payment_result(payment_id, connection=connection)
+                    if result is None and not payment_poller.enabled:
+                        now = time.monotonic()
+                        if last_gateway_check is None or now - last_gateway_check >= 5:
+                            last_gateway_check = now
+                            result = resolve_payment(payment_id, loan_ids, total_amount_str)
+                except Exception as e:
+                    log.exception("Payment status stream check failed")
+                    result = {'status': 'error', 'error': str(e)}
+
+                now = time.monotonic()
+                if result is not None and result['status'] != 'pending':
+                    yield f"event: status\ndata: {json.dumps(result)}\n\n"
+                    return
+
+                if now - started >= PAYMENT_STREAM_MAX_HOLD:
+                    yield f"event: status\ndata: {json.dumps({'status': 'pending'})}\n\n"
+                    return
+
+                if now - last_heartbeat >= PAYMENT_STREAM_HEARTBEAT:
+                    last_heartbeat = now
+                    yield ': keepalive\n\n'
+
+                # Wakes immediately when this worker records an outcome; other workers are seen on the next read
+                settlement_ledger.wait_for_update(timeout=0.5)
+
+    return Response(
+        stream_with_context(status_events()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+@web.route('/payment_result')
 def payment_result():
     """Render final payment result page"""
     status = request.args.get('status', 'failed')
@@ -464,7 +563,6 @@ def payment_result():
     error = request.args.get('error', '')
 
     try:
-        import json
         successful_loans = json.loads(successful_loans) if successful_loans != '[]' else []
         failed_loans = json.loads(failed_loans) if failed_loans != '[]' else []
     except:
@@ -494,8 +592,13 @@ def payment_result():
                                total_amount=total_amount)
 
 
+@web.route('/metrics')
+def metrics():
+    """Route and upstream latency histograms in the Prometheus text format, summed over all workers."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
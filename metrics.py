@@ -0,0 +1,378 @@
+import atexit
+import bisect
+import functools
+import glob
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import tracing
+from logs import get_logger
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX platforms keep every worker's file instead of archiving them
+    fcntl = None
+
+log = get_logger('metrics')
+
+# Shared directory for multi-worker setups (gunicorn): each worker writes its own file there
+# and /metrics in any worker sums them. Unset, /metrics reports the current process only.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+# Totals of workers that have exited, folded together so METRICS_DIR does not grow with every restart
+ARCHIVE_FILE = 'archive.json'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """A labelled latency histogram, with an error counter per label set."""
+
+    def __init__(self, name, documentation, label_names, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labels, seconds, error=False):
+        """Records one observation; labels is a tuple in label_names order."""
+        store.observe(self, labels, seconds, error)
+
+
+REQUEST_DURATION = Histogram(
+    'bridgetrust_http_request_duration_seconds',
+    'Time spent in Flask views, by route and method.',
+    ('route', 'method')
+)
+UPSTREAM_DURATION = Histogram(
+    'bridgetrust_upstream_duration_seconds',
+    'Time spent in outbound calls (Supabase, TuMeNy, Twilio), by operation.',
+    ('operation',)
+)
+HISTOGRAMS = (REQUEST_DURATION, UPSTREAM_DURATION)
+
+
+class MetricsStore:
+    """
+    Per-process metric values, optionally shared between workers through METRICS_DIR.
+
+    Observations only touch in-memory counters under a lock. A background thread
+    writes this process's values to METRICS_DIR/<pid>-<token>.json every
+    METRICS_FLUSH_INTERVAL seconds (atomically, like the TuMeNy token cache), and
+    collect() sums the files of every worker. The token is random per process, so
+    a worker that gets a recycled pid never overwrites an earlier worker's file.
+    Each new worker folds the files of workers that have exited into ARCHIVE_FILE,
+    so counters never go backwards after a restart and the directory stays small.
+    Values inherited across fork are discarded in the child.
+    """
+
+    def __init__(self, directory=None, flush_interval=None):
+        self.directory = directory if directory is not None else METRICS_DIR
+        self.flush_interval = float(flush_interval or METRICS_FLUSH_INTERVAL)
+
+        self._lock = threading.Lock()
+        self._values = {}  # (metric name, labels) -> [bucket counts..., +Inf count, sum, errors]
+        self._pid = None
+        self._token = None
+        self._dirty = False
+
+    def _reset_after_fork(self, pid):
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._lock = threading.Lock()
+            self._values = {}
+            self._pid = pid
+            self._token = uuid.uuid4().hex
+            self._dirty = False
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._archive_exited_workers()
+            threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def observe(self, histogram, labels, seconds, error=False):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._reset_after_fork(pid)
+
+        index = bisect.bisect_left(histogram.buckets, seconds)
+        key = (histogram.name, labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(histogram.buckets) + 1) + [0.0, 0]
+            values[index] += 1
+            values[-2] += seconds
+            if error:
+                values[-1] += 1
+            self._dirty = True
+
+    def _snapshot(self):
+        with self._lock:
+            return {key: list(values) for key, values in self._values.items()}
+
+    def _path(self):
+        return os.path.join(self.directory, f'{self._pid}-{self._token}.json')
+
+    @contextmanager
+    def _locked(self, operation):
+        """Holds an flock on METRICS_DIR/.lock (LOCK_EX to archive files, LOCK_SH to read them)."""
+        lock_file = None
+        if fcntl is not None:
+            try:
+                lock_file = open(os.path.join(self.directory, '.lock'), 'w')
+                fcntl.flock(lock_file, operation)
+            except OSError as e:
+                log.warning("Could not lock metrics directory", extra={'error': str(e)})
+                lock_file = None
+        try:
+            yield
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _exited(self, path):
+        """True if the worker that wrote path (METRICS_DIR/<pid>-<token>.json) is no longer running."""
+        try:
+            pid = int(os.path.basename(path)[:-len('.json')].split('-')[0])
+        except ValueError:
+            return False  # the archive itself
+        if pid == self._pid:
+            # Our pid, but an earlier process's token: that process is gone
+            return path != self._path()
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+
+    def _archive_exited_workers(self):
+        """Folds the files of workers that have exited into ARCHIVE_FILE and deletes them."""
+        if fcntl is None:
+            return
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+        with self._locked(fcntl.LOCK_EX):
+            exited = [path for path in glob.glob(os.path.join(self.directory, '*.json')) if self._exited(path)]
+            if not exited:
+                return
+            totals = {}
+            for path in [archive_path] + exited:
+                _merge(totals, _read_rows(path))
+            try:
+                _write_rows(self.directory, archive_path, totals)
+                for path in exited:
+                    os.remove(path)
+            except OSError as e:
+                log.warning("Could not archive metrics of exited workers", extra={'error': str(e)})
+
+    def flush(self):
+        """Writes this process's values to METRICS_DIR (no-op without one)."""
+        if not self.directory or self._pid != os.getpid() or not self._dirty:
+            return
+        self._dirty = False
+        try:
+            _write_rows(self.directory, self._path(), self._snapshot())
+        except OSError as e:
+            self._dirty = True
+            log.warning("Could not write metrics file", extra={'error': str(e)})
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def collect(self):
+        """Returns {(metric name, labels): values} summed over every worker."""
+        if not self.directory:
+            return self._snapshot()
+
+        self.flush()
+        merged = {}
+        # Shared lock: a worker archiving files never makes them count twice or not at all
+        with self._locked(fcntl.LOCK_SH if fcntl is not None else None):
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                _merge(merged, _read_rows(path))
+        return merged
+
+
+def _read_rows(path):
+    """Rows of a metrics file ([name, labels, values] each), or [] if it is missing or unreadable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_rows(directory, path, values):
+    """Atomically writes {(name, labels): values} to path as rows."""
+    rows = [[name, list(labels), series] for (name, labels), series in values.items()]
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(rows, f)
+    os.replace(tmp_path, path)
+
+
+def _merge(totals, rows):
+    """Adds rows read from a metrics file into totals ({(name, labels): values})."""
+    for name, labels, values in rows:
+        key = (name, tuple(labels))
+        total = totals.get(key)
+        totals[key] = values if total is None else [a + b for a, b in zip(total, values)]
+
+
+store = MetricsStore()
+atexit.register(store.flush)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render():
+    """Returns every metric in the Prometheus text exposition format (version 0.0.4)."""
+    values = store.collect()
+    lines = []
+    for histogram in HISTOGRAMS:
+        series = sorted((labels, v) for (name, labels), v in values.items() if name == histogram.name)
+
+        lines.append(f'# HELP {histogram.name} {histogram.documentation}')
+        lines.append(f'# TYPE {histogram.name} histogram')
+        for labels, v in series:
+            running = 0
+            for bound, count in zip(histogram.buckets + (float('inf'),), v):
+                running += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                label_text = _format_labels(histogram.label_names, labels, [('le', le)])
+                lines.append(f'{histogram.name}_bucket{label_text} {running}')
+            label_text = _format_labels(histogram.label_names, labels)
+            lines.append(f'{histogram.name}_sum{label_text} {v[-2]:.6f}')
+            lines.append(f'{histogram.name}_count{label_text} {running}')
+
+        errors_name = histogram.name.replace('_duration_seconds', '_errors_total')
+        lines.append(f'# HELP {errors_name} Failed calls counted in {histogram.name}.')
+        lines.append(f'# TYPE {errors_name} counter')
+        for labels, v in series:
+            lines.append(f'{errors_name}{_format_labels(histogram.label_names, labels)} {v[-1]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _http_error(exception):
+    """True if an HTTPException stands for a server error (a bare HTTPException has no code)."""
+    return (exception.code or 500) >= 500
+
+
+def _status_code(rv):
+    """Status of a view's return value when it is known before Flask builds the response."""
+    if isinstance(rv, tuple) and len(rv) > 1 and isinstance(rv[1], int):
+        return rv[1]
+    return getattr(rv, 'status_code', 200)
+
+
+def instrument_view(rule, view):
+    """
+    Wraps a Flask view (sync or async) so its latency and 5xx/exceptions are recorded under `rule`.
+
+    An HTTPException raised by the view (abort(404), a redirect) only counts as an
+    error when its status is 5xx, the same as a returned response.
+    """
+    from flask import request
+    from werkzeug.exceptions import HTTPException
+
+    def record(started, error):
+        REQUEST_DURATION.observe((rule, request.method), time.perf_counter() - started, error)
+
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def timed_view(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                rv = await view(*args, **kwargs)
+            except HTTPException as e:
+                record(started, _http_error(e))
+                raise
+            except Exception:
+                record(started, True)
+                raise
+            record(started, _status_code(rv) >= 500)
+            return rv
+    else:
+        @functools.wraps(view)
+        def timed_view(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                rv = view(*args, **kwargs)
+            except HTTPException as e:
+                record(started, _http_error(e))
+                raise
+            except Exception:
+                record(started, True)
+                raise
+            record(started, _status_code(rv) >= 500)
+            return rv
+
+    return timed_view
+
+
+def observe_upstream(operation, seconds, error=False):
+    """Records one outbound call, e.g. observe_upstream('tumeny.payment_status', 0.31)."""
+    UPSTREAM_DURATION.observe((operation,), seconds, error)
+
+
+@contextmanager
+def track_upstream(operation):
+    """
+    Times the enclosed outbound call (metric, plus a span on the current trace);
+    an exception counts as an error and is re-raised.
+    """
+    kind, _, name = operation.partition('.')
+    started = time.perf_counter()
+    try:
+        with tracing.span(kind, name or operation):
+            yield
+    except Exception:
+        observe_upstream(operation, time.perf_counter() - started, True)
+        raise
+    observe_upstream(operation, time.perf_counter() - started)
+
+
+def supabase_operation(request):
+    """Names a PostgREST request after its table and verb, e.g. 'loans.select' or 'rpc.decrement_remaining_payments'."""
+    path = request.url.path
+    marker = '/rest/v1/'
+    if marker not in path:
+        # Auth or storage APIs: name them by their first path segment
+        return 'supabase.' + path.strip('/').split('/')[0]
+
+    resource = path.split(marker, 1)[1].strip('/')
+    if resource.startswith('rpc/'):
+        return f"rpc.{resource[4:]}"
+
+    method = request.method
+    if method in ('GET', 'HEAD'):
+        verb = 'select'
+    elif method == 'POST':
+        verb = 'upsert' if 'resolution=' in request.headers.get('prefer', '') else 'insert'
+    elif method == 'PATCH':
+        verb = 'update'
+    elif method == 'DELETE':
+        verb = 'delete'
+    else:
+        verb = method.lower()
+    return f'{resource}.{verb}'
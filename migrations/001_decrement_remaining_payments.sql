@@ -0,0 +1,40 @@
+-- Atomic decrement of loans.remaining_payments, called from Pay via supabase.rpc().
+--
+-- The read, the guard against going below zero and the write happen in one
+-- statement with the loan rows locked, so concurrent settlements can never
+-- lose an update. A loan listed n times is decremented n times (at most down
+-- to zero); loans that are missing or already at zero are not returned.
+--
+-- Assumes loans.id is a uuid; change the parameter types if it is text.
+
+create or replace function decrement_remaining_payments_batch(p_loan_ids uuid[])
+returns table (id text, remaining_payments integer, applied integer, organisation_id text)
+language sql
+as $$
+    with requested as (
+        select loan_id, count(*)::integer as times
+        from unnest(p_loan_ids) as loan_id
+        group by loan_id
+    ),
+    locked as (
+        select loans.id,
+               loans.remaining_payments as before,
+               least(requested.times, loans.remaining_payments) as applied
+        from loans
+        join requested on requested.loan_id = loans.id
+        where loans.remaining_payments > 0
+        for update of loans
+    )
+    update loans
+    set remaining_payments = locked.before - locked.applied
+    from locked
+    where loans.id = locked.id
+    returning loans.id::text, loans.remaining_payments, locked.applied, loans.organisation_id::text;
+$$;
+
+create or replace function decrement_remaining_payments(p_loan_id uuid)
+returns table (id text, remaining_payments integer, applied integer, organisation_id text)
+language sql
+as $$
+    select * from decrement_remaining_payments_batch(array[p_loan_id]);
+$$;
@@ -0,0 +1,65 @@
+-- Current balance per loan, maintained alongside loan_repayments.
+--
+-- Every insert into loan_repayments upserts the loan's row in loan_balances
+-- inside the same transaction, so reading a loan's current balance is a
+-- primary-key lookup however long its repayment history is. A row is only
+-- replaced by a repayment at least as recent as the one it holds; rows
+-- inserted by one statement share created_at, so the last one wins.
+--
+-- rebuild_loan_balances() recomputes the table from the history and returns
+-- how many rows it changed (used by LoanBalanceStore.verify and run once here
+-- to backfill existing loans).
+--
+-- Assumes loans.id is a uuid, as in 001_decrement_remaining_payments.sql.
+
+create table if not exists loan_balances (
+    loan_id uuid primary key,
+    balance numeric not null,
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists loan_repayments_loan_id_created_at_idx
+    on loan_repayments (loan_id, created_at desc);
+
+create or replace function sync_loan_balance()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into loan_balances (loan_id, balance, updated_at)
+    values (new.loan_id, new.balance, coalesce(new.created_at, now()))
+    on conflict (loan_id) do update
+        set balance = excluded.balance,
+            updated_at = excluded.updated_at
+        where loan_balances.updated_at <= excluded.updated_at;
+    return new;
+end;
+$$;
+
+drop trigger if exists loan_repayments_sync_balance on loan_repayments;
+create trigger loan_repayments_sync_balance
+    after insert on loan_repayments
+    for each row execute function sync_loan_balance();
+
+create or replace function rebuild_loan_balances()
+returns integer
+language sql
+as $$
+    with latest as (
+        select distinct on (loan_id) loan_id, balance, created_at
+        from loan_repayments
+        order by loan_id, created_at desc
+    ),
+    changed as (
+        insert into loan_balances (loan_id, balance, updated_at)
+        select loan_id, balance, created_at from latest
+        on conflict (loan_id) do update
+            set balance = excluded.balance,
+                updated_at = excluded.updated_at
+            where loan_balances.balance is distinct from excluded.balance
+        returning 1
+    )
+    select count(*)::integer from changed;
+$$;
+
+select rebuild_loan_balances();
@@ -0,0 +1,20 @@
+-- Latest repayment balance per loan, read straight from loan_repayments.
+--
+-- LoanBalanceStore uses this to read balances from the history: before
+-- loan_balances exists, and in verify() to check loan_balances against it.
+-- It returns one row per loan, however long the history is. Without it the
+-- store pages through every repayment of the loans and keeps the newest
+-- one itself.
+--
+-- Uses the (loan_id, created_at desc) index from 002_loan_balances.sql.
+
+create or replace function latest_loan_balances(p_loan_ids uuid[])
+returns table (loan_id uuid, balance numeric)
+language sql
+stable
+as $$
+    select distinct on (r.loan_id) r.loan_id, r.balance
+    from loan_repayments r
+    where r.loan_id = any(p_loan_ids)
+    order by r.loan_id, r.created_at desc;
+$$;
@@ -1,26 +1,42 @@
 import textwrap
 from http.client import responses
 
-import bcrypt
-from supabase import create_client, Client
+from typing import TYPE_CHECKING
+from cache import BoundedCache
+from database import get_supabase
 from flask import session
+from logs import get_logger
 import os
 import random
 import string
 import smtplib
+import threading
 from email.message import EmailMessage
 
+if TYPE_CHECKING:
+    from supabase import Client
+
+log = get_logger('organisation')
+
+# organisation_id -> (name, email); organisations are rarely edited, so a long TTL is fine
+organisation_cache = BoundedCache(
+    max_bytes=os.getenv('ORGANISATION_CACHE_MAX_BYTES', 2 * 1024 * 1024),
+    ttl=os.getenv('ORGANISATION_CACHE_TTL', 600)
+)
+# IDs confirmed not to exist, remembered briefly so bad session values do not hit the database
+unknown_organisations = BoundedCache(
+    max_bytes=256 * 1024,
+    ttl=os.getenv('ORGANISATION_NEGATIVE_TTL', 60)
+)
+
+_warmed_pid = None
+_warm_lock = threading.Lock()
+
 
 class Organisations:
     """contains methods required for the home template"""
     def __init__(self):
-        url = os.getenv("SUPABASE_URL")
-        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-        if not url or not service_role_key:
-            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
-
-        self.supabase: Client = create_client(url, service_role_key)
+        self.supabase: Client = get_supabase()
 
         # email authentication
         self.sender_email = os.getenv('SENDER_EMAIL')
@@ -28,7 +44,18 @@ class Organisations:
 
 
     def get_organisational_name(self, organisation_id):
-        """gets the organizational name using the id"""
+        """
+        Gets the organisational (name, email) using the id.
+
+        Read through organisation_cache; unknown IDs return None and are cached briefly too.
+        """
+        cached = organisation_cache.get(organisation_id)
+        if cached is not None:
+            return cached
+
+        if unknown_organisations.get(organisation_id) is not None:
+            return None
+
         try:
             organisation_response = (
                 self.supabase
@@ -38,11 +65,29 @@ class Organisations:
                 .execute()
             )
 
-            return organisation_response.data[0]['name'], organisation_response.data[0]['email']
+            if not organisation_response.data:
+                unknown_organisations.set(organisation_id, True)
+                return None
 
-        except Exception as e:
-            print(f'Exception: {e}')
+            organisation = organisation_response.data[0]
+            result = (organisation['name'], organisation['email'])
+            organisation_cache.set(organisation_id, result)
+            return result
+
+        except Exception:
+            log.exception("Error fetching organisation", extra={'organisation_id': organisation_id})
+
+    def invalidate_organisation(self, organisation_id):
+        """Drops an organisation's cached metadata (call after editing its name or email)."""
+        organisation_cache.invalidate(organisation_id)
+        unknown_organisations.invalidate(organisation_id)
 
+    def warm_cache(self):
+        """Loads every organisation's (name, email) into organisation_cache with one query."""
+        organisations = self.get_organisations() or []
+        for organisation in organisations:
+            organisation_cache.set(organisation['id'], (organisation['name'], organisation['email']))
+        return len(organisations)
 
     def get_organisations(self):
         """returns a list of organizations"""
@@ -56,7 +101,31 @@ class Organisations:
 
             return organisation_response.data
 
-        except Exception as e:
-            print(f'Exception: {e}')
+        except Exception:
+            log.exception("Error fetching organisations")
+
 
+def warm_organisation_cache():
+    """
+    Warms organisation_cache once per worker process, in a background thread.
+
+    Safe to call on every request: only the first call in each process (including
+    each forked gunicorn worker) starts the warm-up.
+    """
+    global _warmed_pid
+    pid = os.getpid()
+    if _warmed_pid == pid:
+        return
+    with _warm_lock:
+        if _warmed_pid == pid:
+            return
+        _warmed_pid = pid
+
+    def warm():
+        try:
+            count = Organisations().warm_cache()
+            log.info("Organisation cache warmed", extra={'organisations': count})
+        except Exception as e:
+            log.warning("Error warming organisation cache", extra={'error': str(e)})
 
+    threading.Thread(target=warm, name='organisation-cache-warm', daemon=True).start()
@@ -0,0 +1,50 @@
+import os
+
+# Rows fetched per request. Must not exceed PostgREST's max-rows (1000 on Supabase by default),
+# otherwise a capped page is mistaken for the last one.
+PAGE_SIZE = int(os.getenv('SUPABASE_PAGE_SIZE', 1000))
+
+
+def iter_rows(build_query, page_size=None, key=('created_at', 'id')):
+    """
+    Yields every row matched by a Supabase query, one page at a time.
+
+    Pages are read in (created_at, id) order and each page starts after the last
+    row of the previous one (keyset pagination), so rows are never skipped or
+    repeated by inserts between pages and later pages cost the same as the first.
+    Only one page is held in memory at a time.
+
+    Args:
+        build_query (callable): Returns a fresh filtered select, e.g.
+            lambda: supabase.table('loans').select('*').eq('organisation_id', org_id).
+            The selected columns must include the key columns.
+        page_size (int, optional): Rows per request, defaults to SUPABASE_PAGE_SIZE.
+        key (tuple): Sort column and unique tie-breaker column.
+
+    Yields:
+        dict: Rows in key order.
+    """
+    page_size = int(page_size or PAGE_SIZE)
+    sort_column, tie_column = key
+    last = None
+
+    while True:
+        query = build_query()
+        if last is not None:
+            sort_value, tie_value = last
+            query = query.or_(
+                f'{sort_column}.gt."{sort_value}",'
+                f'and({sort_column}.eq."{sort_value}",{tie_column}.gt."{tie_value}")'
+            )
+
+        rows = query.order(sort_column).order(tie_column).limit(page_size).execute().data
+        yield from rows
+
+        if len(rows) < page_size:
+            return
+        last = (rows[-1][sort_column], rows[-1][tie_column])
+
+
+def fetch_all(build_query, page_size=None, key=('created_at', 'id')):
+    """Returns every row matched by a query as a list (see iter_rows)."""
+    return list(iter_rows(build_query, page_size=page_size, key=key))
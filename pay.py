@@ -1,135 +1,135 @@
 
 from dotenv import load_dotenv
 import json
+import logging
 
 load_dotenv()  # Make sure this is at the top
 
 import os
+import httpx
 import requests
 from datetime import datetime, timedelta
-from supabase import create_client, Client
+from typing import TYPE_CHECKING
+from balances import balance_store
+from cache import schedule_cache
+from columns import REPAYMENT_LOANS, SETTLEMENT_LOANS
+from database import get_supabase
+from loans import remove_completed_loans
+from logs import get_logger
+from tumeny import token_manager, transport, async_transport
 
-class Pay:
-    """Contains methods required for the home template."""
+if TYPE_CHECKING:
+    from supabase import Client
 
-    def __init__(self):
-        url = os.getenv("SUPABASE_URL")
-        service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-        if not url or not service_role_key:
-            raise ValueError("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY is not set.")
+log = get_logger('pay')
+# Full request/response dumps, sampled (see logs.GATEWAY_DEBUG_SAMPLE_RATE)
+gateway_log = get_logger('gateway.tumeny')
 
-        self.supabase: Client = create_client(url, service_role_key)
 
-        # Email authentication
-        self.sender_email = os.getenv('SENDER_EMAIL')
-        self.email_password = os.getenv('EMAIL_PASSWORD')
+def _rpc_missing(error):
+    """True if a Supabase RPC failed because the function has not been created (migration not applied)."""
+    return getattr(error, 'code', None) == 'PGRST202'
 
-        # TuMeNy API config
-        self.tumeny_api_key = os.getenv("TUMENY_API_KEY")
-        self.tumeny_api_secret = os.getenv("TUMENY_API_SECRET")
 
-        if not self.tumeny_api_key or not self.tumeny_api_secret:
-            raise Exception("Missing TUMENY_API_KEY or TUMENY_API_SECRET in environment variables.")
+class Pay:
+    """Contains methods required for the home template."""
+
+    def __init__(self):
+        self._load_config()
 
-        # Generate auth token
+        # Auth token comes from the process-wide cache (see tumeny.py)
         self.tumeny_token, self.token_expiry = self.get_tumeny_auth_token()
         if not self.tumeny_token:
             raise Exception("Failed to acquire TuMeNy token.")
-        print(f"TuMeNy token acquired: {self.tumeny_token[:10]}...")
+        log.debug("TuMeNy token acquired", extra={'token_expiry': self.token_expiry})
 
         self.headers = {
             "Authorization": f"Bearer {self.tumeny_token}",
             "Content-Type": "application/json"
         }
 
-    def get_tumeny_auth_token(self):
-        url = "https://tumeny.herokuapp.com/api/token"
-        headers = {
-            "apiKey": self.tumeny_api_key,
-            "apiSecret": self.tumeny_api_secret
-        }
+    def _load_config(self):
+        self.supabase: Client = get_supabase()
 
-        try:
-            response = requests.post(url, headers=headers)
-            response.raise_for_status()
+        # Email authentication
+        self.sender_email = os.getenv('SENDER_EMAIL')
+        self.email_password = os.getenv('EMAIL_PASSWORD')
 
-            data = response.json()
-            token = data.get("token")
-            expire_at = data.get("expireAt")
+        # TuMeNy API config
+        self.tumeny_api_key = os.getenv("TUMENY_API_KEY")
+        self.tumeny_api_secret = os.getenv("TUMENY_API_SECRET")
 
-            if not token:
-                raise Exception("Token not found in response")
+        if not self.tumeny_api_key or not self.tumeny_api_secret:
+            raise Exception("Missing TUMENY_API_KEY or TUMENY_API_SECRET in environment variables.")
 
-            if expire_at is None:
-                raise Exception("expireAt not found in response")
+    def get_tumeny_auth_token(self):
+        """Returns the shared cached TuMeNy token as (token, token_expiry), fetching one if needed."""
+        return token_manager.get_token()
 
-            # Handle the datetime format returned by the API
-            if isinstance(expire_at, dict) and 'date' in expire_at:
-                # Parse the datetime string from the API response
-                try:
-                    expire_datetime_str = expire_at['date']
-                    # Parse the datetime string - it's in UTC format
-                    token_expiry = datetime.fromisoformat(expire_datetime_str.replace('Z', '+00:00'))
-                    # Convert to local time if needed, or keep as UTC
-                    print(f"Token expires at: {token_expiry} UTC")
-                except (ValueError, KeyError) as e:
-                    print(f"Warning: Could not parse expireAt datetime: {expire_at}, using 1 hour default")
-                    token_expiry = datetime.now() + timedelta(hours=1)
-            elif isinstance(expire_at, (int, float)):
-                # Handle seconds format (fallback)
-                token_expiry = datetime.now() + timedelta(seconds=int(expire_at))
-            elif isinstance(expire_at, str):
-                try:
-                    # Try to parse as ISO format datetime string
-                    token_expiry = datetime.fromisoformat(expire_at.replace('Z', '+00:00'))
-                except ValueError:
-                    try:
-                        # Try to parse as seconds
-                        expire_seconds = int(expire_at)
-                        token_expiry = datetime.now() + timedelta(seconds=expire_seconds)
-                    except ValueError:
-                        print(f"Warning: Could not parse expireAt string '{expire_at}', using 1 hour default")
-                        token_expiry = datetime.now() + timedelta(hours=1)
-            else:
-                print(f"Warning: Unexpected expireAt format: {type(expire_at)}, using 1 hour default")
-                token_expiry = datetime.now() + timedelta(hours=1)
+    def _auth_headers(self, content_type=None):
+        headers = {"Authorization": f"Bearer {self.tumeny_token}"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        return headers
 
-            return token, token_expiry
+    def _rejected_token(self, response):
+        """
+        True if the gateway answered 401 to the current token. The token is then dropped
+        from the shared cache (it may have been revoked before expireAt) so the caller can
+        retry once with a new one.
+        """
+        if response.status_code != 401:
+            return False
+        log.warning("TuMeNy rejected the auth token, fetching a new one")
+        token_manager.invalidate(self.tumeny_token)
+        return True
 
-        except requests.RequestException as e:
-            print(f"Failed to get TuMeNy auth token: {e}")
-            return None, None
+    def _send_authorised(self, send):
+        """
+        Calls send() with the cached token in self.tumeny_token, retrying once with a new
+        token if the gateway rejects it. Returns the response, or None if no token could be acquired.
+        """
+        for attempt in range(2):
+            self.tumeny_token, self.token_expiry = self.get_tumeny_auth_token()
+            if not self.tumeny_token:
+                return None
+            response = send()
+            if not self._rejected_token(response) or attempt:
+                return response
 
     def check_payment_status(self, payment_id):
         """
         Checks the status of a Tumeny payment.
         Returns a dictionary with status information instead of just boolean.
         """
-        url = f"https://tumeny.herokuapp.com/api/v1/payment/{payment_id}"
-        headers = {
-            "Authorization": f"Bearer {self.tumeny_token}"
-        }
-
         try:
-            response = requests.get(url, headers=headers)
+            response = self._send_authorised(lambda: transport.get(
+                'payment_status', f"/api/v1/payment/{payment_id}", headers=self._auth_headers()
+            ))
+            if response is None:
+                return {"status": "error", "completed": True, "reason": "auth_failed"}
             response.raise_for_status()
-            data = response.json()
-            status = data.get("payment", {}).get("status", "").upper()
-
-            # Return structured status information
-            if status == "SUCCESS":
-                return {"status": "success", "completed": True}
-            elif status in ["CANCELLED", "CANCELED", "FAILED", "DECLINED"]:
-                return {"status": "failed", "completed": True, "reason": status.lower()}
-            else:
-                # Still pending or unknown status
-                return {"status": "pending", "completed": False}
+            return self._parse_payment_status(response.json())
 
         except requests.exceptions.RequestException as e:
-            print(f"❌ Failed to check payment status: {e}")
+            log.warning("Failed to check payment status", extra={'payment_id': payment_id, 'error': str(e)})
             return {"status": "error", "completed": True, "reason": "api_error"}
 
+    @staticmethod
+    def _parse_payment_status(data):
+        """Maps a TuMeNy payment status response to structured status information."""
+        status = data.get("payment", {}).get("status", "").upper()
+
+        # Return structured status information
+        if status == "SUCCESS":
+            return {"status": "success", "completed": True}
+        elif status in ["CANCELLED", "CANCELED", "FAILED", "DECLINED"]:
+            return {"status": "failed", "completed": True, "reason": status.lower()}
+        else:
+            # Still pending or unknown status
+            return {"status": "pending", "completed": False}
+
     def initiate_payment(self, number, total_amount, transaction_fees, month, loan_id, organisation_name,
                          organisation_email):
         """
@@ -148,91 +148,88 @@ class Pay:
             dict: Response from the TuMeNy API, or error information.
         """
         try:
-            # Step 1: Check if token is expired
-            if self.tumeny_token is None or datetime.now() >= self.token_expiry:
-                print("Token expired or missing, getting new token...")
-                self.tumeny_token, self.token_expiry = self.get_tumeny_auth_token()
-                if not self.tumeny_token:
-                    return {"error": "auth_failed", "message": "Failed to get authentication token"}
-
-            # Step 2: Format phone number - ensure it has country code
-            formatted_number = number
-            print(f"Using phone number: {formatted_number}")
-
-            print(f"Formatted phone number: {formatted_number}")
-
-            # Step 3: Prepare headers and payload according to API docs
-            headers = {
-                "Authorization": f"Bearer {self.tumeny_token}",
-                "Content-Type": "application/json"
-            }
+            # Steps 1-2: Prepare the payload according to API docs
+            payload = self._payment_request(number, total_amount, month, loan_id,
+                                            organisation_name, organisation_email)
 
+            # Steps 3-4: Send it with a valid token (the shared cache refreshes it before expiry)
+            response = self._send_authorised(lambda: transport.post('payment', '/api/v1/payment',
+                                                                    headers=self._auth_headers("application/json"),
+                                                                    json=payload))
+            if response is None:
+                return {"error": "auth_failed", "message": "Failed to get authentication token"}
 
-            amount_in_kwacha = int(total_amount) if isinstance(total_amount, int) else int(total_amount)
+            # Step 5: Handle response
+            return self._handle_payment_response(response)
 
-            # According to the API docs, the correct structure should be:
-            payload = {
-                "description": f"{organisation_name} {month} payment for loan {loan_id}",
-                "customerFirstName": "Customer",  # You might want to get this from borrower data
-                "customerLastName": "Name",  # You might want to get this from borrower data
-                "email": organisation_email,
-                "phoneNumber": formatted_number,
-                "amount": amount_in_kwacha  # Amount in kwacha, not ngwee
-            }
+        except requests.exceptions.Timeout:
+            log.error("Payment request timed out")
+            return {"error": "timeout", "message": "Payment request timed out"}
+        except requests.exceptions.ConnectionError:
+            log.error("Connection error during payment request")
+            return {"error": "connection_error", "message": "Could not connect to payment gateway"}
+        except Exception as e:
+            log.exception("Payment initiation exception")
+            return {"error": "exception", "message": str(e)}
 
-            print("Sending payment request to TuMeNy:")
-            print(f"  URL: https://tumeny.herokuapp.com/api/v1/payment")
-            print(f"  Headers: {headers}")
-            print(f"  Payload: {payload}")
+    def _payment_request(self, number, total_amount, month, loan_id, organisation_name, organisation_email):
+        """Builds the payload for a TuMeNy payment request."""
+        # Format phone number - ensure it has country code
+        formatted_number = number
+
+        amount_in_kwacha = int(total_amount) if isinstance(total_amount, int) else int(total_amount)
+
+        # According to the API docs, the correct structure should be:
+        payload = {
+            "description": f"{organisation_name} {month} payment for loan {loan_id}",
+            "customerFirstName": "Customer",  # You might want to get this from borrower data
+            "customerLastName": "Name",  # You might want to get this from borrower data
+            "email": organisation_email,
+            "phoneNumber": formatted_number,
+            "amount": amount_in_kwacha  # Amount in kwacha, not ngwee
+        }
 
-            # Step 4: Make request to the correct endpoint
-            response = requests.post("https://tumeny.herokuapp.com/api/v1/payment",
-                                     headers=headers,
-                                     json=payload,
-                                     timeout=30)  # Add timeout
+        # The log pipeline redacts the phone number and email
+        gateway_log.debug("Sending payment request to TuMeNy", extra={
+            'url': 'https://tumeny.herokuapp.com/api/v1/payment', 'payload': payload
+        })
 
-            print(f"Response status code: {response.status_code}")
-            print(f"Response headers: {dict(response.headers)}")
+        return payload
 
+    @staticmethod
+    def _handle_payment_response(response):
+        """Turns a TuMeNy payment response (requests or httpx) into the initiate_payment result."""
+        if gateway_log.isEnabledFor(logging.DEBUG):
             # Try to get response content regardless of status code
             try:
                 response_text = response.text
-                print(f"Response text: {response_text}")
-            except:
-                print("Could not get response text")
-
-            # Step 5: Handle response
-            if response.status_code == 200:
-                try:
-                    response_json = response.json()
-                    print(f"Payment request successful: {response_json}")
-                    return response_json
-                except ValueError as e:
-                    print(f"Failed to parse JSON response: {e}")
-                    return {"error": "json_parse_error", "message": "Invalid JSON response from API"}
-            else:
-                error_message = f"HTTP {response.status_code}"
-                try:
-                    # Try to get error details from response
-                    error_response = response.json()
-                    error_message = error_response.get('message', error_message)
-                except:
-                    error_message = response.text or error_message
+            except Exception:
+                response_text = None
+            gateway_log.debug("TuMeNy payment response", extra={
+                'status_code': response.status_code,
+                'response_headers': dict(response.headers),
+                'response_text': response_text
+            })
 
-                print(f"Payment failed: {response.status_code} - {error_message}")
-                return {"error": response.status_code, "message": error_message}
+        if response.status_code == 200:
+            try:
+                response_json = response.json()
+                log.info("Payment request accepted", extra={'status_code': response.status_code})
+                return response_json
+            except ValueError as e:
+                log.error("Failed to parse payment response JSON", extra={'error': str(e)})
+                return {"error": "json_parse_error", "message": "Invalid JSON response from API"}
+        else:
+            error_message = f"HTTP {response.status_code}"
+            try:
+                # Try to get error details from response
+                error_response = response.json()
+                error_message = error_response.get('message', error_message)
+            except:
+                error_message = response.text or error_message
 
-        except requests.exceptions.Timeout:
-            print("Payment request timed out")
-            return {"error": "timeout", "message": "Payment request timed out"}
-        except requests.exceptions.ConnectionError:
-            print("Connection error during payment request")
-            return {"error": "connection_error", "message": "Could not connect to payment gateway"}
-        except Exception as e:
-            print(f"Payment initiation exception: {e}")
-            import traceback
-            traceback.print_exc()
-            return {"error": "exception", "message": str(e)}
+            log.warning("Payment request failed", extra={'status_code': response.status_code, 'error': error_message})
+            return {"error": response.status_code, "message": error_message}
 
     def calculate_components(
             self,
@@ -240,7 +237,8 @@ class Pay:
             loan_amount,
             monthly_payment,
             interest_rate,
-            method
+            method,
+            current_balance=None
     ):
         """
         Calculates payment components for a single loan based on method.
@@ -251,6 +249,8 @@ class Pay:
             monthly_payment (float): Monthly payment amount.
             interest_rate (float): Annual interest rate as a decimal (e.g., 0.3 for 30%).
             method (str): Either 'simple' or 'amortisation'.
+            current_balance (float, optional): Latest balance if already known;
+                otherwise it is read from loan_balances, bypassing the cache.
 
         Returns:
             dict: {
@@ -264,21 +264,11 @@ class Pay:
         method = method.lower()
         monthly_interest_rate = interest_rate / 12  # corrected here
 
-        # Fetch the latest balance
-        repayment_response = (
-            self.supabase
-            .table('loan_repayments')
-            .select('balance')
-            .eq('loan_id', loan_id)
-            .order('created_at', desc=True)
-            .limit(1)
-            .execute()
-        )
-
-        if repayment_response.data:
-            current_balance = float(repayment_response.data[0]['balance'])
-        else:
-            current_balance = loan_amount
+        if current_balance is None:
+            # Latest balance from the maintained balance store (never a cached copy another worker may have changed)
+            current_balance = balance_store.get(loan_id, fresh=True)
+            if current_balance is None:
+                current_balance = loan_amount
 
         if method == 'simple':
             # Simple interest always on original loan amount
@@ -319,9 +309,7 @@ class Pay:
         try:
             # Fetch loan data
             loan_response = (
-                self.supabase
-                .table('loans')
-                .select('*')
+                REPAYMENT_LOANS.query(self.supabase)
                 .eq('id', loan_id)
                 .execute()
             )
@@ -334,7 +322,7 @@ class Pay:
                     'error': 'Loan not found'
                 }
 
-            loan_data = loan_response.data[0]
+            loan_data = REPAYMENT_LOANS.track(loan_response.data)[0]
 
             # Fetch repayment method
             request_response = (
@@ -379,6 +367,8 @@ class Pay:
 
             # Insert repayment record
             repayment_response = self.supabase.table('loan_repayments').insert(repayment_data).execute()
+            balance_store.record([repayment_data])
+            schedule_cache.invalidate(loan_data['organisation_id'])
 
             return {
                 'loan_id': loan_id,
@@ -396,38 +386,65 @@ class Pay:
             }
 
     def reduce_remaining_payments(self, loan_id):
-        """Reduce the number of remaining payments for a given loan_id."""
+        """
+        Atomically reduces the number of remaining payments for a given loan_id by one.
+
+        Runs the decrement_remaining_payments RPC (migrations/001_decrement_remaining_payments.sql),
+        which reads, guards against going below zero and writes in one statement.
+
+        Returns:
+            tuple: (True, [{'id', 'remaining_payments', 'applied', 'organisation_id'}]) on success,
+                (False, error message) otherwise.
+        """
+        try:
+            response = self.supabase.rpc('decrement_remaining_payments', {'p_loan_id': loan_id}).execute()
+        except Exception as e:
+            if _rpc_missing(e):
+                return self._reduce_remaining_payments_read_write(loan_id)
+            log.exception("reduce_remaining_payments failed", extra={'loan_id': loan_id})
+            return False, str(e)
+
+        if not response.data:
+            log.warning("Loan not found or already has 0 remaining payments", extra={'loan_id': loan_id})
+            return False, f"Loan {loan_id} not found or already complete."
+
+        schedule_cache.invalidate(response.data[0].get('organisation_id'))
+        remove_completed_loans(response.data)
+        return True, response.data
+
+    def _reduce_remaining_payments_read_write(self, loan_id):
+        """Fallback for reduce_remaining_payments when the RPC is not deployed: read, then compare-and-set."""
 
         try:
             # Fetch current remaining payments
             loan_response = (
                 self.supabase
                 .table('loans')
-                .select('remaining_payments')
+                .select('remaining_payments, organisation_id')
                 .eq('id', loan_id)
                 .single()
                 .execute()
             )
 
             if not loan_response.data:
-                print(f"[ERROR] Loan with ID {loan_id} not found.")
+                log.error("Loan not found", extra={'loan_id': loan_id})
                 return False, f"Loan with ID {loan_id} not found."
 
             remaining_payments = loan_response.data.get('remaining_payments')
 
             if remaining_payments is None:
-                print(f"[ERROR] 'remaining_payments' is missing in loan {loan_id}.")
+                log.error("'remaining_payments' is missing", extra={'loan_id': loan_id})
                 return False, f"'remaining_payments' missing for loan {loan_id}."
 
             if not isinstance(remaining_payments, int):
                 try:
                     remaining_payments = int(remaining_payments)
                 except ValueError:
-                    print(f"[ERROR] 'remaining_payments' is not a valid integer for loan {loan_id}.")
+                    log.error("'remaining_payments' is not a valid integer", extra={'loan_id': loan_id})
                     return False, f"'remaining_payments' invalid for loan {loan_id}."
 
             if remaining_payments <= 0:
-                print(f"[WARNING] Loan {loan_id} already has 0 remaining payments.")
+                log.warning("Loan already has 0 remaining payments", extra={'loan_id': loan_id})
                 return False, f"Loan {loan_id} already complete."
 
             updated_remaining_payments = remaining_payments - 1
@@ -438,19 +455,320 @@ class Pay:
                 .table('loans')
                 .update({'remaining_payments': updated_remaining_payments})
                 .eq('id', loan_id)
+                .eq('remaining_payments', remaining_payments)
                 .execute()
             )
 
             if update_response.data:
+                schedule_cache.invalidate(loan_response.data.get('organisation_id'))
+                remove_completed_loans([{
+                    'id': loan_id,
+                    'remaining_payments': updated_remaining_payments,
+                    'organisation_id': loan_response.data.get('organisation_id')
+                }])
                 return True, update_response.data
             else:
-                print(f"[ERROR] Failed to update remaining payments for loan {loan_id}.")
+                log.error("Failed to update remaining payments", extra={'loan_id': loan_id})
                 return False, "Update failed."
 
         except Exception as e:
-            print(f"[EXCEPTION] reduce_remaining_payments: {e}")
+            log.exception("_reduce_remaining_payments_read_write failed", extra={'loan_id': loan_id})
             return False, str(e)
 
+    def settle_loans(self, loan_ids, payment_id):
+        """
+        Records a repayment and reduces remaining payments for every loan paid by one payment,
+        using a handful of bulk queries instead of record_repayment/reduce_remaining_payments
+        per loan.
+
+        Args:
+            loan_ids (list): IDs of the loans covered by the payment.
+            payment_id (str): TuMeNy payment ID, echoed back for successful loans.
+
+        Returns:
+            tuple: (successful_loans, failed_loans) in the same shape check_payment_status returns:
+                [{'loan_id', 'payment_id'}], [{'loan_id', 'error'}]
+        """
+        successful_loans = []
+        failed_loans = []
+
+        if not loan_ids:
+            return successful_loans, failed_loans
+
+        unique_ids = list(dict.fromkeys(loan_ids))
+
+        try:
+            # Step 1: Fetch loans, repayment methods and current balances in bulk
+            loans_response = (
+                SETTLEMENT_LOANS.query(self.supabase)
+                .in_('id', unique_ids)
+                .execute()
+            )
+            loans_by_id = {loan['id']: loan for loan in SETTLEMENT_LOANS.track(loans_response.data)}
+
+            requests_response = (
+                self.supabase
+                .table('loan_requests')
+                .select('id, method')
+                .in_('id', unique_ids)
+                .execute()
+            )
+            methods_by_id = {row['id']: row['method'] for row in requests_response.data}
+
+            # Uncached: another worker may have settled one of these loans moments ago
+            balances_by_id = balance_store.get_many(unique_ids, fresh=True)
+
+        except Exception as e:
+            return successful_loans, [{'loan_id': loan_id, 'error': str(e)} for loan_id in loan_ids]
+
+        # Step 2: Compute repayment components in memory
+        repayment_rows = []
+        settled_ids = []
+        for loan_id in loan_ids:
+            try:
+                loan_data = loans_by_id.get(loan_id)
+                if not loan_data:
+                    failed_loans.append({'loan_id': loan_id, 'error': 'Loan not found'})
+                    continue
+
+                method = methods_by_id.get(loan_id)
+                if not method:
+                    failed_loans.append({'loan_id': loan_id, 'error': 'Method not found'})
+                    continue
+
+                monthly_payment = float(loan_data['monthly_payment'])
+                repayment_components = self.calculate_components(
+                    loan_id=loan_id,
+                    loan_amount=loan_data['loan_amount'],
+                    monthly_payment=monthly_payment,
+                    interest_rate=loan_data['interest_rate'],
+                    method=method,
+                    current_balance=balances_by_id.get(loan_id, loan_data['loan_amount'])
+                )
+                # A loan listed twice pays down the balance left by its first repayment
+                balances_by_id[loan_id] = repayment_components['new_balance']
+
+                repayment_rows.append({
+                    'loan_id': loan_id,
+                    'payment_amount': monthly_payment,
+                    'principal_component': repayment_components['principal_component'],
+                    'interest_component': repayment_components['interest_component'],
+                    'balance': repayment_components['new_balance'],
+                    'payment_status': 'complete',
+                    'borrower_id': loan_data['borrower_id'],
+                    'organisation_id': loan_data['organisation_id']
+                })
+                settled_ids.append(loan_id)
+
+            except Exception as e:
+                failed_loans.append({'loan_id': loan_id, 'error': str(e)})
+
+        if not repayment_rows:
+            return successful_loans, failed_loans
+
+        # Step 3: Insert all repayment records in one call
+        try:
+            self.supabase.table('loan_repayments').insert(repayment_rows).execute()
+        except Exception as e:
+            failed_loans.extend({'loan_id': loan_id, 'error': str(e)} for loan_id in settled_ids)
+            return successful_loans, failed_loans
+        balance_store.record(repayment_rows)
+
+        for organisation_id in {row['organisation_id'] for row in repayment_rows}:
+            schedule_cache.invalidate(organisation_id)
+
+        # Step 4: Reduce remaining payments for all settled loans in one atomic call
+        decremented = self.reduce_remaining_payments_batch(settled_ids)
+
+        for loan_id in settled_ids:
+            if decremented.get(loan_id):
+                decremented[loan_id] -= 1
+                successful_loans.append({
+                    'loan_id': loan_id,
+                    'payment_id': payment_id
+                })
+            else:
+                failed_loans.append({
+                    'loan_id': loan_id,
+                    'error': 'Failed to update remaining payments'
+                })
+
+        return successful_loans, failed_loans
+
+    def reduce_remaining_payments_batch(self, loan_ids, loans_by_id=None):
+        """
+        Atomically decrements remaining_payments once per occurrence of each loan in loan_ids,
+        never below zero, with a single decrement_remaining_payments_batch RPC.
+
+        Args:
+            loan_ids (list): Loan IDs; a loan listed twice is decremented twice.
+            loans_by_id (dict, optional): Loan rows already fetched, used only by the
+                fallback when the RPC is not deployed.
+
+        Returns:
+            dict: loan_id -> number of decrements applied (missing or complete loans are absent).
+        """
+        if not loan_ids:
+            return {}
+
+        try:
+            response = (
+                self.supabase
+                .rpc('decrement_remaining_payments_batch', {'p_loan_ids': list(loan_ids)})
+                .execute()
+            )
+        except Exception as e:
+            if not _rpc_missing(e):
+                log.exception("reduce_remaining_payments_batch failed", extra={'loan_ids': list(loan_ids)})
+                return {}
+            if loans_by_id is None:
+                loans_response = (
+                    self.supabase
+                    .table('loans')
+                    .select('id, remaining_payments, organisation_id')
+                    .in_('id', list(dict.fromkeys(loan_ids)))
+                    .execute()
+                )
+                loans_by_id = {loan['id']: loan for loan in loans_response.data}
+            return self._reduce_remaining_payments_bulk(loan_ids, loans_by_id)
+
+        decremented = {}
+        for row in response.data or []:
+            decremented[row['id']] = row['applied']
+            schedule_cache.invalidate(row.get('organisation_id'))
+        remove_completed_loans(response.data or [])
+        return decremented
+
+    def _reduce_remaining_payments_bulk(self, loan_ids, loans_by_id):
+        """
+        Fallback for reduce_remaining_payments_batch when the RPC is not deployed.
+
+        Decrements remaining_payments once per occurrence of each loan in loan_ids.
+
+        Loans are grouped by their current remaining_payments so each group is a single
+        update filtered on that value; a loan changed concurrently simply does not match
+        and is reported as not decremented.
+
+        Returns:
+            dict: loan_id -> number of decrements applied.
+        """
+        counts = {}
+        for loan_id in loan_ids:
+            counts[loan_id] = counts.get(loan_id, 0) + 1
+
+        groups = {}
+        decremented = {}
+        for loan_id, count in counts.items():
+            loan = loans_by_id.get(loan_id)
+            if loan is None:
+                log.warning("Loan not found", extra={'loan_id': loan_id})
+                continue
+            try:
+                remaining = int(loan.get('remaining_payments'))
+            except (TypeError, ValueError):
+                log.error("'remaining_payments' is missing or invalid", extra={'loan_id': loan_id})
+                continue
+
+            applied = min(count, remaining)
+            if applied <= 0:
+                log.warning("Loan already has 0 remaining payments", extra={'loan_id': loan_id})
+                continue
+            groups.setdefault((remaining, applied), []).append(loan_id)
+
+        for (remaining, applied), group_ids in groups.items():
+            try:
+                update_response = (
+                    self.supabase
+                    .table('loans')
+                    .update({'remaining_payments': remaining - applied})
+                    .in_('id', group_ids)
+                    .eq('remaining_payments', remaining)
+                    .execute()
+                )
+                for row in update_response.data or []:
+                    organisation_id = loans_by_id[row['id']].get('organisation_id')
+                    decremented[row['id']] = applied
+                    schedule_cache.invalidate(organisation_id)
+                    remove_completed_loans([{
+                        'id': row['id'],
+                        'remaining_payments': remaining - applied,
+                        'organisation_id': organisation_id
+                    }])
+            except Exception as e:
+                log.exception("_reduce_remaining_payments_bulk failed", extra={'loan_ids': group_ids})
+
+        return decremented
+
+
+class AsyncPay(Pay):
+    """
+    asyncio-native Pay: the token fetch, check_payment_status and initiate_payment
+    are coroutines on the pooled httpx gateway transport, so one worker can wait on
+    many gateway calls at once. Database methods (settle_loans etc.) are inherited
+    unchanged and stay synchronous.
+    """
+
+    def __init__(self):
+        self._load_config()
+        self.tumeny_token, self.token_expiry = None, None
+
+    async def get_tumeny_auth_token_async(self):
+        """Async get_tumeny_auth_token: returns the shared cached TuMeNy token as (token, token_expiry)."""
+        return await token_manager.get_token_async()
+
+    async def _send_authorised_async(self, send):
+        """Async _send_authorised: awaits send(), retrying once with a new token on a 401."""
+        for attempt in range(2):
+            self.tumeny_token, self.token_expiry = await self.get_tumeny_auth_token_async()
+            if not self.tumeny_token:
+                return None
+            response = await send()
+            if not self._rejected_token(response) or attempt:
+                return response
+
+    async def check_payment_status(self, payment_id):
+        """
+        Checks the status of a Tumeny payment.
+        Returns a dictionary with status information instead of just boolean.
+        """
+        try:
+            response = await self._send_authorised_async(lambda: async_transport.get(
+                'payment_status', f"/api/v1/payment/{payment_id}", headers=self._auth_headers()
+            ))
+            if response is None:
+                return {"status": "error", "completed": True, "reason": "auth_failed"}
+            response.raise_for_status()
+            return self._parse_payment_status(response.json())
+
+        except httpx.HTTPError as e:
+            log.warning("Failed to check payment status", extra={'payment_id': payment_id, 'error': str(e)})
+            return {"status": "error", "completed": True, "reason": "api_error"}
+
+    async def initiate_payment(self, number, total_amount, transaction_fees, month, loan_id, organisation_name,
+                               organisation_email):
+        """Initiates payment using the TuMeNy payment API. See Pay.initiate_payment."""
+        try:
+            payload = self._payment_request(number, total_amount, month, loan_id,
+                                            organisation_name, organisation_email)
+
+            response = await self._send_authorised_async(lambda: async_transport.post(
+                'payment', '/api/v1/payment', headers=self._auth_headers("application/json"), json=payload
+            ))
+            if response is None:
+                return {"error": "auth_failed", "message": "Failed to get authentication token"}
+
+            return self._handle_payment_response(response)
+
+        except httpx.TimeoutException:
+            log.error("Payment request timed out")
+            return {"error": "timeout", "message": "Payment request timed out"}
+        except httpx.TransportError:
+            log.error("Connection error during payment request")
+            return {"error": "connection_error", "message": "Could not connect to payment gateway"}
+        except Exception as e:
+            log.exception("Payment initiation exception")
+            return {"error": "exception", "message": str(e)}
+
 
 def test_tumeny_api():
     # Get credentials from environment
@@ -0,0 +1,178 @@
+import heapq
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ledger import settlement_ledger
+from logs import bind_payment_id, get_logger
+from settlement import resolve_payment, stored_payment_result
+
+log = get_logger('poller')
+
+
+class PaymentStatusPoller:
+    """
+    Background poller that resolves pending TuMeNy payments for this worker process.
+
+    /pay registers each new payment_id with track(). A daemon thread then checks
+    the gateway with exponential backoff (PAYMENT_POLL_INITIAL_DELAY doubling up
+    to PAYMENT_POLL_MAX_DELAY) and settles the payment through resolve_payment,
+    which stores the final result in the settlement ledger. The browser endpoint
+    only reads that local state, so gateway calls scale with pending payments
+    rather than open tabs.
+
+    Every worker that sees a payment tracks it, but only the one holding its
+    poll lease in the ledger (PAYMENT_POLL_LEASE seconds, renewed on every poll)
+    checks the gateway; the others read the ledger until the outcome is final,
+    and take the lease over if its holder stops renewing it.
+
+    Gateway errors and pending payments are retried until PAYMENT_POLL_MAX_AGE,
+    after which the last error (or a 'timeout' error for a payment still pending)
+    is recorded as the payment's outcome so the browser stops waiting. The thread is started
+    lazily and restarted after fork, so it is safe with gunicorn --preload.
+    """
+
+    def __init__(self, initial_delay=None, max_delay=None, max_age=None, workers=None):
+        self.enabled = os.getenv('PAYMENT_POLLER_ENABLED', '1') not in ('0', 'false', 'False')
+        self.initial_delay = float(initial_delay or os.getenv('PAYMENT_POLL_INITIAL_DELAY', 5))
+        self.max_delay = float(max_delay or os.getenv('PAYMENT_POLL_MAX_DELAY', 10))
+        self.max_age = float(max_age or os.getenv('PAYMENT_POLL_MAX_AGE', 600))
+        self.workers = int(workers or os.getenv('PAYMENT_POLLER_WORKERS', 4))
+        self.lease_ttl = float(os.getenv('PAYMENT_POLL_LEASE', 60))
+
+        self._condition = threading.Condition()
+        self._pending = {}  # payment_id -> {'loan_ids', 'total_amount', 'registered_at', 'attempts'}
+        self._schedule = []  # heap of (next_check_at, payment_id)
+        self._in_flight = set()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+        self._owner = None
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._thread is not None and self._pid == pid and self._thread.is_alive():
+            return
+
+        # Threads do not survive fork, so a forked worker starts its own with a clean queue
+        if self._pid != pid:
+            self._pending.clear()
+            self._schedule.clear()
+            self._in_flight.clear()
+            # Poll leases are held per process; a recycled pid must not inherit an earlier worker's
+            self._owner = f'{pid}-{uuid.uuid4().hex}'
+
+        self._pid = pid
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payment-poll')
+        self._thread = threading.Thread(target=self._run, name='payment-poller', daemon=True)
+        self._thread.start()
+
+    def track(self, payment_id, loan_ids, total_amount, delay=None):
+        """Starts polling a payment, if it is not already tracked."""
+        with self._condition:
+            self._ensure_started()
+            if payment_id in self._pending:
+                return
+
+            self._pending[payment_id] = {
+                'loan_ids': list(loan_ids),
+                'total_amount': total_amount,
+                'registered_at': time.monotonic(),
+                'attempts': 0
+            }
+            next_check = time.monotonic() + (self.initial_delay if delay is None else delay)
+            heapq.heappush(self._schedule, (next_check, payment_id))
+            self._condition.notify()
+
+    def is_tracking(self, payment_id):
+        return payment_id in self._pending
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._schedule:
+                    self._condition.wait()
+
+                next_check, payment_id = self._schedule[0]
+                wait = next_check - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(timeout=wait)
+                    continue
+
+                heapq.heappop(self._schedule)
+                if payment_id not in self._pending or payment_id in self._in_flight:
+                    continue
+                self._in_flight.add(payment_id)
+                entry = self._pending[payment_id]
+
+            self._executor.submit(self._poll, payment_id, entry)
+
+    def _poll(self, payment_id, entry):
+        bind_payment_id(payment_id)
+        owner = self._owner
+        leased = False
+        try:
+            # A final outcome is read from the ledger, whichever worker recorded it
+            result = stored_payment_result(payment_id)
+            if result is None:
+                leased = settlement_ledger.lease_poll(payment_id, owner, self.lease_ttl)
+                if leased:
+                    result = resolve_payment(payment_id, entry['loan_ids'], entry['total_amount'])
+                else:
+                    # Another worker polls the gateway for this payment
+                    result = {'status': 'pending'}
+        except Exception as e:
+            log.exception("Error polling payment")
+            result = {'status': 'error', 'reason': 'exception', 'message': str(e)}
+
+        with self._condition:
+            self._in_flight.discard(payment_id)
+            entry['attempts'] += 1
+            age = time.monotonic() - entry['registered_at']
+
+            if result['status'] in ('success', 'failed'):
+                self._pending.pop(payment_id, None)
+                self._release(payment_id, owner, leased)
+                return
+
+            if age >= self.max_age:
+                self._pending.pop(payment_id, None)
+                if not leased:
+                    # The lease holder records the outcome
+                    return
+                if result['status'] != 'error':
+                    result = {
+                        'status': 'error',
+                        'reason': 'timeout',
+                        'message': 'Payment was not confirmed in time, please contact support'
+                    }
+                # Final either way, so the ledger, the stream and polling clients stop waiting
+                settlement_ledger.record_outcome(payment_id, result)
+                self._release(payment_id, owner, leased)
+                log.warning("Gave up polling payment", extra={
+                    'reason': result.get('reason'), 'attempts': entry['attempts']
+                })
+                return
+
+            delay = min(self.initial_delay * (2 ** entry['attempts']), self.max_delay)
+            heapq.heappush(self._schedule, (time.monotonic() + delay, payment_id))
+            self._condition.notify()
+
+    @staticmethod
+    def _release(payment_id, owner, leased):
+        if not leased:
+            return
+        try:
+            settlement_ledger.release_poll(payment_id, owner)
+        except Exception:
+            # The lease expires on its own
+            log.exception("Failed to release poll lease")
+
+    def stats(self):
+        with self._condition:
+            return {'pending': len(self._pending), 'in_flight': len(self._in_flight)}
+
+
+payment_poller = PaymentStatusPoller()
@@ -0,0 +1,310 @@
+import calendar
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+
+# Status codes used inside the engine, mapped back to the labels the templates use
+UPCOMING, PAID, MISSED = 0, 1, 2
+STATUS_LABELS = ('Upcoming', 'Paid', 'Missed')
+STATUS_CODES = {label: code for code, label in enumerate(STATUS_LABELS)}
+
+# Large enough that row*BASE + month_index never collides (month indices stay well below it)
+_KEY_BASE = 1 << 20
+
+
+def month_index(year, month):
+    """Returns the integer month index (year*12 + month-1) used by the engine."""
+    return year * 12 + (month - 1)
+
+
+def month_key_to_index(month_key):
+    """Converts a 'YYYY-MM' key into its integer month index."""
+    year, month = month_key.split('-')
+    return month_index(int(year), int(month))
+
+
+def month_index_to_key(index):
+    """Converts an integer month index back into a 'YYYY-MM' key."""
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def _naive(value):
+    """Drops tzinfo so timestamps from the database compare against datetime.today()."""
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
+
+def _seconds_of_day(value):
+    return value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1e6
+
+
+def due_anchor(created_at):
+    """
+    Returns (first_due_month, due_day, due_time) for a loan created at `created_at`.
+
+    Repayments start one month after creation. Later due dates are offset from the
+    first one, so its clamped day of month carries forward.
+    """
+    created_at = _naive(datetime.fromisoformat(created_at))
+    first_due = month_index(created_at.year, created_at.month) + 1
+    due_day = min(created_at.day, calendar.monthrange(first_due // 12, first_due % 12 + 1)[1])
+    return first_due, due_day, _seconds_of_day(created_at)
+
+
+class ScheduleArrays:
+    """
+    Column-oriented view of an organisation's loans for the schedule engine.
+
+    Attributes:
+        loan_ids (list): Loan IDs in row order.
+        first_due_month (np.ndarray): Month index of each loan's first repayment
+            (one month after creation).
+        term_months (np.ndarray): Number of repayments per loan.
+        due_day (np.ndarray): Day of month repayments fall due, as of the first
+            repayment (still clamped to the length of later months).
+        due_time (np.ndarray): Seconds after midnight the loan was created, which
+            decides whether a repayment due today is already past.
+    """
+
+    def __init__(self, loans):
+        self.loans = loans
+        self.loan_ids = [loan['id'] for loan in loans]
+        self.row_by_loan = {loan_id: row for row, loan_id in enumerate(self.loan_ids)}
+
+        count = len(loans)
+        self.first_due_month = np.empty(count, dtype=np.int64)
+        self.term_months = np.empty(count, dtype=np.int64)
+        self.due_day = np.empty(count, dtype=np.int64)
+        self.due_time = np.empty(count, dtype=np.float64)
+
+        for row, loan in enumerate(loans):
+            first_due, due_day, due_time = due_anchor(loan['created_at'])
+            self.first_due_month[row] = first_due
+            self.term_months[row] = int(loan['term_months'] or 0)
+            self.due_day[row] = due_day
+            self.due_time[row] = due_time
+
+    def __len__(self):
+        return len(self.loan_ids)
+
+    def paid_keys(self, payments_by_month):
+        """
+        Encodes {loan_id: {'YYYY-MM', ...}} as an array of row*BASE + month keys
+        so paid lookups for every (loan, month) pair can be done with one np.isin call.
+        """
+        month_cache = {}
+        key_rows = []
+        key_months = []
+        for loan_id, months in payments_by_month.items():
+            row = self.row_by_loan.get(loan_id)
+            if row is None:
+                continue
+            for month in months:
+                index = month_cache.get(month)
+                if index is None:
+                    index = month_cache[month] = month_key_to_index(month)
+                key_months.append(index)
+            key_rows.extend([row] * len(months))
+
+        keys = np.asarray(key_rows, dtype=np.int64) * _KEY_BASE + np.asarray(key_months, dtype=np.int64)
+        return keys
+
+
+def compute_statuses(arrays, payments_by_month, today=None, months=None):
+    """
+    Computes the Paid/Missed/Upcoming status of every repayment of every loan at once.
+
+    Args:
+        arrays (ScheduleArrays): Loans to schedule.
+        payments_by_month (dict): loan_id -> set of 'YYYY-MM' months with a completed repayment.
+        today (datetime, optional): Reference time, defaults to datetime.today().
+        months (iterable, optional): Only return entries for these 'YYYY-MM' months.
+
+    Returns:
+        tuple: (rows, month_indices, status_codes) as parallel NumPy arrays,
+            ordered by loan row then due month.
+    """
+    today = today or datetime.today()
+    terms = np.maximum(arrays.term_months, 0)
+    total = int(terms.sum())
+
+    rows = np.repeat(np.arange(len(arrays), dtype=np.int64), terms)
+    # Offset of each entry within its loan's term: 0, 1, ..., term-1
+    starts = np.repeat(np.cumsum(terms) - terms, terms)
+    offsets = np.arange(total, dtype=np.int64) - starts
+    month_indices = arrays.first_due_month[rows] + offsets
+
+    if months is not None:
+        wanted = np.asarray(sorted(month_key_to_index(m) for m in months), dtype=np.int64)
+        keep = np.isin(month_indices, wanted)
+        rows, month_indices = rows[keep], month_indices[keep]
+
+    today_month = month_index(today.year, today.month)
+    status = np.full(len(rows), MISSED, dtype=np.int8)
+
+    # Due dates keep the creation day (clamped to the month length) and time of day,
+    # so only repayments falling in the current month need a finer comparison.
+    upcoming = month_indices > today_month
+    current = month_indices == today_month
+    if current.any():
+        days_in_month = calendar.monthrange(today.year, today.month)[1]
+        due_day = np.minimum(arrays.due_day[rows[current]], days_in_month)
+        today_time = _seconds_of_day(today)
+        due_after_today = (due_day > today.day) | (
+            (due_day == today.day) & (arrays.due_time[rows[current]] > today_time)
+        )
+        upcoming[current] = due_after_today
+    status[upcoming] = UPCOMING
+
+    paid_keys = arrays.paid_keys(payments_by_month)
+    if len(paid_keys):
+        past = ~upcoming
+        status[past & np.isin(rows * _KEY_BASE + month_indices, paid_keys, kind='sort')] = PAID
+
+    return rows, month_indices, status
+
+
+def build_payment_status(loans, payments_by_month, organisation_id, today=None, months=None, statuses=None):
+    """
+    Vectorised equivalent of the per-loan, per-month loop in Loans.generate_payment_status.
+
+    Args:
+        loans (list): Loan rows with id, created_at, term_months, monthly_payment, borrower_id.
+        payments_by_month (dict): loan_id -> set of paid 'YYYY-MM' months.
+        organisation_id (str): Organisation the loans belong to.
+        today (datetime, optional): Reference time, defaults to datetime.today().
+        months (iterable, optional): Fast path - only build entries for these months.
+        statuses (iterable, optional): Fast path - only build entries with these statuses.
+
+    Returns:
+        dict: loan_id -> {
+            'monthly_payment', 'borrower_id', 'organisation_id',
+            'payment_status_by_month': {month: status}
+        }
+    """
+    arrays = ScheduleArrays(loans)
+    rows, month_indices, status = compute_statuses(arrays, payments_by_month, today=today, months=months)
+
+    if statuses is not None:
+        keep = np.isin(status, [STATUS_CODES[s] for s in statuses])
+        rows, month_indices, status = rows[keep], month_indices[keep], status[keep]
+
+    # Format each distinct month once instead of once per loan
+    unique_months, month_positions = np.unique(month_indices, return_inverse=True)
+    month_keys = [month_index_to_key(int(m)) for m in unique_months]
+
+    row_list = rows.tolist()
+    key_list = [month_keys[p] for p in month_positions.tolist()]
+    label_list = [STATUS_LABELS[s] for s in status.tolist()]
+
+    result = {}
+    for loan in loans:
+        result[loan['id']] = {
+            "monthly_payment": loan.get("monthly_payment"),
+            "borrower_id": loan.get("borrower_id"),
+            "organisation_id": organisation_id,
+            "payment_status_by_month": {}
+        }
+
+    loan_ids = arrays.loan_ids
+    for row, month_key, label in zip(row_list, key_list, label_list):
+        result[loan_ids[row]]["payment_status_by_month"][month_key] = label
+
+    return result
+
+
+class MonthIndex:
+    """
+    Inverted index from due month to the loans with a repayment due in that month.
+
+    Built in one pass over loan start dates and terms, so looking up the loans due
+    in a month costs about the number of loans due then rather than loans x term.
+    Loans can be added or removed in place as they are created or completed
+    (remaining_payments reaching 0); loans already complete are not indexed.
+
+    The index is shared between request threads. Writers hold a lock and replace a
+    month's dict instead of mutating it (copy-on-write), so readers never see a
+    dict change under them and need no lock.
+    """
+
+    def __init__(self, loans=()):
+        self._lock = threading.Lock()
+        self._by_month = {}  # month index -> {loan_id: entry}, never mutated once published
+        self._months_by_loan = {}  # loan_id -> range of month indices
+        by_month = defaultdict(dict)
+        for loan in loans:
+            if loan.get('remaining_payments') == 0:
+                continue
+            months, entry = self._entry(loan)
+            for month in months:
+                by_month[month][loan['id']] = entry
+            self._months_by_loan[loan['id']] = months
+        self._by_month = dict(by_month)
+
+    @staticmethod
+    def _entry(loan):
+        """Returns (due month indices, entry) for a loan row with id, created_at, term_months, monthly_payment, borrower_id."""
+        first_due, due_day, due_time = due_anchor(loan['created_at'])
+        entry = {
+            'monthly_payment': loan.get('monthly_payment'),
+            'borrower_id': loan.get('borrower_id'),
+            'due_day': due_day,
+            'due_time': due_time
+        }
+        return range(first_due, first_due + max(int(loan['term_months'] or 0), 0)), entry
+
+    def add_loan(self, loan):
+        """Indexes (or re-indexes) a loan row with id, created_at, term_months, monthly_payment, borrower_id."""
+        months, entry = self._entry(loan)
+        with self._lock:
+            self._remove(loan['id'])
+            for month in months:
+                loans = dict(self._by_month.get(month, {}))
+                loans[loan['id']] = entry
+                self._by_month[month] = loans
+            self._months_by_loan[loan['id']] = months
+
+    def remove_loan(self, loan_id):
+        """Removes a loan (e.g. once completed) from every month it was due in."""
+        with self._lock:
+            self._remove(loan_id)
+
+    def _remove(self, loan_id):
+        for month in self._months_by_loan.pop(loan_id, ()):
+            loans = {key: entry for key, entry in self._by_month.get(month, {}).items() if key != loan_id}
+            if loans:
+                self._by_month[month] = loans
+            else:
+                self._by_month.pop(month, None)
+
+    def loans_due(self, month_key):
+        """Returns {loan_id: entry} for every loan with a repayment due in 'YYYY-MM'."""
+        return dict(self._by_month.get(month_key_to_index(month_key), {}))
+
+    def upcoming_loans(self, month_key, today=None):
+        """
+        Returns {loan_id: entry} for loans whose repayment in 'YYYY-MM' is still Upcoming,
+        matching the status rules of compute_statuses.
+        """
+        today = today or datetime.today()
+        month = month_key_to_index(month_key)
+        today_month = month_index(today.year, today.month)
+
+        if month < today_month:
+            return {}
+
+        loans = self._by_month.get(month, {})
+        if month > today_month:
+            return dict(loans)
+
+        days_in_month = calendar.monthrange(today.year, today.month)[1]
+        today_time = _seconds_of_day(today)
+        upcoming = {}
+        for loan_id, entry in loans.items():
+            due_day = min(entry['due_day'], days_in_month)
+            if due_day > today.day or (due_day == today.day and entry['due_time'] > today_time):
+                upcoming[loan_id] = entry
+        return upcoming
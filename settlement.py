@@ -0,0 +1,145 @@
+import asyncio
+import os
+
+from cache import BoundedCache, SingleFlight
+from ledger import settlement_ledger
+from pay import AsyncPay, Pay
+
+# One gateway check per payment_id at a time; final results are reused for a short window
+payment_flight = SingleFlight(
+    cache=BoundedCache(max_bytes=1024 * 1024, ttl=os.getenv('PAYMENT_RESULT_CACHE_TTL', 30)),
+    cacheable=lambda result: result.get('status') in ('success', 'failed')
+)
+
+
+def stored_payment_result(payment_id, connection=None):
+    """
+    Returns the check_payment_status response already known for a payment, or None.
+
+    Settled and failed payments return their stored result; a payment being settled
+    by another request reads as pending until its claim goes stale. Pass a
+    settlement_ledger.reader() connection to reuse it across repeated checks.
+    """
+    settlement = settlement_ledger.get(payment_id, connection=connection)
+    if settlement is None:
+        return None
+
+    if settlement['result'] is not None:
+        return settlement['result']
+
+    if settlement_ledger.is_stale(settlement):
+        return {
+            'status': 'error',
+            'reason': 'settlement_incomplete',
+            'message': 'Payment settlement did not complete, please contact support'
+        }
+
+    # Another request is settling this payment right now
+    return {
+        'status': 'pending'
+    }
+
+
+def resolve_payment(payment_id, loan_ids, total_amount_str, pay_manager=None):
+    """
+    Checks a payment with the gateway and settles its loans exactly once on success.
+
+    Concurrent calls for the same payment_id (several tabs, the poller and a request)
+    share a single upstream check and its result.
+
+    Args:
+        payment_id (str): TuMeNy payment ID.
+        loan_ids (list): Loans covered by the payment.
+        total_amount_str (str): Amount echoed back to the browser.
+        pay_manager (Pay, optional): Existing Pay instance to reuse.
+
+    Returns:
+        dict: The check_payment_status response (status success/failed/error/pending).
+    """
+    return payment_flight.do(
+        payment_id,
+        lambda: _resolve_payment(payment_id, loan_ids, total_amount_str, pay_manager)
+    )
+
+
+async def resolve_payment_async(payment_id, loan_ids, total_amount_str, pay_manager=None):
+    """
+    Async resolve_payment for async views: awaits the gateway check on the shared
+    async transport and runs the ledger and Supabase settlement in a thread.
+
+    Shares payment_flight with resolve_payment, so concurrent checks of the same
+    payment_id (async views, sync callers and the poller) make one gateway call
+    and settle once. Final results already stored are returned without a gateway call.
+    """
+    return await payment_flight.do_async(
+        payment_id,
+        lambda: _resolve_payment_async(payment_id, loan_ids, total_amount_str, pay_manager)
+    )
+
+
+async def _resolve_payment_async(payment_id, loan_ids, total_amount_str, pay_manager=None):
+    stored = await asyncio.to_thread(stored_payment_result, payment_id)
+    if stored is not None:
+        return stored
+
+    pay_manager = pay_manager or AsyncPay()
+    payment_status_result = await pay_manager.check_payment_status(payment_id)
+
+    return await asyncio.to_thread(
+        _finalise_payment, payment_status_result, payment_id, loan_ids, total_amount_str, pay_manager
+    )
+
+
+def _resolve_payment(payment_id, loan_ids, total_amount_str, pay_manager=None):
+    stored = stored_payment_result(payment_id)
+    if stored is not None:
+        return stored
+
+    pay_manager = pay_manager or Pay()
+    payment_status_result = pay_manager.check_payment_status(payment_id)
+    return _finalise_payment(payment_status_result, payment_id, loan_ids, total_amount_str, pay_manager)
+
+
+def _finalise_payment(payment_status_result, payment_id, loan_ids, total_amount_str, pay_manager):
+    # Handle the new structured response
+    if payment_status_result["status"] == "success":
+        # Claim the payment first so concurrent polls can never settle it twice
+        if not settlement_ledger.claim(payment_id):
+            return stored_payment_result(payment_id) or {'status': 'pending'}
+
+        # Settle all loans covered by this payment in bulk
+        successful_loans, failed_loans = pay_manager.settle_loans(loan_ids, payment_id)
+
+        result = {
+            'status': 'success',
+            'successful_loans': successful_loans,
+            'failed_loans': failed_loans,
+            'payment_id': payment_id,
+            'total_amount': total_amount_str
+        }
+        settlement_ledger.complete(payment_id, result)
+        return result
+
+    elif payment_status_result["status"] == "failed":
+        # Payment was cancelled or failed - stop polling
+        result = {
+            'status': 'failed',
+            'reason': payment_status_result.get('reason', 'unknown'),
+            'message': f'Payment was {payment_status_result.get("reason", "cancelled")}'
+        }
+        settlement_ledger.record_outcome(payment_id, result)
+        return result
+
+    elif payment_status_result["status"] == "error":
+        # API error - stop polling
+        return {
+            'status': 'error',
+            'reason': payment_status_result.get('reason', 'unknown'),
+            'message': 'Error checking payment status'
+        }
+
+    else:
+        # Still pending
+        return {
+            'status': 'pending'
+        }
@@ -0,0 +1,91 @@
+"""
+Startup benchmark: how long a fresh worker takes to import the app, and which modules cost the most.
+
+Runs `python -X importtime -c "import main; main.create_app()"` in fresh interpreters
+and reports the median wall time plus per-module cumulative import times.
+
+Usage:
+    python startup_benchmark.py [--runs 5] [--top 20] [--target main]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules of this repo, reported separately from third-party packages
+LOCAL_MODULES = (
+    'main', 'auth', 'balances', 'batching', 'borrowers', 'cache', 'columns', 'database', 'ledger',
+    'loans', 'logs', 'metrics', 'organisation', 'pagination', 'pay', 'poller', 'schedule', 'settlement',
+    'tracing', 'tumeny',
+)
+
+
+def run_once(target):
+    """Imports `target` and builds the app in a fresh interpreter; returns (wall seconds, importtime lines)."""
+    code = f"import {target}; {target}.create_app()"
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    elapsed = time.perf_counter() - started
+
+    if completed.returncode != 0:
+        raise RuntimeError(f"Importing {target} failed:\n{completed.stderr[-2000:]}")
+    return elapsed, completed.stderr.splitlines()
+
+
+def parse_importtime(lines):
+    """Returns {module: (self_us, cumulative_us)} from -X importtime output."""
+    modules = {}
+    for line in lines:
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to time (median is reported)')
+    parser.add_argument('--top', type=int, default=20, help='third-party modules to list')
+    parser.add_argument('--target', default='main', help='module exposing create_app()')
+    args = parser.parse_args()
+
+    walls = []
+    runs = []
+    for _ in range(args.runs):
+        elapsed, lines = run_once(args.target)
+        walls.append(elapsed)
+        runs.append(parse_importtime(lines))
+
+    def median_cumulative(name):
+        return statistics.median(run[name][1] for run in runs if name in run) / 1000
+
+    names = set().union(*runs)
+    print(f"Interpreter start + import {args.target} + create_app(): "
+          f"median {statistics.median(walls) * 1000:.0f} ms over {args.runs} runs")
+    if args.target in names:
+        print(f"Import time of {args.target}: {median_cumulative(args.target):.1f} ms")
+
+    print("\nLocal modules (cumulative ms):")
+    for name in sorted((n for n in names if n in LOCAL_MODULES), key=median_cumulative, reverse=True):
+        print(f"  {name:<24} {median_cumulative(name):8.1f}")
+
+    # Top-level packages only, so a package is not listed again for each of its submodules
+    third_party = [
+        n for n in names
+        if '.' not in n and n not in LOCAL_MODULES and n not in sys.stdlib_module_names
+    ]
+    print(f"\nHeaviest third-party packages (cumulative ms, top {args.top}):")
+    for name in sorted(third_party, key=median_cumulative, reverse=True)[:args.top]:
+        print(f"  {name:<24} {median_cumulative(name):8.1f}")
+
+
+if __name__ == '__main__':
+    main()
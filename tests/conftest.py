@@ -0,0 +1,50 @@
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_supabase import FakePostgrest  # noqa: E402
+
+
+@pytest.fixture
+def postgrest(monkeypatch):
+    """A FakePostgrest answering every query made through database.get_supabase()."""
+    from database import registry
+
+    fake = FakePostgrest()
+    monkeypatch.setenv('SUPABASE_URL', 'http://supabase.test')
+    monkeypatch.setenv('SUPABASE_SERVICE_ROLE_KEY', 'test.service.key')
+    registry.reset()
+    monkeypatch.setattr(registry, 'transport', httpx.MockTransport(fake.handler))
+    yield fake
+    registry.reset()
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(tmp_path, monkeypatch):
+    """Empties the per-process caches and points the settlement ledger at a fresh file."""
+    from balances import balance_store
+    from borrowers import borrower_cache, loan_borrower_ids
+    from cache import schedule_cache
+    from ledger import settlement_ledger
+    from settlement import payment_flight
+
+    for cache in (schedule_cache, borrower_cache, loan_borrower_ids, balance_store._cache,
+                  payment_flight.cache, settlement_ledger._settled):
+        cache.clear()
+
+    monkeypatch.setattr(settlement_ledger, 'path', str(tmp_path / 'settlements.db'))
+    monkeypatch.setattr(settlement_ledger, '_initialised', False)
+
+
+@pytest.fixture
+def pay_manager(postgrest, monkeypatch):
+    """An AsyncPay on the fake database; its constructor needs no gateway call."""
+    from pay import AsyncPay
+
+    monkeypatch.setenv('TUMENY_API_KEY', 'test-key')
+    monkeypatch.setenv('TUMENY_API_SECRET', 'test-secret')
+    return AsyncPay()
@@ -0,0 +1,344 @@
+"""
+In-memory stand-in for Supabase's PostgREST API, for tests.
+
+FakePostgrest answers the HTTP requests the real supabase client sends, so the
+code under test runs its real query builders, the pooled client's transport,
+tracing and metrics. It implements the subset of PostgREST this repo uses:
+selects with embedded resources, eq/neq/gt/gte/lt/lte/in/cs/is filters, or/and
+groups, order, limit, single(), insert, update, upsert, and the RPC functions
+and trigger declared in migrations/.
+
+A table that was never seeded answers like a missing relation (PGRST205), and a
+function removed from `functions` like one never created (PGRST202), so the
+fallbacks for unapplied migrations can be exercised too.
+"""
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+# Query string keys that are not filters
+_MODIFIERS = {'select', 'order', 'limit', 'offset', 'on_conflict', 'columns'}
+
+
+def decrement_remaining_payments_batch(db, p_loan_ids):
+    """migrations/001_decrement_remaining_payments.sql: one decrement per occurrence, never below zero."""
+    times = {}
+    for loan_id in p_loan_ids:
+        times[str(loan_id)] = times.get(str(loan_id), 0) + 1
+
+    rows = []
+    for loan in db.tables.get('loans', []):
+        requested = times.get(str(loan['id']))
+        remaining = loan.get('remaining_payments')
+        if not requested or remaining is None or remaining <= 0:
+            continue
+        applied = min(requested, remaining)
+        loan['remaining_payments'] = remaining - applied
+        rows.append({
+            'id': str(loan['id']),
+            'remaining_payments': loan['remaining_payments'],
+            'applied': applied,
+            'organisation_id': loan.get('organisation_id')
+        })
+    return rows
+
+
+def decrement_remaining_payments(db, p_loan_id):
+    return decrement_remaining_payments_batch(db, [p_loan_id])
+
+
+def latest_loan_balances(db, p_loan_ids):
+    """migrations/003_latest_loan_balances.sql: the newest repayment's balance per loan."""
+    wanted = {str(loan_id) for loan_id in p_loan_ids}
+    latest = {}
+    for row in sorted(db.tables.get('loan_repayments', []), key=lambda row: row['created_at']):
+        if str(row['loan_id']) in wanted:
+            latest[row['loan_id']] = {'loan_id': row['loan_id'], 'balance': row['balance']}
+    return list(latest.values())
+
+
+RPC_FUNCTIONS = {
+    'decrement_remaining_payments_batch': decrement_remaining_payments_batch,
+    'decrement_remaining_payments': decrement_remaining_payments,
+    'latest_loan_balances': latest_loan_balances,
+}
+
+
+def _text(value):
+    """A column value as PostgREST compares it with a filter operand."""
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _unquote(operand):
+    if len(operand) >= 2 and operand[0] == operand[-1] == '"':
+        return operand[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return operand
+
+
+def _split(text, separator=','):
+    """Splits on separators outside double quotes and parentheses."""
+    parts, current, depth, quoted = [], '', 0, False
+    for char in text:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and char == separator:
+            parts.append(current)
+            current = ''
+            continue
+        current += char
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _compare(value, operand):
+    """-1, 0 or 1; numbers compare as numbers, everything else as text (ISO dates sort as text)."""
+    try:
+        left, right = float(value), float(operand)
+    except (TypeError, ValueError):
+        left, right = _text(value), operand
+    return (left > right) - (left < right)
+
+
+def _condition(column, expression):
+    """Returns row -> bool for one 'op.operand' filter on column."""
+    negate = expression.startswith('not.')
+    if negate:
+        expression = expression[4:]
+    operator, _, operand = expression.partition('.')
+
+    if operator == 'in':
+        values = {_unquote(v) for v in _split(operand.strip()[1:-1])}
+        test = lambda row: _text(row.get(column)) in values
+    elif operator == 'cs':
+        values = {_unquote(v) for v in _split(operand.strip()[1:-1])}
+        test = lambda row: values <= {_text(v) for v in row.get(column) or []}
+    elif operator == 'is':
+        test = lambda row: _text(row.get(column)) == operand
+    elif operator in ('eq', 'neq'):
+        operand = _unquote(operand)
+        test = lambda row: _text(row.get(column)) == operand
+        if operator == 'neq':
+            test = lambda row, eq=test: row.get(column) is not None and not eq(row)
+    elif operator in ('gt', 'gte', 'lt', 'lte'):
+        operand = _unquote(operand)
+        accept = {'gt': (1,), 'gte': (0, 1), 'lt': (-1,), 'lte': (-1, 0)}[operator]
+        test = lambda row: row.get(column) is not None and _compare(row.get(column), operand) in accept
+    else:
+        raise ValueError(f'Unsupported filter operator {operator!r}')
+
+    return (lambda row: not test(row)) if negate else test
+
+
+def _group(expression, combine):
+    """Returns row -> bool for an or/and group such as '(a.eq.1,and(b.gt.2,c.lt.3))'."""
+    conditions = []
+    for item in _split(expression.strip()[1:-1]):
+        if item.startswith(('and(', 'or(')):
+            name, _, rest = item.partition('(')
+            conditions.append(_group('(' + rest, all if name == 'and' else any))
+        else:
+            column, _, filter_expression = item.partition('.')
+            conditions.append(_condition(column, filter_expression))
+    return lambda row: combine(condition(row) for condition in conditions)
+
+
+class FakePostgrest:
+    """
+    PostgREST over in-memory tables; `handler` is an httpx.MockTransport handler.
+
+    Args:
+        project (bool): Return only the selected columns, as PostgREST does. False
+            returns whole rows whatever the select asks for (to see what a call site reads).
+    """
+
+    def __init__(self, project=True):
+        self.project = project
+        self.tables = {}
+        self.functions = dict(RPC_FUNCTIONS)
+        self.calls = []  # (method, resource) of every request, in order
+        self._lock = threading.Lock()
+        self._clock = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def seed(self, **tables):
+        """Adds rows to tables (creating them); returns self."""
+        for name, rows in tables.items():
+            self.tables.setdefault(name, []).extend(dict(row) for row in rows)
+        return self
+
+    def handler(self, request):
+        resource = request.url.path.split('/rest/v1/', 1)[-1].strip('/')
+        with self._lock:
+            self.calls.append((request.method, resource))
+            try:
+                if resource.startswith('rpc/'):
+                    return self._rpc(request, resource[4:])
+                if resource not in self.tables:
+                    return _error(404, 'PGRST205', f"Could not find the table 'public.{resource}' in the schema cache")
+                return self._table(request, resource)
+            except _Error as e:
+                return _error(e.status, e.code, e.message)
+
+    def _rpc(self, request, name):
+        function = self.functions.get(name)
+        if function is None:
+            return _error(404, 'PGRST202', f'Could not find the function public.{name} in the schema cache')
+        params = json.loads(request.content or b'{}')
+        try:
+            rows = function(self, **params)
+        except Exception as e:
+            # What a function raising an exception looks like through PostgREST
+            return _error(500, 'P0001', str(e))
+        return self._respond(request, rows)
+
+    def _table(self, request, name):
+        params = request.url.params
+        rows = self.tables[name]
+
+        if request.method in ('GET', 'HEAD'):
+            matched = self._order(self._filter(rows, params), params.get('order'))
+            offset = int(params.get('offset', 0))
+            limit = params.get('limit')
+            matched = matched[offset:offset + int(limit) if limit is not None else None]
+            return self._respond(request, [self._select(name, row, params.get('select', '*')) for row in matched])
+
+        if request.method == 'POST':
+            body = json.loads(request.content)
+            body = body if isinstance(body, list) else [body]
+            if 'resolution=' in request.headers.get('prefer', ''):
+                written = self._upsert(name, body, params.get('on_conflict', 'id'))
+            else:
+                written = self._insert(name, body)
+            return self._written(request, name, written, 201)
+
+        if request.method == 'PATCH':
+            changes = json.loads(request.content)
+            matched = self._filter(rows, params)
+            for row in matched:
+                row.update(changes)
+            return self._written(request, name, matched, 200)
+
+        if request.method == 'DELETE':
+            matched = self._filter(rows, params)
+            self.tables[name] = [row for row in rows if row not in matched]
+            return self._written(request, name, matched, 200)
+
+        return _error(405, 'PGRST000', f'{request.method} not supported')
+
+    def _filter(self, rows, params):
+        conditions = []
+        for key, value in params.multi_items():
+            if key in _MODIFIERS:
+                continue
+            if key in ('or', 'and'):
+                conditions.append(_group(value, any if key == 'or' else all))
+            else:
+                conditions.append(_condition(key, value))
+        return [row for row in rows if all(condition(row) for condition in conditions)]
+
+    @staticmethod
+    def _order(rows, order):
+        rows = list(rows)
+        for term in reversed((order or '').split(',') if order else []):
+            column, _, direction = term.partition('.')
+            rows.sort(
+                key=lambda row: (row.get(column) is None, _sort_key(row.get(column))),
+                reverse=direction.startswith('desc')
+            )
+        return rows
+
+    def _select(self, table, row, select):
+        """Projects a row onto a select list, resolving embedded many-to-one resources."""
+        result = dict(row) if not self.project else {}
+        for item in _split(select):
+            if '(' in item:
+                embedded, _, inner = item.partition('(')
+                result[embedded] = self._embed(table, row, embedded, inner[:-1])
+            elif item == '*':
+                result.update(row)
+            elif self.project:
+                result[item] = row.get(item)
+        return result
+
+    def _embed(self, table, row, embedded, select):
+        foreign_key = embedded.rstrip('s') + '_id'
+        if embedded not in self.tables or foreign_key not in row:
+            raise _Error(400, 'PGRST200', f"Could not find a relationship between '{table}' and '{embedded}'")
+        for target in self.tables[embedded]:
+            if _text(target.get('id')) == _text(row[foreign_key]):
+                return self._select(embedded, target, select)
+        return None
+
+    def _insert(self, name, body):
+        inserted = []
+        for values in body:
+            self._clock += timedelta(seconds=1)
+            row = {'id': str(uuid.uuid4()), 'created_at': self._clock.isoformat()}
+            row.update(values)
+            self.tables[name].append(row)
+            inserted.append(row)
+
+        if name == 'loan_repayments' and 'loan_balances' in self.tables:
+            # migrations/002_loan_balances.sql: the trigger keeps the latest balance per loan
+            self._upsert('loan_balances', [
+                {'loan_id': row['loan_id'], 'balance': row['balance']} for row in inserted
+            ], 'loan_id')
+        return inserted
+
+    def _upsert(self, name, body, on_conflict):
+        written = []
+        for values in body:
+            existing = next(
+                (row for row in self.tables[name] if _text(row.get(on_conflict)) == _text(values.get(on_conflict))),
+                None
+            )
+            if existing is None:
+                written.extend(self._insert(name, [values]))
+            else:
+                existing.update(values)
+                written.append(existing)
+        return written
+
+    def _written(self, request, name, rows, status):
+        if 'return=representation' not in request.headers.get('prefer', ''):
+            return httpx.Response(status, headers={'content-range': '*/*'})
+        select = request.url.params.get('select', '*')
+        return self._respond(request, [self._select(name, row, select) for row in rows], status)
+
+    @staticmethod
+    def _respond(request, rows, status=200):
+        headers = {'content-range': f'0-{len(rows) - 1}/*' if rows else '*/*'}
+        if request.headers.get('accept') == 'application/vnd.pgrst.object+json':
+            if len(rows) != 1:
+                return _error(406, 'PGRST116', f'The result contains {len(rows)} rows')
+            return httpx.Response(status, json=rows[0], headers=headers)
+        if request.method == 'HEAD':
+            return httpx.Response(status, headers=headers)
+        return httpx.Response(status, json=rows, headers=headers)
+
+
+def _sort_key(value):
+    return (0, value) if isinstance(value, (int, float)) and not isinstance(value, bool) else (1, _text(value))
+
+
+class _Error(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def _error(status, code, message):
+    return httpx.Response(status, json={'code': code, 'message': message, 'details': None, 'hint': None})
@@ -0,0 +1,85 @@
+import pytest
+
+import batching
+import pagination
+from balances import balance_store
+
+
+def seed_loan(postgrest, balance):
+    postgrest.seed(
+        loans=[{
+            'id': 'loan-1', 'monthly_payment': 200, 'loan_amount': 1200, 'interest_rate': 0.12,
+            'borrower_id': 'borrower-1', 'organisation_id': 'org-1', 'remaining_payments': 6
+        }],
+        loan_requests=[{'id': 'loan-1', 'method': 'amortisation'}],
+        loan_balances=[{'loan_id': 'loan-1', 'balance': balance}],
+        loan_repayments=[]
+    )
+
+
+def test_settlement_reads_the_balance_another_worker_changed(postgrest, pay_manager):
+    seed_loan(postgrest, 1000)
+    assert balance_store.get('loan-1') == 1000  # now cached in this process
+
+    # Another worker settles a repayment within BALANCE_CACHE_TTL
+    postgrest.tables['loan_balances'][0]['balance'] = 810
+
+    successful, failed = pay_manager.settle_loans(['loan-1'], 'payment-1')
+
+    assert failed == []
+    assert [loan['loan_id'] for loan in successful] == ['loan-1']
+    repayment = postgrest.tables['loan_repayments'][0]
+    assert repayment['interest_component'] == 8.1
+    assert repayment['balance'] == 618.1
+
+
+def test_display_reads_stay_cached(postgrest):
+    seed_loan(postgrest, 1000)
+    assert balance_store.get('loan-1') == 1000
+
+    postgrest.tables['loan_balances'][0]['balance'] = 810
+
+    assert balance_store.get('loan-1') == 1000
+    assert balance_store.get('loan-1', fresh=True) == 810
+    assert balance_store.get('loan-1') == 810
+
+
+def seed_history(postgrest, loan_count, repayments_per_loan):
+    """Repayments whose balance is their month number, so each loan's latest balance is repayments_per_loan."""
+    postgrest.seed(loan_repayments=[
+        {'id': f'repayment-{number}-{month}', 'loan_id': f'loan-{number}', 'balance': month,
+         'created_at': f'2025-{month:02d}-01T00:00:00'}
+        for month in range(repayments_per_loan, 0, -1)
+        for number in range(loan_count)
+    ])
+    return [f'loan-{number}' for number in range(loan_count)]
+
+
+@pytest.mark.parametrize('rpc_deployed', [True, False])
+def test_falls_back_to_history_before_the_migration(postgrest, monkeypatch, rpc_deployed):
+    if not rpc_deployed:
+        postgrest.functions.pop('latest_loan_balances')
+    # Small pages and chunks, so the fallback has to page through several of each
+    monkeypatch.setattr(pagination, 'PAGE_SIZE', 4)
+    monkeypatch.setattr(batching, 'IN_FILTER_MAX_BYTES', 30)
+    loan_ids = seed_history(postgrest, loan_count=5, repayments_per_loan=3)
+
+    assert balance_store.get_many(loan_ids, fresh=True) == {loan_id: 3 for loan_id in loan_ids}
+
+    history_reads = [call for call in postgrest.calls if call[1] == 'loan_repayments']
+    assert bool(history_reads) != rpc_deployed
+
+
+def test_verify_repairs_balances_that_disagree_with_history(postgrest, monkeypatch):
+    monkeypatch.setattr(batching, 'IN_FILTER_MAX_BYTES', 30)
+    loan_ids = seed_history(postgrest, loan_count=5, repayments_per_loan=2)
+    postgrest.seed(loan_balances=[{'loan_id': loan_id, 'balance': 2} for loan_id in loan_ids[:4]])
+    postgrest.tables['loan_balances'][0]['balance'] = 7
+
+    report = balance_store.verify(loan_ids)
+
+    assert report['mismatched'] == {'loan-0': (7, 2), 'loan-4': (None, 2)}
+    assert report['repaired'] == 2
+    assert {row['loan_id']: row['balance'] for row in postgrest.tables['loan_balances']} == {
+        loan_id: 2 for loan_id in loan_ids
+    }
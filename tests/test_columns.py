@@ -0,0 +1,147 @@
+"""
+Every ColumnSet call site, run against whole rows with COLUMN_AUDIT on: each
+declared column must be read (unread() is empty) and nothing outside the
+declaration may be read, or it would be missing from the real, projected rows.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import columns
+from borrowers import Borrowers
+from fake_supabase import _Error
+from loans import Loans
+
+ORGANISATION_ID = 'org-1'
+
+# Columns no call site selects, so reading one would be a bug the projection hides
+EXTRA = {'notes': 'not selected', 'updated_at': '2024-01-01T00:00:00+00:00'}
+
+
+def loan(loan_id, created_at):
+    return dict(
+        EXTRA, id=loan_id, created_at=created_at, term_months=6, monthly_payment=200, loan_amount=1000,
+        interest_rate=0.12, borrower_id=f'borrower-{loan_id}', organisation_id=ORGANISATION_ID,
+        remaining_payments=6, status='active'
+    )
+
+
+def borrower(loan_id):
+    return dict(
+        EXTRA, id=f'borrower-{loan_id}', first_name='Mwila', last_name='Banda', nrc_number='123456/10/1',
+        phone='260970000000', email='mwila@example.com', date_of_birth='1990-01-01'
+    )
+
+
+def repayment(loan_id, created_at):
+    return dict(
+        EXTRA, loan_id=loan_id, created_at=created_at, borrower_id=f'borrower-{loan_id}',
+        organisation_id=ORGANISATION_ID, payment_amount=200, principal_component=190,
+        interest_component=10, balance=810, payment_status='complete'
+    )
+
+
+@pytest.fixture
+def full_rows(postgrest, monkeypatch):
+    """Seeds two loans with a repayment each; the fake returns whole rows whatever is selected."""
+    postgrest.project = False
+    monkeypatch.setattr(columns, 'COLUMN_AUDIT', True)
+
+    created = (datetime.now() - timedelta(days=40)).isoformat()
+    paid = (datetime.now() - timedelta(days=5)).isoformat()
+    postgrest.seed(
+        loans=[loan('loan-1', created), loan('loan-2', created)],
+        loan_requests=[{'id': 'loan-1', 'method': 'amortisation'}, {'id': 'loan-2', 'method': 'simple'}],
+        loan_balances=[{'loan_id': 'loan-1', 'balance': 810}],
+        loan_repayments=[repayment('loan-1', paid), repayment('loan-2', paid)],
+        borrowers=[borrower('loan-1'), borrower('loan-2')]
+    )
+    return postgrest
+
+
+def audited(monkeypatch, *column_sets):
+    for column_set in column_sets:
+        monkeypatch.setattr(column_set, '_read', set())
+    return column_sets
+
+
+def assert_reads_exactly_declared(*column_sets):
+    for column_set in column_sets:
+        assert column_set.unread() == [], column_set.name
+        assert column_set._read <= set(column_set.columns), column_set.name
+
+
+def test_covers_every_column_set():
+    audited_here = {
+        columns.SCHEDULE_LOANS, columns.PAID_MONTH_REPAYMENTS, columns.REPAYMENT_SUMMARY_LOANS,
+        columns.REPAYMENT_SUMMARY_REPAYMENTS, columns.SETTLEMENT_LOANS, columns.REPAYMENT_LOANS,
+        columns.BORROWERS
+    }
+    assert set(columns.COLUMN_SETS) == audited_here
+
+
+def test_schedule_source(full_rows, monkeypatch):
+    column_sets = audited(monkeypatch, columns.SCHEDULE_LOANS, columns.PAID_MONTH_REPAYMENTS)
+
+    # Both consumers of the schedule inputs: the status engine and the month index
+    loans = Loans()
+    statuses = loans.generate_payment_status(ORGANISATION_ID)
+    month = (datetime.now() + timedelta(days=31)).strftime('%Y-%m')
+    loans.get_month_index(ORGANISATION_ID).upcoming_loans(month)
+
+    assert set(statuses) == {'loan-1', 'loan-2'}
+    assert_reads_exactly_declared(*column_sets)
+
+
+def test_monthly_loan_repayments(full_rows, monkeypatch):
+    column_sets = audited(monkeypatch, columns.REPAYMENT_SUMMARY_LOANS, columns.REPAYMENT_SUMMARY_REPAYMENTS)
+
+    summary = Loans().get_monthly_loan_repayments(ORGANISATION_ID)
+
+    assert sum(len(rows) for rows in summary.values()) == 2
+    assert_reads_exactly_declared(*column_sets)
+
+
+def test_record_repayment(full_rows, pay_manager, monkeypatch):
+    column_sets = audited(monkeypatch, columns.REPAYMENT_LOANS)
+
+    assert pay_manager.record_repayment('loan-1')['success']
+    assert_reads_exactly_declared(*column_sets)
+
+
+def test_settle_loans(full_rows, pay_manager, monkeypatch):
+    column_sets = audited(monkeypatch, columns.SETTLEMENT_LOANS)
+
+    successful, failed = pay_manager.settle_loans(['loan-1', 'loan-2'], 'payment-1')
+
+    assert failed == []
+    assert len(successful) == 2
+    assert_reads_exactly_declared(*column_sets)
+
+
+def test_borrowers_for_month(full_rows, monkeypatch):
+    column_sets = audited(monkeypatch, columns.BORROWERS)
+
+    month = (datetime.now() + timedelta(days=31)).strftime('%Y-%m')
+    details = Loans().get_borrower_payment_details_for_month(ORGANISATION_ID, month)
+
+    assert {row['loan_id'] for row in details} == {'loan-1', 'loan-2'}
+    assert_reads_exactly_declared(*column_sets)
+
+
+@pytest.mark.parametrize('embedded', [True, False])
+def test_borrowers_by_loans_fetch_only_declared_columns(full_rows, embedded, monkeypatch):
+    full_rows.project = True
+    if not embedded:
+        # Without a loans -> borrowers foreign key the lookup falls back to borrower IDs
+        def no_relationship(table, row, name, select):
+            raise _Error(400, 'PGRST200', f"Could not find a relationship between '{table}' and '{name}'")
+
+        monkeypatch.setattr(full_rows, '_embed', no_relationship)
+
+    borrowers = Borrowers().get_borrowers_by_loans(['loan-1', 'loan-2'])
+
+    assert set(borrowers) == {'loan-1', 'loan-2'}
+    assert (('GET', 'borrowers') in full_rows.calls) == (not embedded)
+    for row in borrowers.values():
+        assert set(row) == set(columns.BORROWERS.columns)
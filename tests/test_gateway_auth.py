@@ -0,0 +1,132 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+import requests
+
+import pay
+from tumeny import TumenyTokenManager
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    """A fresh token manager whose fetches hand out token-1, token-2, ..."""
+    fetched = []
+
+    def fetch():
+        fetched.append(f'token-{len(fetched) + 1}')
+        return fetched[-1], datetime.now() + timedelta(hours=1)
+
+    manager = TumenyTokenManager(fetcher=fetch)
+    monkeypatch.setattr(pay, 'token_manager', manager)
+    manager.fetched = fetched
+    return manager
+
+
+class Gateway:
+    """Stands in for the TuMeNy transports: 401 for every token in `revoked`, otherwise `body`."""
+
+    def __init__(self, body, revoked=()):
+        self.body = body
+        self.revoked = set(revoked)
+        self.sent = []  # the bearer token of every request
+
+    def respond(self, headers, as_httpx):
+        token = headers['Authorization'].removeprefix('Bearer ')
+        self.sent.append(token)
+        status = 401 if token in self.revoked else 200
+        if as_httpx:
+            return httpx.Response(status, json=self.body, request=httpx.Request('GET', 'https://tumeny.test'))
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(self.body).encode()
+        return response
+
+    def install(self, monkeypatch):
+        def sync_send(endpoint, path, headers=None, **kwargs):
+            return self.respond(headers, as_httpx=False)
+
+        async def async_send(endpoint, path, headers=None, **kwargs):
+            return self.respond(headers, as_httpx=True)
+
+        for method in ('get', 'post'):
+            monkeypatch.setattr(pay.transport, method, sync_send)
+            monkeypatch.setattr(pay.async_transport, method, async_send)
+        return self
+
+
+def check(pay_manager, payment_id):
+    result = pay_manager.check_payment_status(payment_id)
+    return asyncio.run(result) if asyncio.iscoroutine(result) else result
+
+
+def initiate(pay_manager):
+    result = pay_manager.initiate_payment('0970000000', 200, 0, 'August 2025', 'loan-1', 'Org', 'org@example.com')
+    return asyncio.run(result) if asyncio.iscoroutine(result) else result
+
+
+@pytest.fixture(params=['sync', 'async'])
+def gateway_client(request, pay_manager, tokens):
+    if request.param == 'async':
+        return pay_manager
+    client = pay.Pay.__new__(pay.Pay)
+    client._load_config()
+    return client
+
+
+def test_revoked_token_is_dropped_and_the_check_retried_once(gateway_client, tokens, monkeypatch):
+    tokens.get_token()
+    gateway = Gateway({'payment': {'status': 'SUCCESS'}}, revoked={'token-1'}).install(monkeypatch)
+
+    assert check(gateway_client, 'payment-1') == {'status': 'success', 'completed': True}
+    assert gateway.sent == ['token-1', 'token-2']
+    assert tokens.stats()['invalidations'] == 1
+
+    # The new token is cached for the next request
+    check(gateway_client, 'payment-1')
+    assert gateway.sent[-1] == 'token-2'
+    assert tokens.fetched == ['token-1', 'token-2']
+
+
+def test_revoked_token_is_dropped_and_the_payment_retried_once(gateway_client, tokens, monkeypatch):
+    tokens.get_token()
+    gateway = Gateway({'id': 'payment-1'}, revoked={'token-1'}).install(monkeypatch)
+
+    assert initiate(gateway_client) == {'id': 'payment-1'}
+    assert gateway.sent == ['token-1', 'token-2']
+
+
+def test_only_one_retry(gateway_client, tokens, monkeypatch):
+    gateway = Gateway({'payment': {'status': 'SUCCESS'}}, revoked={'token-1', 'token-2', 'token-3', 'token-4'})
+    gateway.install(monkeypatch)
+
+    assert check(gateway_client, 'payment-1')['status'] == 'error'
+    assert initiate(gateway_client)['error'] == 401
+    assert gateway.sent == ['token-1', 'token-2', 'token-3', 'token-4']
+
+
+def test_no_token_sends_nothing(gateway_client, tokens, monkeypatch):
+    monkeypatch.setattr(tokens, '_fetcher', lambda: (None, None))
+    gateway = Gateway({'payment': {'status': 'SUCCESS'}}).install(monkeypatch)
+
+    assert check(gateway_client, 'payment-1') == {'status': 'error', 'completed': True, 'reason': 'auth_failed'}
+    assert initiate(gateway_client)['error'] == 'auth_failed'
+    assert gateway.sent == []
+
+
+def test_invalidate_clears_the_shared_file_only_for_the_rejected_token(tmp_path):
+    cache_file = tmp_path / 'token.json'
+    fetched = iter(['token-1', 'token-2'])
+    manager = TumenyTokenManager(cache_file=str(cache_file),
+                                 fetcher=lambda: (next(fetched), datetime.now() + timedelta(hours=1)))
+    manager.get_token()
+
+    # Another worker already replaced the token: the file is left alone
+    manager.invalidate('token-0')
+    assert json.loads(cache_file.read_text())['token'] == 'token-1'
+
+    manager.invalidate('token-1')
+    assert not cache_file.exists()
+    assert manager.get_token()[0] == 'token-2'
@@ -0,0 +1,29 @@
+import json
+import logging
+
+from logs import REDACTED, JsonFormatter
+
+
+def formatted(**extra):
+    record = logging.LogRecord('bridgetrust.tumeny.gateway', logging.DEBUG, __file__, 1, 'Sending payment request', (), None)
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return json.loads(JsonFormatter().format(record))
+
+
+def test_payment_payload_personal_data_is_redacted():
+    entry = formatted(
+        headers={'Authorization': 'Bearer abc123'},
+        payload={'phoneNumber': '0970000000', 'email': 'org@example.com', 'amount': 200}
+    )
+
+    assert entry['headers']['Authorization'] == REDACTED
+    assert entry['payload'] == {'phoneNumber': REDACTED, 'email': REDACTED, 'amount': 200}
+
+
+def test_personal_data_in_serialised_json_is_redacted():
+    entry = formatted(body='{"phoneNumber": "0970000000", "email": "org@example.com", "status": "PENDING"}')
+
+    assert '0970000000' not in entry['body']
+    assert 'org@example.com' not in entry['body']
+    assert '"status": "PENDING"' in entry['body']
@@ -0,0 +1,110 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from flask import Flask, abort, redirect
+
+import metrics
+from metrics import REQUEST_DURATION, MetricsStore, instrument_view
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """A process-local MetricsStore that every histogram records into."""
+    store = MetricsStore(directory='')
+    monkeypatch.setattr(metrics, 'store', store)
+    return store
+
+
+def errors(store, rule):
+    return {
+        labels[1]: values[-1]
+        for (name, labels), values in store.collect().items()
+        if name == REQUEST_DURATION.name and labels[0] == rule
+    }
+
+
+@pytest.mark.parametrize('is_async', [False, True])
+@pytest.mark.parametrize('raise_status, is_error', [(404, False), (403, False), (500, True), (503, True)])
+def test_raised_http_errors_count_only_when_5xx(store, is_async, raise_status, is_error):
+    if is_async:
+        async def view():
+            abort(raise_status)
+    else:
+        def view():
+            abort(raise_status)
+
+    app = Flask(__name__)
+    app.add_url_rule('/raise', view_func=instrument_view('/raise', view))
+
+    assert app.test_client().get('/raise').status_code == raise_status
+    assert errors(store, '/raise') == {'GET': int(is_error)}
+
+
+def test_redirects_and_failures(store):
+    def moved():
+        return redirect('/elsewhere')
+
+    def broken():
+        raise RuntimeError('boom')
+
+    app = Flask(__name__)
+    app.add_url_rule('/moved', view_func=instrument_view('/moved', moved))
+    app.add_url_rule('/broken', view_func=instrument_view('/broken', broken))
+    client = app.test_client()
+
+    assert client.get('/moved').status_code == 302
+    assert client.get('/broken').status_code == 500
+    assert errors(store, '/moved') == {'GET': 0}
+    assert errors(store, '/broken') == {'GET': 1}
+
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_worker_file(directory, name, count):
+    rows = [[REQUEST_DURATION.name, ['/home', 'GET'], [count] + [0] * len(REQUEST_DURATION.buckets) + [0.1, 0]]]
+    (directory / name).write_text(json.dumps(rows))
+
+
+def request_count(store):
+    return sum(values[0] for (name, labels), values in store.collect().items() if labels == ('/home', 'GET'))
+
+
+@pytest.mark.skipif(metrics.fcntl is None, reason='archiving needs POSIX file locks')
+def test_exited_workers_are_archived(tmp_path):
+    dead = exited_pid()
+    write_worker_file(tmp_path, f'{dead}-a1.json', 2)
+    write_worker_file(tmp_path, f'{dead}-b2.json', 3)
+    # An earlier process that had this worker's pid
+    write_worker_file(tmp_path, f'{os.getpid()}-c3.json', 5)
+    # A worker that is still running
+    write_worker_file(tmp_path, f'{os.getppid()}-d4.json', 7)
+    write_worker_file(tmp_path, metrics.ARCHIVE_FILE, 11)
+
+    store = MetricsStore(directory=str(tmp_path), flush_interval=3600)
+    store.observe(REQUEST_DURATION, ('/home', 'GET'), 0.001)
+
+    remaining = sorted(path.name for path in tmp_path.glob('*.json'))
+    assert remaining == sorted([metrics.ARCHIVE_FILE, f'{os.getppid()}-d4.json'])
+    assert request_count(store) == 2 + 3 + 5 + 7 + 11 + 1
+    assert os.path.exists(store._path())
+
+
+@pytest.mark.skipif(metrics.fcntl is None, reason='archiving needs POSIX file locks')
+def test_recycled_pid_does_not_overwrite_an_earlier_worker(tmp_path):
+    first = MetricsStore(directory=str(tmp_path), flush_interval=3600)
+    first.observe(REQUEST_DURATION, ('/home', 'GET'), 0.001)
+    first.flush()
+
+    # The same pid in a new process: a fresh token, so the first worker's file is archived, not replaced
+    second = MetricsStore(directory=str(tmp_path), flush_interval=3600)
+    second.observe(REQUEST_DURATION, ('/home', 'GET'), 0.001)
+
+    assert first._path() != second._path()
+    assert request_count(second) == 2
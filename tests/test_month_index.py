@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime
+
+import pytest
+
+from cache import schedule_cache
+from loans import Loans, month_index_key
+from schedule import MonthIndex
+
+ORGANISATION_ID = 'org-1'
+
+
+def loan(loan_id, created_at='2025-01-10T09:00:00', term_months=3, remaining_payments=3):
+    return {
+        'id': loan_id, 'created_at': created_at, 'term_months': term_months, 'monthly_payment': 200,
+        'borrower_id': f'borrower-{loan_id}', 'organisation_id': ORGANISATION_ID,
+        'remaining_payments': remaining_payments
+    }
+
+
+def test_add_and_remove_in_place():
+    index = MonthIndex([loan('loan-1')])
+    assert set(index.loans_due('2025-02')) == {'loan-1'}
+
+    index.add_loan(loan('loan-2', created_at='2025-03-05T09:00:00'))
+    assert set(index.loans_due('2025-03')) == {'loan-1'}
+    assert set(index.loans_due('2025-04')) == {'loan-1', 'loan-2'}
+
+    # Re-adding re-indexes: a shorter term drops the later months
+    index.add_loan(loan('loan-1', term_months=1))
+    assert set(index.loans_due('2025-03')) == set()
+    assert set(index.loans_due('2025-02')) == {'loan-1'}
+
+    index.remove_loan('loan-1')
+    index.remove_loan('loan-404')
+    assert index.loans_due('2025-02') == {}
+    assert set(index.loans_due('2025-04')) == {'loan-2'}
+
+
+def test_completed_loans_are_not_indexed():
+    index = MonthIndex([loan('loan-1', remaining_payments=0), loan('loan-2')])
+    assert set(index.loans_due('2025-02')) == {'loan-2'}
+
+
+def test_readers_keep_a_consistent_month_while_writers_change_it():
+    index = MonthIndex([loan(f'loan-{number}') for number in range(50)])
+    stop = threading.Event()
+
+    def churn():
+        while not stop.is_set():
+            for number in range(50, 60):
+                index.add_loan(loan(f'loan-{number}'))
+            for number in range(50, 60):
+                index.remove_loan(f'loan-{number}')
+
+    writer = threading.Thread(target=churn)
+    writer.start()
+    try:
+        for _ in range(2000):
+            # Iterating a month while another thread writes must never fail
+            assert len(index.upcoming_loans('2025-02', today=datetime(2025, 1, 15))) in range(50, 61)
+    finally:
+        stop.set()
+        writer.join()
+
+
+@pytest.mark.parametrize('rpc_deployed', [True, False])
+def test_settling_the_last_payment_removes_the_loan_from_the_cached_index(postgrest, pay_manager, rpc_deployed):
+    if not rpc_deployed:
+        postgrest.functions.clear()
+    postgrest.seed(
+        loans=[dict(loan('loan-1', remaining_payments=1), loan_amount=600, interest_rate=0.12),
+               dict(loan('loan-2'), loan_amount=600, interest_rate=0.12)],
+        loan_requests=[{'id': 'loan-1', 'method': 'simple'}, {'id': 'loan-2', 'method': 'simple'}],
+        loan_balances=[],
+        loan_repayments=[]
+    )
+    month_index = Loans().get_month_index(ORGANISATION_ID)
+    assert set(month_index.loans_due('2025-02')) == {'loan-1', 'loan-2'}
+
+    pay_manager.settle_loans(['loan-1', 'loan-2'], 'payment-1')
+
+    # The same cached index, updated in place rather than dropped
+    assert schedule_cache.get(month_index_key(ORGANISATION_ID)) is month_index
+    assert set(month_index.loans_due('2025-02')) == {'loan-2'}
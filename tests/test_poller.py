@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import poller
+from ledger import settlement_ledger
+from poller import PaymentStatusPoller
+
+
+class Gateway:
+    """Stands in for resolve_payment; records which poller checked the gateway."""
+
+    def __init__(self, monkeypatch, status='pending'):
+        self.status = status
+        self.checks = []
+        monkeypatch.setattr(poller, 'resolve_payment', self.resolve)
+
+    def resolve(self, payment_id, loan_ids, total_amount):
+        self.checks.append(payment_id)
+        result = {'status': self.status}
+        if self.status == 'failed':
+            settlement_ledger.record_outcome(payment_id, result)
+        return result
+
+
+def worker(owner, lease_ttl=60):
+    """A poller as another gunicorn worker would have it, driven by calling _poll directly."""
+    payment_poller = PaymentStatusPoller(initial_delay=1, max_age=600)
+    payment_poller._owner = owner
+    payment_poller.lease_ttl = lease_ttl
+    return payment_poller
+
+
+def poll(payment_poller, payment_id='payment-1'):
+    entry = payment_poller._pending.setdefault(payment_id, {
+        'loan_ids': ['loan-1'], 'total_amount': '200', 'registered_at': time.monotonic(), 'attempts': 0
+    })
+    payment_poller._poll(payment_id, entry)
+
+
+def test_lease_is_held_by_one_owner_until_it_expires():
+    assert settlement_ledger.lease_poll('payment-1', 'worker-a', ttl=60)
+    assert not settlement_ledger.lease_poll('payment-1', 'worker-b', ttl=60)
+    # Renewal by the holder
+    assert settlement_ledger.lease_poll('payment-1', 'worker-a', ttl=-1)
+
+    # Expired: another worker takes it over
+    assert settlement_ledger.lease_poll('payment-1', 'worker-b', ttl=60)
+    assert not settlement_ledger.lease_poll('payment-1', 'worker-a', ttl=60)
+
+    settlement_ledger.release_poll('payment-1', 'worker-a')
+    assert not settlement_ledger.lease_poll('payment-1', 'worker-a', ttl=60)
+    settlement_ledger.release_poll('payment-1', 'worker-b')
+    assert settlement_ledger.lease_poll('payment-1', 'worker-a', ttl=60)
+
+
+def test_only_the_lease_holder_polls_the_gateway(monkeypatch):
+    gateway = Gateway(monkeypatch)
+    workers = [worker(f'worker-{number}') for number in range(4)]
+
+    for _ in range(3):
+        for payment_poller in workers:
+            poll(payment_poller)
+
+    assert gateway.checks == ['payment-1'] * 3
+    assert all(payment_poller.is_tracking('payment-1') for payment_poller in workers)
+
+    # The holder records the outcome; the others read it from the ledger and stop
+    gateway.status = 'failed'
+    for payment_poller in workers:
+        poll(payment_poller)
+
+    assert gateway.checks == ['payment-1'] * 4
+    assert not any(payment_poller.is_tracking('payment-1') for payment_poller in workers)
+    # Released, so the lease table does not grow with settled payments
+    assert settlement_ledger.lease_poll('payment-1', 'worker-9', ttl=60)
+
+
+def test_another_worker_takes_over_an_expired_lease(monkeypatch):
+    gateway = Gateway(monkeypatch)
+    # Its lease lapses at once, as if the worker had died after polling
+    dead, survivor = worker('dead', lease_ttl=-1), worker('survivor')
+
+    poll(dead)
+    poll(survivor)
+
+    assert gateway.checks == ['payment-1'] * 2
+
+
+@pytest.mark.parametrize('leased', [True, False])
+def test_only_the_lease_holder_records_a_timeout(monkeypatch, leased):
+    Gateway(monkeypatch)
+    if not leased:
+        settlement_ledger.lease_poll('payment-1', 'other-worker', ttl=60)
+    payment_poller = worker('worker-a')
+    payment_poller.max_age = 0
+
+    poll(payment_poller)
+
+    assert not payment_poller.is_tracking('payment-1')
+    entry = settlement_ledger.get('payment-1')
+    assert (entry is not None and entry['result']['reason'] == 'timeout') == leased
@@ -0,0 +1,94 @@
+"""Query budgets of the routes that must not grow with the organisation or the payment."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from pay import AsyncPay
+from poller import payment_poller
+from tracing import count_queries, query_budget
+
+ORGANISATION_ID = 'org-1'
+
+
+def seed_loans(postgrest, count):
+    """Seeds `count` loans of one organisation, each with a borrower and a repayment due next month."""
+    created = (datetime.now() - timedelta(days=40)).isoformat()
+    loan_ids = [f'loan-{number}' for number in range(count)]
+    postgrest.seed(
+        loans=[{
+            'id': loan_id, 'created_at': created, 'term_months': 6, 'monthly_payment': 200,
+            'loan_amount': 1000, 'interest_rate': 0.12, 'borrower_id': f'borrower-{loan_id}',
+            'organisation_id': ORGANISATION_ID, 'remaining_payments': 6
+        } for loan_id in loan_ids],
+        borrowers=[{
+            'id': f'borrower-{loan_id}', 'first_name': 'Mwila', 'last_name': 'Banda',
+            'nrc_number': '123456/10/1', 'phone': '260970000000'
+        } for loan_id in loan_ids],
+        loan_requests=[{'id': loan_id, 'method': 'amortisation'} for loan_id in loan_ids],
+        loan_balances=[],
+        loan_repayments=[]
+    )
+    return loan_ids
+
+
+@pytest.fixture
+def client(postgrest, pay_manager, monkeypatch):
+    """A test client logged in to ORGANISATION_ID, with the payment poller and cache warm-up off."""
+    monkeypatch.setattr(main, 'warm_organisation_cache', lambda: None)
+    monkeypatch.setattr(payment_poller, 'enabled', False)
+
+    client = main.create_app().test_client()
+    with client.session_transaction() as session:
+        session['organisation_id'] = ORGANISATION_ID
+    return client
+
+
+@pytest.fixture
+def gateway_confirms(monkeypatch):
+    """Every payment checked with TuMeNy comes back successful."""
+    async def check_payment_status(self, payment_id):
+        return {'status': 'success'}
+
+    monkeypatch.setattr(AsyncPay, 'check_payment_status', check_payment_status)
+
+
+@pytest.mark.parametrize('loan_count', [1, 40])
+def test_staff_breakdown_stays_within_three_queries(postgrest, client, loan_count):
+    seed_loans(postgrest, loan_count)
+    month = (datetime.now() + timedelta(days=31)).strftime('%Y-%m')
+
+    with query_budget(3):
+        response = client.get(f'/staff_breakdown/{month}')
+
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).count('Mwila') == loan_count
+
+
+def test_check_payment_status_is_constant_in_the_number_of_loans(postgrest, client, gateway_confirms):
+    loan_ids = seed_loans(postgrest, 25)
+
+    counts = {}
+    for payment_id, paid in (('payment-one', loan_ids[:1]), ('payment-many', loan_ids)):
+        with count_queries() as count:
+            response = client.get(
+                f'/check_payment_status/{payment_id}',
+                query_string={'loan_ids': ','.join(paid), 'total_amount': '200'}
+            )
+        result = response.get_json()
+        assert result['status'] == 'success'
+        assert len(result['successful_loans']) == len(paid)
+        counts[len(paid)] = count.calls
+
+    assert counts[1] == counts[len(loan_ids)], counts
+
+
+def test_settled_payments_are_answered_without_queries(postgrest, client, gateway_confirms):
+    loan_ids = seed_loans(postgrest, 3)
+    query_string = {'loan_ids': ','.join(loan_ids), 'total_amount': '600'}
+    client.get('/check_payment_status/payment-1', query_string=query_string)
+
+    with query_budget(0):
+        response = client.get('/check_payment_status/payment-1', query_string=query_string)
+
+    assert response.get_json()['status'] == 'success'
@@ -0,0 +1,90 @@
+import pytest
+
+ORGANISATION_ID = 'org-1'
+
+
+def loan(loan_id, remaining_payments):
+    return {'id': loan_id, 'remaining_payments': remaining_payments, 'organisation_id': ORGANISATION_ID}
+
+
+def remaining(postgrest, loan_id):
+    return next(row['remaining_payments'] for row in postgrest.tables['loans'] if row['id'] == loan_id)
+
+
+@pytest.fixture(params=['rpc', 'fallback'])
+def rpc_mode(request, postgrest):
+    """Runs a test against the deployed RPC functions and against the fallback used before the migration."""
+    if request.param == 'fallback':
+        postgrest.functions.clear()
+    return request.param
+
+
+def test_decrements_to_zero_then_refuses(postgrest, pay_manager, rpc_mode):
+    postgrest.seed(loans=[loan('loan-1', 1)])
+
+    ok, rows = pay_manager.reduce_remaining_payments('loan-1')
+    assert ok
+    assert rows[0]['remaining_payments'] == 0
+    assert remaining(postgrest, 'loan-1') == 0
+
+    ok, message = pay_manager.reduce_remaining_payments('loan-1')
+    assert not ok
+    assert 'loan-1' in message
+    assert remaining(postgrest, 'loan-1') == 0
+
+
+def test_never_goes_below_zero(postgrest, pay_manager, rpc_mode):
+    postgrest.seed(loans=[loan('loan-1', 0), loan('loan-2', -1)])
+
+    assert not pay_manager.reduce_remaining_payments('loan-1')[0]
+    assert not pay_manager.reduce_remaining_payments('loan-2')[0]
+    assert pay_manager.reduce_remaining_payments_batch(['loan-1', 'loan-2']) == {}
+    assert remaining(postgrest, 'loan-1') == 0
+    assert remaining(postgrest, 'loan-2') == -1
+
+
+def test_missing_loan_is_not_decremented(postgrest, pay_manager, rpc_mode):
+    postgrest.seed(loans=[loan('loan-1', 2)])
+
+    assert not pay_manager.reduce_remaining_payments('loan-404')[0]
+    assert pay_manager.reduce_remaining_payments_batch(['loan-404', 'loan-1']) == {'loan-1': 1}
+
+
+def test_batch_decrements_once_per_occurrence(postgrest, pay_manager, rpc_mode):
+    postgrest.seed(loans=[loan('loan-1', 3), loan('loan-2', 5)])
+
+    decremented = pay_manager.reduce_remaining_payments_batch(['loan-1', 'loan-2', 'loan-1'])
+
+    assert decremented == {'loan-1': 2, 'loan-2': 1}
+    assert remaining(postgrest, 'loan-1') == 1
+    assert remaining(postgrest, 'loan-2') == 4
+
+
+def test_batch_duplicates_clamp_at_zero(postgrest, pay_manager, rpc_mode):
+    postgrest.seed(loans=[loan('loan-1', 1)])
+
+    assert pay_manager.reduce_remaining_payments_batch(['loan-1', 'loan-1', 'loan-1']) == {'loan-1': 1}
+    assert remaining(postgrest, 'loan-1') == 0
+
+
+def test_falls_back_only_when_the_function_is_missing(postgrest, pay_manager):
+    postgrest.seed(loans=[loan('loan-1', 2)])
+    postgrest.functions.clear()
+
+    assert pay_manager.reduce_remaining_payments_batch(['loan-1']) == {'loan-1': 1}
+    assert ('POST', 'rpc/decrement_remaining_payments_batch') in postgrest.calls
+    assert ('PATCH', 'loans') in postgrest.calls
+    assert remaining(postgrest, 'loan-1') == 1
+
+
+def test_other_rpc_errors_do_not_fall_back(postgrest, pay_manager):
+    postgrest.seed(loans=[loan('loan-1', 2)])
+
+    def broken(db, p_loan_ids):
+        raise ValueError('boom')
+
+    postgrest.functions['decrement_remaining_payments_batch'] = broken
+
+    assert pay_manager.reduce_remaining_payments_batch(['loan-1']) == {}
+    assert ('PATCH', 'loans') not in postgrest.calls
+    assert remaining(postgrest, 'loan-1') == 2
@@ -0,0 +1,145 @@
+"""The schedule engine against the per-loan relativedelta/strftime loop it replaced."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from schedule import MonthIndex, build_payment_status
+
+relativedelta = pytest.importorskip('dateutil.relativedelta').relativedelta
+
+ORGANISATION_ID = 'org-1'
+
+
+def reference_statuses(loans, payments_by_month, today):
+    """The loop in Loans.generate_payment_status before the engine, one loan and month at a time."""
+    result = {}
+    for loan in loans:
+        created_at = datetime.fromisoformat(loan['created_at'])
+        start_date = created_at + relativedelta(months=1)
+        loan_status = {}
+        for i in range(loan['term_months']):
+            due_date = start_date + relativedelta(months=i)
+            month_key = due_date.strftime("%Y-%m")
+            if due_date > today:
+                status = "Upcoming"
+            elif month_key in payments_by_month.get(loan['id'], set()):
+                status = "Paid"
+            else:
+                status = "Missed"
+            loan_status[month_key] = status
+        result[loan['id']] = loan_status
+    return result
+
+
+def make_loans():
+    """Loans created on month-end and ordinary days across a leap year and a year end, at several times of day."""
+    loans = []
+    for month in range(12):
+        year, month = 2023 + (11 + month) // 12, (11 + month) % 12 + 1
+        for day in (1, 15, 28, 29, 30, 31):
+            for time_of_day in ('00:00:00', '09:30:15', '23:59:59'):
+                try:
+                    created_at = datetime.fromisoformat(f'{year}-{month:02d}-{day:02d}T{time_of_day}')
+                except ValueError:
+                    continue
+                loans.append({
+                    'id': f'loan-{len(loans)}', 'created_at': created_at.isoformat(),
+                    'term_months': len(loans) % 14, 'monthly_payment': 200,
+                    'borrower_id': f'borrower-{len(loans)}'
+                })
+    return loans
+
+
+def paid_every_other_month(loans):
+    """Marks alternate months paid from the first due month, including some not yet due."""
+    paid = {}
+    for loan in loans:
+        first_due = datetime.fromisoformat(loan['created_at']) + relativedelta(months=1)
+        paid[loan['id']] = {
+            (first_due + relativedelta(months=i)).strftime('%Y-%m') for i in range(0, loan['term_months'], 2)
+        }
+    return paid
+
+
+# A loan created on 31 January 2024 at 09:30:15 first falls due on 29 February, then on the 29th
+FIRST_DUE = datetime(2024, 2, 29, 9, 30, 15)
+REFERENCE_DATES = [
+    FIRST_DUE - timedelta(seconds=1), FIRST_DUE, FIRST_DUE + timedelta(seconds=1),
+    datetime(2024, 4, 29, 9, 30, 15), datetime(2024, 4, 30, 0, 0, 0),
+    datetime(2024, 12, 31, 23, 59, 59), datetime(2025, 1, 1, 0, 0, 0),
+    datetime(2025, 2, 28, 12, 0, 0), datetime(2025, 3, 15, 9, 30, 15), datetime(2026, 6, 1, 0, 0, 0),
+]
+
+LOANS = make_loans()
+PAID = paid_every_other_month(LOANS)
+
+
+@pytest.mark.parametrize('today', REFERENCE_DATES, ids=str)
+def test_matches_the_reference_loop(today):
+    expected = reference_statuses(LOANS, PAID, today)
+
+    result = build_payment_status(LOANS, PAID, ORGANISATION_ID, today=today)
+
+    assert {loan_id: entry['payment_status_by_month'] for loan_id, entry in result.items()} == expected
+    assert result['loan-0'] == {
+        'monthly_payment': 200, 'borrower_id': 'borrower-0', 'organisation_id': ORGANISATION_ID,
+        'payment_status_by_month': {}
+    }
+
+
+def test_month_end_clamping_carries_the_first_due_day():
+    loan = {'id': 'loan-1', 'created_at': '2025-01-31T10:00:00', 'term_months': 4}
+
+    statuses = build_payment_status([loan], {}, ORGANISATION_ID, today=datetime(2025, 5, 28, 10, 0, 0))
+
+    # Due 28 Feb, 28 Mar, 28 Apr and 28 May at 10:00, as relativedelta from 28 February gives
+    assert statuses['loan-1']['payment_status_by_month'] == {
+        '2025-02': 'Missed', '2025-03': 'Missed', '2025-04': 'Missed', '2025-05': 'Missed'
+    }
+    assert reference_statuses([loan], {}, datetime(2025, 5, 28, 10, 0, 0)) == {
+        'loan-1': statuses['loan-1']['payment_status_by_month']
+    }
+
+
+@pytest.mark.parametrize('term_months', [0, None])
+def test_loans_without_a_term_have_no_repayments(term_months):
+    loan = {'id': 'loan-1', 'created_at': '2025-01-10T10:00:00', 'term_months': term_months}
+
+    result = build_payment_status([loan], {}, ORGANISATION_ID, today=datetime(2025, 3, 1))
+
+    # The old loop crashed on None (range(None)); both mean no repayments now
+    assert result['loan-1']['payment_status_by_month'] == {}
+    assert MonthIndex([loan]).loans_due('2025-02') == {}
+
+
+@pytest.mark.parametrize('today', REFERENCE_DATES[:3] + REFERENCE_DATES[7:8], ids=str)
+@pytest.mark.parametrize('months, statuses', [
+    (['2024-02', '2024-03'], None),
+    (None, ['Upcoming']),
+    (None, ['Paid', 'Missed']),
+    (['2024-02', '2025-02', '2025-03'], ['Missed']),
+    ([], None),
+])
+def test_filters_match_the_filtered_reference(today, months, statuses):
+    expected = {
+        loan_id: {
+            month: status for month, status in by_month.items()
+            if (months is None or month in months) and (statuses is None or status in statuses)
+        }
+        for loan_id, by_month in reference_statuses(LOANS, PAID, today).items()
+    }
+
+    result = build_payment_status(LOANS, PAID, ORGANISATION_ID, today=today, months=months, statuses=statuses)
+
+    assert {loan_id: entry['payment_status_by_month'] for loan_id, entry in result.items()} == expected
+
+
+@pytest.mark.parametrize('today', REFERENCE_DATES, ids=str)
+def test_month_index_upcoming_loans_match_the_reference_loop(today):
+    expected = reference_statuses(LOANS, PAID, today)
+    index = MonthIndex(LOANS)
+
+    months = {month for by_month in expected.values() for month in by_month}
+    for month in sorted(months):
+        upcoming = {loan_id for loan_id, by_month in expected.items() if by_month.get(month) == 'Upcoming'}
+        assert set(index.upcoming_loans(month, today=today)) == upcoming, month
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+
+import pytest
+
+from cache import SingleFlight
+
+
+def test_async_followers_share_one_future_per_loop():
+    flight = SingleFlight()
+    calls = []
+
+    async def check():
+        started.set()
+        await release.wait()
+        calls.append(1)
+        return 'success'
+
+    async def main():
+        leader = asyncio.create_task(flight.do_async('payment-1', check))
+        await started.wait()
+        followers = [asyncio.create_task(flight.do_async('payment-1', check)) for _ in range(200)]
+        await asyncio.sleep(0)
+
+        # No executor threads are parked on the flight, only one future for this loop
+        assert threading.active_count() == threads_before
+        assert len(flight._flights['payment-1'].waiters) == 1
+
+        release.set()
+        return await asyncio.gather(leader, *followers)
+
+    started, release = asyncio.Event(), asyncio.Event()
+    threads_before = threading.active_count()
+    results = asyncio.run(main())
+
+    assert results == ['success'] * 201
+    assert calls == [1]
+    assert flight.stats() == {'executions': 1, 'coalesced': 200, 'cache_hits': 0}
+
+
+def test_async_followers_wake_when_a_sync_leader_in_another_thread_lands():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def check():
+        started.set()
+        release.wait()
+        raise RuntimeError('gateway down')
+
+    def lead():
+        with pytest.raises(RuntimeError):
+            flight.do('payment-1', check)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+
+    async def follow():
+        async def never_run():
+            raise AssertionError('followers must not run the check')
+
+        followers = [asyncio.create_task(flight.do_async('payment-1', never_run)) for _ in range(10)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*followers, return_exceptions=True)
+
+    try:
+        results = asyncio.run(follow())
+    finally:
+        release.set()
+        leader.join()
+
+    assert [str(result) for result in results] == ['gateway down'] * 10
+
+
+def test_a_cancelled_follower_leaves_the_others_waiting():
+    flight = SingleFlight()
+
+    async def check():
+        await release.wait()
+        return 'success'
+
+    async def main():
+        leader = asyncio.create_task(flight.do_async('payment-1', check))
+        await asyncio.sleep(0)
+        cancelled, waiting = (asyncio.create_task(flight.do_async('payment-1', check)) for _ in range(2))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await leader, await waiting, cancelled.cancelled()
+
+    release = asyncio.Event()
+    assert asyncio.run(main()) == ('success', 'success', True)
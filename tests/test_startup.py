@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOGIN_PAGE = '''
+import sys
+import main
+
+response = main.create_app().test_client().get('/')
+assert response.status_code == 200, response.status_code
+# One write, so a log line from the warm-up thread cannot land inside it
+sys.stdout.write(f"twilio loaded: {'twilio' in sys.modules}\\n")
+'''
+
+
+def test_login_page_does_not_load_the_twilio_sdk():
+    env = dict(
+        os.environ,
+        SUPABASE_URL='http://supabase.test', SUPABASE_SERVICE_ROLE_KEY='test.service.key',
+        TWILIO_ACCOUNT_SID='ACtest', TWILIO_AUTH_TOKEN='test', TWILIO_SERVICE_SID='VAtest',
+        PAYMENT_POLLER_ENABLED='0'
+    )
+    # A fresh interpreter, since another test may already have imported twilio
+    result = subprocess.run(
+        [sys.executable, '-c', LOGIN_PAGE], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert 'twilio loaded: False' in result.stdout
@@ -0,0 +1,263 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from logs import get_logger
+
+log = get_logger('trace')
+
+_current = contextvars.ContextVar('trace', default=None)
+
+# Lists receiving every trace finished while a query_budget() block is open
+_collectors = []
+_collectors_lock = threading.Lock()
+
+# Query string keys that shape a PostgREST response rather than filter it
+_MODIFIERS = {'order', 'limit', 'offset', 'on_conflict', 'columns'}
+
+
+class Span:
+    """One upstream call: kind ('supabase', 'tumeny'...), operation name, timing and attributes."""
+
+    __slots__ = ('kind', 'name', 'start', 'duration', 'attrs')
+
+    def __init__(self, kind, name, start, duration, attrs):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.attrs = attrs
+
+
+class Trace:
+    """
+    The upstream calls made while serving one request (or one query_budget() block).
+
+    Spans are appended from whichever thread makes the call; batching.gather and
+    fetch_in copy the request's context into their pool threads, so fanned-out
+    queries are recorded on the same trace.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started
+
+    def calls(self, kind=None):
+        """Spans recorded so far, optionally only those of one kind."""
+        with self._lock:
+            return [span for span in self.spans if kind is None or span.kind == kind]
+
+    def server_timing(self):
+        """Server-Timing header value with the total time and call count per upstream kind."""
+        totals = {}
+        for span in self.calls():
+            duration, count = totals.get(span.kind, (0.0, 0))
+            totals[span.kind] = (duration + span.duration, count + 1)
+        return ', '.join(
+            f'{kind};dur={duration * 1000:.1f};desc="{count} calls"'
+            for kind, (duration, count) in totals.items()
+        )
+
+    def waterfall(self, width=40):
+        """
+        Renders the spans as a text waterfall, one line per call in start order:
+        offset from the start of the trace, duration, a bar, and the call's details.
+        """
+        spans = sorted(self.calls(), key=lambda span: span.start)
+        total = self.duration or (time.perf_counter() - self.started)
+        scale = width / total if total > 0 else 0
+
+        counts = {}
+        for span in spans:
+            counts[span.kind] = counts.get(span.kind, 0) + 1
+        summary = ', '.join(f'{kind} {count}' for kind, count in counts.items()) or 'none'
+        lines = [f'{self.label}  {total * 1000:.1f} ms  {len(spans)} upstream calls ({summary})']
+
+        for span in spans:
+            offset = span.start - self.started
+            left = max(0, min(int(offset * scale), width - 1))
+            bar_width = max(1, min(int(round(span.duration * scale)), width - left))
+            bar = ' ' * left + '#' * bar_width + ' ' * (width - left - bar_width)
+            details = '  '.join(f'{key}={value}' for key, value in span.attrs.items() if value is not None)
+            lines.append(
+                f'  +{offset * 1000:8.1f} ms {span.duration * 1000:8.1f} ms |{bar}| '
+                f'{span.kind} {span.name}  {details}'.rstrip()
+            )
+        return '\n'.join(lines)
+
+
+def current():
+    """The trace of the current request, or None when nothing is being traced."""
+    return _current.get()
+
+
+def start_trace(label):
+    """Starts tracing upstream calls made from the current context; returns the Trace."""
+    trace = Trace(label)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def finish_trace():
+    """
+    Ends the current trace, hands it to any open query_budget() blocks and returns it.
+
+    An enclosing trace (e.g. a query_budget() around a test client request) becomes current again.
+    """
+    trace = _current.get()
+    if trace is None:
+        return None
+    try:
+        _current.reset(trace._token)
+    except ValueError:
+        # Started in another context (e.g. before an async view's event loop copied it)
+        _current.set(None)
+    trace.finish()
+    with _collectors_lock:
+        for collected in _collectors:
+            collected.append(trace)
+    return trace
+
+
+def log_waterfall(trace, message='Upstream call waterfall', level=logging.INFO):
+    """Logs a trace's waterfall (plain text in the 'waterfall' field) with its call counts."""
+    log.log(level, message, extra={
+        'route': trace.label,
+        'duration_ms': round((trace.duration or 0) * 1000, 1),
+        'upstream_calls': len(trace.calls()),
+        'waterfall': trace.waterfall()
+    })
+
+
+def record_span(kind, name, start, duration, **attrs):
+    """Adds a finished call to the current trace (no-op when nothing is being traced)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(Span(kind, name, start, duration, attrs))
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """Times the enclosed upstream call onto the current trace; yields attrs so the call can add details."""
+    trace = _current.get()
+    if trace is None:
+        yield attrs
+        return
+
+    start = time.perf_counter()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        trace.add(Span(kind, name, start, time.perf_counter() - start, attrs))
+
+
+def query_shape(params):
+    """
+    Describes a PostgREST query string without its values, e.g.
+    'organisation_id=eq id=in[25] order', so repeated queries with the same shape stand out.
+    """
+    parts = []
+    for key, value in params.multi_items():
+        if key == 'select':
+            continue
+        if key in _MODIFIERS or key in ('or', 'and'):
+            parts.append(key)
+            continue
+        operator = value.split('.', 1)[0]
+        if operator in ('in', 'not') and '(' in value:
+            parts.append(f'{key}={operator}[{value.count(",") + 1}]')
+        else:
+            parts.append(f'{key}={operator}')
+    return ' '.join(parts) or None
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised by query_budget() when a block made more upstream calls than allowed."""
+
+
+class QueryCount:
+    """Upstream calls counted by count_queries(); `calls` is set when the block exits."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = None
+        self.traces = []  # the traces the calls were counted in
+
+    def waterfalls(self):
+        return '\n\n'.join(trace.waterfall() for trace in self.traces)
+
+
+@contextmanager
+def count_queries(kind='supabase'):
+    """
+    Counts the upstream calls of `kind` (every kind when None) the enclosed code makes,
+    for budgets that are relative rather than fixed, e.g. the same number of queries
+    for a payment covering one loan as for one covering fifty.
+
+    Calls made directly inside the block and by every request finished during it
+    (e.g. through the Flask test client) are counted; paginated reads count one
+    call per page. Inside an already traced request, the calls the block adds to
+    that request's trace are counted.
+
+        with count_queries() as one, count_queries() as many: ...
+        assert one.calls == many.calls
+    """
+    count = QueryCount(kind)
+    collected = count.traces
+    with _collectors_lock:
+        _collectors.append(collected)
+
+    outer = _current.get()
+    outer_calls = len(outer.calls(kind)) if outer is not None else 0
+    own_trace = start_trace('count_queries') if outer is None else None
+
+    try:
+        yield count
+    finally:
+        if own_trace is not None:
+            finish_trace()
+        with _collectors_lock:
+            _collectors.remove(collected)
+
+    count.calls = sum(len(trace.calls(kind)) for trace in collected)
+    if outer is not None:
+        count.calls += len(outer.calls(kind)) - outer_calls
+        collected.append(outer)
+
+
+@contextmanager
+def query_budget(max_calls, kind='supabase'):
+    """
+    Asserts that the enclosed code makes at most max_calls upstream calls of `kind`
+    (every kind when None), for catching N+1 query patterns in tests and scripts.
+
+    Calls are counted as by count_queries(). On failure the waterfalls are in the
+    exception message.
+
+        with query_budget(3):
+            client.get('/staff_breakdown/2025-08')
+    """
+    with count_queries(kind) as count:
+        yield count.traces
+
+    if count.calls > max_calls:
+        raise QueryBudgetExceeded(
+            f"{count.calls} {kind or 'upstream'} calls, budget is {max_calls}:\n{count.waterfalls()}"
+        )
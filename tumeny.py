@@ -0,0 +1,600 @@
+import asyncio
+import bisect
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+from logs import get_logger
+from metrics import observe_upstream
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX platforms fall back to process-local locking only
+    fcntl = None
+
+log = get_logger('tumeny')
+
+TUMENY_BASE_URL = "https://tumeny.herokuapp.com"
+
+# (connect, read) timeouts in seconds per gateway endpoint
+ENDPOINT_TIMEOUTS = {
+    'token': (3.05, 10),
+    'payment': (3.05, 30),
+    'payment_status': (3.05, 10),
+}
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+class LatencyHistogram:
+    """Thread-safe cumulative latency histogram with fixed bucket bounds (seconds)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += seconds
+            self._count += 1
+            if error:
+                self._errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total, count, errors = self._sum, self._count, self._errors
+
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+
+        return {'buckets': cumulative, 'sum': round(total, 6), 'count': count, 'errors': errors}
+
+
+class TumenyTransport:
+    """
+    Pooled keep-alive HTTP transport for the TuMeNy gateway.
+
+    Every call names its endpoint ('token', 'payment', 'payment_status') so it
+    gets that endpoint's (connect, read) timeout and is recorded in that
+    endpoint's latency histogram. Only GET requests are retried, with
+    exponential backoff and full jitter, and only while the total time spent
+    stays within the retry budget; POSTs are never replayed since they are
+    not idempotent.
+    """
+
+    def __init__(self, base_url=TUMENY_BASE_URL, pool_size=None, timeouts=None,
+                 max_retries=None, retry_budget=None, backoff_base=0.2):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = int(pool_size or os.getenv('TUMENY_POOL_SIZE', 10))
+        self.timeouts = dict(ENDPOINT_TIMEOUTS, **(timeouts or {}))
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv('TUMENY_GET_RETRIES', 2))
+        self.retry_budget = float(retry_budget or os.getenv('TUMENY_RETRY_BUDGET', 15))
+        self.backoff_base = backoff_base
+
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self._histograms = {}
+
+    @property
+    def session(self):
+        """The pooled requests.Session for this process (rebuilt after fork)."""
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            with self._lock:
+                if self._session is None or self._pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = pid
+        return self._session
+
+    def histogram(self, endpoint):
+        histogram = self._histograms.get(endpoint)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(endpoint, LatencyHistogram())
+        return histogram
+
+    def _observe(self, endpoint, seconds, error=False):
+        """Records one attempt in the endpoint's histogram and the shared /metrics store."""
+        self.histogram(endpoint).observe(seconds, error=error)
+        observe_upstream(f'tumeny.{endpoint}', seconds, error)
+
+    def request(self, endpoint, method, path, **kwargs):
+        """
+        Sends a request to the gateway.
+
+        Args:
+            endpoint (str): Endpoint name used for timeouts and latency stats.
+            method (str): HTTP method.
+            path (str): Path relative to the gateway base URL.
+
+        Returns:
+            requests.Response
+
+        Raises:
+            requests.RequestException: When the request (and any retries) failed.
+        """
+        with tracing.span('tumeny', endpoint, method=method) as attrs:
+            response = self._send(endpoint, method, path, **kwargs)
+            attrs['status'] = response.status_code
+            attrs['bytes'] = len(response.content)
+            return response
+
+    def _send(self, endpoint, method, path, **kwargs):
+        """Sends the request, retrying GETs within the budget (see request)."""
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeouts.get(endpoint, (3.05, 30)))
+        retries = self.max_retries if method.upper() == 'GET' else 0
+        started = time.monotonic()
+        attempt = 0
+
+        while True:
+            attempt_started = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._observe(endpoint, time.monotonic() - attempt_started, error=True)
+                if not self._should_retry(attempt, retries, started):
+                    raise
+            else:
+                failed = response.status_code >= 500
+                self._observe(endpoint, time.monotonic() - attempt_started, error=failed)
+                if response.status_code not in RETRYABLE_STATUS_CODES \
+                        or not self._should_retry(attempt, retries, started):
+                    return response
+                response.close()
+
+            attempt += 1
+
+    def _should_retry(self, attempt, retries, started):
+        """Sleeps for the backoff delay and returns True if another attempt fits in the budget."""
+        if attempt >= retries:
+            return False
+
+        delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+        if time.monotonic() - started + delay >= self.retry_budget:
+            return False
+
+        time.sleep(delay)
+        return True
+
+    def get(self, endpoint, path, **kwargs):
+        return self.request(endpoint, 'GET', path, **kwargs)
+
+    def post(self, endpoint, path, **kwargs):
+        return self.request(endpoint, 'POST', path, **kwargs)
+
+    def stats(self):
+        """Returns a latency histogram snapshot per endpoint."""
+        return {endpoint: histogram.snapshot() for endpoint, histogram in list(self._histograms.items())}
+
+
+transport = TumenyTransport()
+
+
+class AsyncTumenyTransport(TumenyTransport):
+    """
+    asyncio-native counterpart of TumenyTransport built on httpx.AsyncClient.
+
+    The client and its keep-alive pool live on one background event loop per
+    process, so connections survive across requests even though Flask runs each
+    async view in its own short-lived loop. Coroutines awaited from any loop are
+    handed to the gateway loop, which can hold many in-flight gateway calls at
+    once. Timeouts, GET-only retries and latency histograms match the sync transport.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = None
+        self._loop_pid = None
+        self._client = None
+
+    def _gateway_loop(self):
+        pid = os.getpid()
+        if self._loop is None or self._loop_pid != pid:
+            with self._lock:
+                if self._loop is None or self._loop_pid != pid:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='tumeny-async', daemon=True).start()
+                    self._client = None
+                    self._loop = loop
+                    self._loop_pid = pid
+        return self._loop
+
+    def _async_client(self):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=limits)
+        return self._client
+
+    async def request(self, endpoint, method, path, **kwargs):
+        """
+        Sends a request to the gateway.
+
+        Returns:
+            httpx.Response
+
+        Raises:
+            httpx.TransportError: When the request (and any retries) failed.
+        """
+        loop = self._gateway_loop()
+        coroutine = self._request(endpoint, method, path, **kwargs)
+        # The span is timed here, in the caller's context, where the request's trace is visible
+        with tracing.span('tumeny', endpoint, method=method) as attrs:
+            if asyncio.get_running_loop() is loop:
+                response = await coroutine
+            else:
+                response = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+            attrs['status'] = response.status_code
+            attrs['bytes'] = len(response.content)
+            return response
+
+    async def _request(self, endpoint, method, path, **kwargs):
+        connect, read = self.timeouts.get(endpoint, (3.05, 30))
+        kwargs.setdefault('timeout', httpx.Timeout(read, connect=connect))
+        retries = self.max_retries if method.upper() == 'GET' else 0
+        started = time.monotonic()
+        attempt = 0
+        client = self._async_client()
+
+        while True:
+            attempt_started = time.monotonic()
+            try:
+                response = await client.request(method, path, **kwargs)
+            except httpx.TransportError:
+                self._observe(endpoint, time.monotonic() - attempt_started, error=True)
+                if not await self._should_retry_async(attempt, retries, started):
+                    raise
+            else:
+                failed = response.status_code >= 500
+                self._observe(endpoint, time.monotonic() - attempt_started, error=failed)
+                if response.status_code not in RETRYABLE_STATUS_CODES \
+                        or not await self._should_retry_async(attempt, retries, started):
+                    return response
+
+            attempt += 1
+
+    async def _should_retry_async(self, attempt, retries, started):
+        if attempt >= retries:
+            return False
+
+        delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+        if time.monotonic() - started + delay >= self.retry_budget:
+            return False
+
+        await asyncio.sleep(delay)
+        return True
+
+    async def get(self, endpoint, path, **kwargs):
+        return await self.request(endpoint, 'GET', path, **kwargs)
+
+    async def post(self, endpoint, path, **kwargs):
+        return await self.request(endpoint, 'POST', path, **kwargs)
+
+
+async_transport = AsyncTumenyTransport()
+
+
+def parse_token_expiry(expire_at):
+    """Converts the expireAt value returned by /api/token into a datetime."""
+    # Handle the datetime format returned by the API
+    if isinstance(expire_at, dict) and 'date' in expire_at:
+        # Parse the datetime string from the API response
+        try:
+            expire_datetime_str = expire_at['date']
+            # Parse the datetime string - it's in UTC format
+            token_expiry = datetime.fromisoformat(expire_datetime_str.replace('Z', '+00:00'))
+            log.debug("TuMeNy token expiry parsed", extra={'token_expiry': token_expiry})
+        except (ValueError, KeyError) as e:
+            log.warning("Could not parse expireAt datetime, using 1 hour default", extra={'expire_at': expire_at})
+            token_expiry = datetime.now() + timedelta(hours=1)
+    elif isinstance(expire_at, (int, float)):
+        # Handle seconds format (fallback)
+        token_expiry = datetime.now() + timedelta(seconds=int(expire_at))
+    elif isinstance(expire_at, str):
+        try:
+            # Try to parse as ISO format datetime string
+            token_expiry = datetime.fromisoformat(expire_at.replace('Z', '+00:00'))
+        except ValueError:
+            try:
+                # Try to parse as seconds
+                expire_seconds = int(expire_at)
+                token_expiry = datetime.now() + timedelta(seconds=expire_seconds)
+            except ValueError:
+                log.warning("Could not parse expireAt string, using 1 hour default", extra={'expire_at': expire_at})
+                token_expiry = datetime.now() + timedelta(hours=1)
+    else:
+        log.warning("Unexpected expireAt format, using 1 hour default", extra={'expire_at_type': type(expire_at).__name__})
+        token_expiry = datetime.now() + timedelta(hours=1)
+
+    return token_expiry
+
+
+def fetch_tumeny_auth_token(api_key, api_secret):
+    """
+    Requests a new auth token from TuMeNy.
+
+    Returns:
+        tuple: (token, token_expiry) or (None, None) on failure.
+    """
+    headers = {
+        "apiKey": api_key,
+        "apiSecret": api_secret
+    }
+
+    try:
+        response = transport.post('token', '/api/token', headers=headers)
+        response.raise_for_status()
+
+        data = response.json()
+        token = data.get("token")
+        expire_at = data.get("expireAt")
+
+        if not token:
+            raise Exception("Token not found in response")
+
+        if expire_at is None:
+            raise Exception("expireAt not found in response")
+
+        return token, parse_token_expiry(expire_at)
+
+    except requests.RequestException as e:
+        log.error("Failed to get TuMeNy auth token", extra={'error': str(e)})
+        return None, None
+
+
+class TumenyTokenManager:
+    """
+    Process-level cache for the TuMeNy auth token shared by every Pay instance.
+
+    The cached token is handed out until it gets within `refresh_margin` seconds
+    of its expiry, at which point a single background refresh is started while
+    callers keep using the still-valid token. Concurrent callers that find no
+    usable token wait on one fetch (a background refresh already in progress
+    included) instead of each requesting their own.
+
+    When TUMENY_TOKEN_CACHE_FILE is set the token is also shared between
+    worker processes through that file, guarded by an flock so only one worker
+    fetches at a time.
+    """
+
+    def __init__(self, refresh_margin=None, cache_file=None, fetcher=None):
+        self.refresh_margin = float(refresh_margin or os.getenv('TUMENY_TOKEN_REFRESH_MARGIN', 300))
+        self.cache_file = cache_file or os.getenv('TUMENY_TOKEN_CACHE_FILE')
+        self._fetcher = fetcher
+
+        self._lock = threading.Lock()  # guards the cached token and the stats
+        self._fetch_lock = threading.Lock()  # held for the whole of every fetch, background or not
+        self._token = None
+        self._token_expiry = None
+        self._expires_at = 0.0
+        self._refresh_thread = None
+
+        self._stats = {
+            'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0, 'file_hits': 0, 'invalidations': 0
+        }
+
+    def _fetch(self):
+        if self._fetcher is not None:
+            return self._fetcher()
+
+        api_key = os.getenv("TUMENY_API_KEY")
+        api_secret = os.getenv("TUMENY_API_SECRET")
+        if not api_key or not api_secret:
+            raise Exception("Missing TUMENY_API_KEY or TUMENY_API_SECRET in environment variables.")
+
+        return fetch_tumeny_auth_token(api_key, api_secret)
+
+    def _store(self, token, token_expiry):
+        self._token = token
+        self._token_expiry = token_expiry
+        self._expires_at = token_expiry.timestamp()
+
+    def _read_file(self):
+        """Returns (token, token_expiry) from the shared cache file if it holds a usable token."""
+        if not self.cache_file:
+            return None, None
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+            expires_at = float(data['expires_at'])
+            if expires_at - time.time() <= self.refresh_margin:
+                return None, None
+            return data['token'], datetime.fromtimestamp(expires_at)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def _write_file(self, token, token_expiry):
+        if not self.cache_file:
+            return
+        try:
+            directory = os.path.dirname(os.path.abspath(self.cache_file))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tumeny_token_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'token': token, 'expires_at': token_expiry.timestamp()}, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            log.warning("Could not write TuMeNy token cache file", extra={'error': str(e)})
+
+    @contextmanager
+    def _file_lock(self):
+        """Holds the flock that serialises every worker's changes to the shared cache file."""
+        lock_file = None
+        if self.cache_file and fcntl is not None:
+            try:
+                lock_file = open(f"{self.cache_file}.lock", 'w')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            except OSError as e:
+                log.warning("Could not lock TuMeNy token cache file", extra={'error': str(e)})
+                lock_file = None
+        try:
+            yield
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _refresh(self):
+        """Fetches a new token, coordinating with other workers through the cache file lock."""
+        with self._file_lock():
+            # Another worker may have refreshed while we waited for the lock
+            token, token_expiry = self._read_file()
+            if token and token_expiry.timestamp() > self._expires_at:
+                self._count('file_hits')
+                return token, token_expiry
+
+            token, token_expiry = self._fetch()
+            if token:
+                self._count('refreshes')
+                self._write_file(token, token_expiry)
+            else:
+                self._count('refresh_failures')
+            return token, token_expiry
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _usable_token(self, margin=0.0):
+        """The cached (token, token_expiry) if it is valid for more than `margin` seconds, else None."""
+        with self._lock:
+            if self._token and self._expires_at - time.time() > margin:
+                return self._token, self._token_expiry
+        return None
+
+    def _background_refresh(self):
+        try:
+            with self._fetch_lock:
+                # A caller that found the cache empty may have fetched while we waited
+                if self._usable_token(self.refresh_margin) is not None:
+                    return
+                token, token_expiry = self._refresh()
+                if token:
+                    with self._lock:
+                        self._store(token, token_expiry)
+        except Exception as e:
+            self._count('refresh_failures')
+            log.exception("Background TuMeNy token refresh failed")
+        finally:
+            with self._lock:
+                self._refresh_thread = None
+
+    def get_token(self):
+        """
+        Returns a valid (token, token_expiry) pair, fetching one only when needed.
+
+        A caller that finds no usable token waits for any fetch already in progress
+        (including a background refresh) and uses its token rather than fetching again.
+
+        Returns:
+            tuple: (token, token_expiry) or (None, None) if no token could be acquired.
+        """
+        with self._lock:
+            token, token_expiry = self._token, self._token_expiry
+            remaining = self._expires_at - time.time()
+            if token and remaining > 0:
+                self._stats['hits'] += 1
+        if token and remaining > 0:
+            if remaining <= self.refresh_margin:
+                self._start_background_refresh()
+            return token, token_expiry
+
+        with self._fetch_lock:
+            # Re-check: the fetch we waited for (a caller's or the background refresh) may have stored a token
+            cached = self._usable_token()
+            if cached is not None:
+                self._count('hits')
+                return cached
+
+            self._count('misses')
+            token, token_expiry = self._read_file()
+            if token:
+                self._count('file_hits')
+            else:
+                token, token_expiry = self._refresh()
+
+            if token:
+                with self._lock:
+                    self._store(token, token_expiry)
+            return token, token_expiry
+
+    async def get_token_async(self):
+        """
+        Async variant of get_token. Cache hits return immediately; a miss runs the
+        single-flight fetch in a worker thread so the event loop is never blocked.
+        """
+        cached = self._usable_token(self.refresh_margin)
+        if cached is not None:
+            self._count('hits')
+            return cached
+
+        return await asyncio.to_thread(self.get_token)
+
+    def _start_background_refresh(self):
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._background_refresh,
+                name='tumeny-token-refresh',
+                daemon=True
+            )
+            self._refresh_thread.start()
+
+    def invalidate(self, token=None):
+        """
+        Drops the cached token, in this process and in the shared cache file, e.g. after
+        the gateway rejects it with a 401. Pass the rejected token so that a newer one,
+        fetched by another caller in the meantime, is kept.
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._token_expiry = None
+                self._expires_at = 0.0
+                self._stats['invalidations'] += 1
+
+        if not self.cache_file:
+            return
+        with self._file_lock():
+            cached, _ = self._read_file()
+            if cached and (token is None or cached == token):
+                try:
+                    os.remove(self.cache_file)
+                except OSError as e:
+                    log.warning("Could not remove TuMeNy token cache file", extra={'error': str(e)})
+
+    def stats(self):
+        """Returns cache hit/miss/refresh counters."""
+        with self._lock:
+            return dict(self._stats)
+
+
+token_manager = TumenyTokenManager()